@@ -0,0 +1,251 @@
+'''
+Benchmark harness for the A* and OPERA processing stages on synthetic inputs.
+
+Run from the project root:
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --qpe-sizes 8 32 --dist-sizes 512 --cores 1 2 4
+    python -m benchmarks.run_benchmarks --save-baseline     # record benchmarks/baselines.json
+Each measurement runs in a fresh process so peak RSS belongs to the stage alone, with its own scratch
+directory so concurrent copies in the core-scaling runs never share output files. A run is compared
+against the stored baselines and exits with status 1 if any stage's throughput drops by more than
+--tolerance. Throughput depends on the machine, so no baseline is committed: record one locally with
+--save-baseline (or point --baseline at a file recorded on the same machine) before comparing.
+'''
+# Library Imports
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import cProfile
+import resource
+import tempfile
+import multiprocessing as mp
+
+import numpy as np
+import xarray as xr
+
+from benchmarks.synthetic import write_synthetic_qpe, write_synthetic_dist_alert
+from modules.RainfallProcessor import HRAP_PROJ4, RainfallProcessor
+from modules.figure_and_boundingboxes import astar_regions
+from modules.stack_bands import stack_bands
+from modules.dist_utils import mask_rasters, compute_areas
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LATLON_CSV = os.path.join(project_root, 'astar_needed_DoNotTouch', 'QPE_latlons_new.csv')
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+DIST_BANDS = ['VEG-ANOM-MAX', 'VEG-DIST-DATE', 'VEG-DIST-STATUS']
+CA_BOX = dict(min_lon=-125, max_lon=-113, min_lat=32, max_lat=43)
+
+def _processor(ctx):
+    return RainfallProcessor(latlon_csv_path=LATLON_CSV, crs_proj4=HRAP_PROJ4, output_dir=ctx['scratch'])
+
+def _astar(ctx):
+    awi = xr.open_dataarray(ctx['awi_file']).fillna(0) + 0.18
+    recurrence = awi.max(dim='z') * 0.9 + 0.18
+    return awi / recurrence
+
+# ------------------------------------------------------------------------------------------------ #
+# Stages: each takes a fixture context and returns the number of work units it processed
+# ------------------------------------------------------------------------------------------------ #
+
+def stage_decode(ctx):
+    for file in ctx['qpe_files']:
+        xr.open_dataset(file, decode_times=False, decode_coords="all").load()
+    return len(ctx['qpe_files'])
+
+def stage_reproject(ctx):
+    processor = _processor(ctx)
+    for file in ctx['qpe_files']:
+        processor.process_file_CNRFC(file, None).load()
+    return len(ctx['qpe_files'])
+
+def stage_awi(ctx):
+    processor = _processor(ctx)
+    processor.process_dir_CNRFC_AWI_WY(os.path.join(ctx['qpe_dir'], '*.nc'), year=None, WY=ctx.get('WY', 'bench'),
+                                       **CA_BOX)
+    return len(ctx['qpe_files'])
+
+def stage_astar(ctx):
+    astar = _astar(ctx).load()
+    return int(astar.size)
+
+def stage_regions(ctx):
+    astar = _astar(ctx).load()
+    times = astar['time'].values
+    regions, _ = astar_regions(astar, times[1], times[-1], 1.1)
+    return int(astar.size)
+
+def stage_stack_bands(ctx):
+    cube, _ = stack_bands(ctx['stac_item'], DIST_BANDS)
+    cube.load()
+    return int(cube.z.sel(band=1).size)
+
+def stage_area_stats(ctx):
+    cube, _ = stack_bands(ctx['stac_item'], DIST_BANDS)
+    anom, date, status = mask_rasters(cube.z.sel(band=1), cube.z.sel(band=2), cube.z.sel(band=3), as_mask=True)
+    classes, counts = np.unique(status.compressed(), return_counts=True)
+    stats = {0: int(status.size - status.count())}
+    stats.update({int(c): int(n) for c, n in zip(classes, counts)})
+    stats = [{k: stats.get(k, 0) for k in range(5)}]
+    compute_areas(stats, 30 * 30)
+    return int(status.size)
+
+STAGES = {
+    'decode': (stage_decode, 'qpe', 'files'),
+    'reproject': (stage_reproject, 'qpe', 'files'),
+    'awi': (stage_awi, 'qpe', 'files'),
+    'astar': (stage_astar, 'qpe', 'cells'),
+    'regions': (stage_regions, 'qpe', 'cells'),
+    'stack_bands': (stage_stack_bands, 'dist', 'pixels'),
+    'area_stats': (stage_area_stats, 'dist', 'pixels'),
+}
+
+# ------------------------------------------------------------------------------------------------ #
+# Measurement
+# ------------------------------------------------------------------------------------------------ #
+
+def _worker_ctx(ctx, worker):
+    '''
+    Returns the context of one measured run, writing to its own scratch directory and WY tag.
+    '''
+    if 'scratch' not in ctx:
+        return ctx
+    return dict(ctx, scratch=os.path.join(ctx['scratch'], f'worker_{worker}'), WY=f'bench_{worker}')
+
+def _measure(args):
+    '''
+    Runs one stage in the current (fresh) process and returns (elapsed s, units, peak RSS bytes).
+    '''
+    stage, ctx, profile_path = args
+    func = STAGES[stage][0]
+    if 'scratch' in ctx:
+        os.makedirs(ctx['scratch'], exist_ok=True)
+    profiler = cProfile.Profile() if profile_path else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    units = func(ctx)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, units, peak_kb * 1024
+
+def run_stage(stage, ctx, cores, repeat, profile_path=None):
+    '''
+    Returns timing, throughput and peak RSS for one stage, plus throughput when k copies run on k cores.
+    '''
+    spawn = mp.get_context('spawn')
+    best = None
+    for r in range(repeat):
+        with spawn.Pool(1, maxtasksperchild=1) as pool:
+            result = pool.apply(_measure, ((stage, _worker_ctx(ctx, 0), profile_path if r == 0 else None),))
+        if best is None or result[0] < best[0]:
+            best = result
+    elapsed, units, peak = best
+
+    scaling = {}
+    for k in cores:
+        with spawn.Pool(k, maxtasksperchild=1) as pool:
+            start = time.perf_counter()
+            results = pool.map(_measure, [(stage, _worker_ctx(ctx, worker), None) for worker in range(k)])
+            wall = time.perf_counter() - start
+        scaling[str(k)] = sum(r[1] for r in results) / wall
+
+    return {
+        'seconds': elapsed,
+        'units': units,
+        'throughput': units / elapsed,
+        'peak_rss_mb': peak / 2**20,
+        'scaling': scaling,
+    }
+
+def prepare_fixtures(workdir, qpe_sizes, dist_sizes):
+    '''
+    Writes the synthetic inputs once and returns a context per (kind, size).
+    '''
+    fixtures = {}
+    for n_steps in qpe_sizes:
+        qpe_dir = os.path.join(workdir, f'qpe_{n_steps}')
+        scratch = os.path.join(workdir, f'scratch_{n_steps}')
+        os.makedirs(scratch, exist_ok=True)
+        files = sorted(glob.glob(os.path.join(qpe_dir, '*.nc'))) or write_synthetic_qpe(qpe_dir, LATLON_CSV, n_steps)
+        ctx = {'qpe_dir': qpe_dir, 'qpe_files': files, 'scratch': scratch,
+               'awi_file': os.path.join(scratch, 'AWI_prism_bench.nc')}
+        if not os.path.exists(ctx['awi_file']):
+            stage_awi(ctx)
+        fixtures[('qpe', n_steps)] = ctx
+    for size in dist_sizes:
+        fixtures[('dist', size)] = {'stac_item': write_synthetic_dist_alert(os.path.join(workdir, f'dist_{size}'), size)}
+    return fixtures
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns the list of stage/size keys whose throughput fell below baseline * (1 - tolerance).
+    '''
+    regressions = []
+    for key, result in results.items():
+        if key in baseline and result['throughput'] < baseline[key]['throughput'] * (1 - tolerance):
+            regressions.append(key)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the A* and OPERA stages on synthetic data.')
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=list(STAGES))
+    parser.add_argument('--qpe-sizes', nargs='+', type=int, default=[8, 32, 120], help='6-hour QPE files per run')
+    parser.add_argument('--dist-sizes', nargs='+', type=int, default=[512, 1024, 2048], help='DIST-ALERT tile width')
+    parser.add_argument('--cores', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', default=None, help='Fixture directory (reused between runs)')
+    parser.add_argument('--profile-dir', default=None, help='Write a cProfile .prof file per stage and size')
+    parser.add_argument('--output', default=None, help='Write results as JSON')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='landslide_bench_')
+    print(f"Preparing synthetic fixtures in {workdir}")
+    fixtures = prepare_fixtures(workdir, args.qpe_sizes, args.dist_sizes)
+    if args.profile_dir:
+        os.makedirs(args.profile_dir, exist_ok=True)
+
+    results = {}
+    print(f"{'stage':<12}{'size':>7}{'seconds':>10}{'throughput':>16}{'peak MB':>10}  scaling")
+    for stage in args.stages:
+        kind, unit = STAGES[stage][1], STAGES[stage][2]
+        for (fixture_kind, size), ctx in fixtures.items():
+            if fixture_kind != kind:
+                continue
+            profile_path = os.path.join(args.profile_dir, f'{stage}_{size}.prof') if args.profile_dir else None
+            result = run_stage(stage, ctx, args.cores, args.repeat, profile_path)
+            results[f'{stage}/{size}'] = result
+            scaling = ' '.join(f"{k}:{v / result['scaling'][str(args.cores[0])]:.2f}x"
+                               for k, v in result['scaling'].items())
+            print(f"{stage:<12}{size:>7}{result['seconds']:>10.3f}{result['throughput']:>11.1f} {unit:<5}"
+                  f"{result['peak_rss_mb']:>9.0f}  {scaling}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for key in regressions:
+            print(f"REGRESSION {key}: {results[key]['throughput']:.1f} vs baseline {baseline[key]['throughput']:.1f}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
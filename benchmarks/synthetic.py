@@ -0,0 +1,89 @@
+# Library Imports
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+import rasterio as rio
+from rasterio.transform import from_origin
+
+# DIST-ALERT band layout used by stack_bands and mask_rasters
+DIST_BANDS = {
+    'VEG-ANOM-MAX': ('uint8', 255),
+    'VEG-DIST-DATE': ('int16', -1),
+    'VEG-DIST-STATUS': ('uint8', 255),
+}
+
+def qpe_grid_shape(latlon_csv_path):
+    '''
+    Returns the (ny, nx) HRAP grid shape described by QPE_latlons_new.csv.
+    '''
+    df = pd.read_csv(latlon_csv_path, sep=',')
+    return int((df['Grid x'] == 0).sum()), int((df['Grid y'] == 0).sum())
+
+def write_synthetic_qpe(output_dir, latlon_csv_path, n_steps, start='2022-12-25T00:00', seed=0):
+    '''
+    Writes CNRFC-shaped 6-hour qpe_grid NetCDF files on the HRAP grid.
+            Parameters:
+                    output_dir (str): Directory for the qpe.YYYYMMDD_HHMM.nc files
+                    latlon_csv_path (str): Path to QPE_latlons_new.csv
+                    n_steps (int): Number of 6-hour files to write
+                    start (str): Timestamp of the first file
+                    seed (int): Random seed
+            Returns:
+                    filenames (list): Paths of the written files
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    ny, nx = qpe_grid_shape(latlon_csv_path)
+    rng = np.random.default_rng(seed)
+
+    # A storm cell drifting east over a dry background, in mm per 6 hours
+    yy, xx = np.mgrid[0:ny, 0:nx]
+    filenames = []
+    for step, time in enumerate(pd.date_range(start=start, periods=n_steps, freq='6h')):
+        cx = (step * 3) % nx
+        cell = 40.0 * np.exp(-((xx - cx) ** 2 + (yy - ny / 2) ** 2) / (2 * 30.0 ** 2))
+        rain = (cell + rng.gamma(0.3, 1.0, size=(ny, nx))).astype('float32')
+        ds = xr.Dataset({'qpe_grid': (('dimy', 'dimx'), rain, {'units': 'mm'})})
+        filename = os.path.join(output_dir, f"qpe.{time.strftime('%Y%m%d_%H%M')}.nc")
+        ds.to_netcdf(filename)
+        filenames.append(filename)
+    return filenames
+
+def write_synthetic_dist_alert(output_dir, size, seed=0, epsg=32610, ref_day=760):
+    '''
+    Writes one synthetic DIST-ALERT granule as three single band COGs (30 m UTM pixels).
+            Parameters:
+                    output_dir (str): Directory for the band files
+                    size (int): Width and height of the tile in pixels (a real MGRS tile is 3660)
+                    seed (int): Random seed
+                    epsg (int): UTM zone EPSG code
+                    ref_day (int): Typical VEG-DIST-DATE value (days since 2020-12-31)
+            Returns:
+                    stac_item (dict): Minimal STAC item with an href per band, as read by stack_bands
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    # Sparse disturbed patches, the rest no disturbance
+    disturbed = rng.random((size, size)) < 0.02
+    status = np.where(disturbed, rng.integers(1, 5, size=(size, size)), 0).astype('uint8')
+    date = np.where(disturbed, ref_day + rng.integers(-30, 60, size=(size, size)), 0).astype('int16')
+    anom = np.where(disturbed, rng.integers(10, 101, size=(size, size)), 0).astype('uint8')
+    border = size // 50
+    status[:border, :] = 255
+    anom[:border, :] = 255
+    date[:border, :] = -1
+
+    profile = {
+        'driver': 'COG', 'height': size, 'width': size, 'count': 1,
+        'crs': rio.crs.CRS.from_epsg(epsg), 'transform': from_origin(600000.0, 4100000.0, 30.0, 30.0),
+        'compress': 'deflate', 'blocksize': 512,
+    }
+    arrays = {'VEG-ANOM-MAX': anom, 'VEG-DIST-DATE': date, 'VEG-DIST-STATUS': status}
+    assets = {}
+    for band, (dtype, nodata) in DIST_BANDS.items():
+        href = os.path.join(output_dir, f"OPERA_L3_DIST-ALERT-HLS_T10SFG_synthetic_{band}.tif")
+        with rio.open(href, 'w', dtype=dtype, nodata=nodata, **profile) as dst:
+            dst.write(arrays[band], 1)
+        assets[band] = {'href': href}
+    return {'id': f'OPERA_L3_DIST-ALERT-HLS_T10SFG_synthetic_{size}', 'assets': assets}
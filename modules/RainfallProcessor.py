@@ -1,72 +1,165 @@
 import os
-import glob
 import numpy as np
 import pandas as pd
 import xarray as xr
-import rasterio
-from metpy.units import units
-import rioxarray
 import time
 
+from modules.instrumentation import instrumentation, instrumented
+from modules.qpe_index import QPEFileIndex, parse_qpe_time
+
+# Polar stereographic HRAP projection of the CNRFC QPE grid, in grid cells
+HRAP_PROJ4 = ('+proj=stere +lat_0=90 +lat_ts=60 +lon_0=-105 +k=1 +x_0=2202656.25 +y_0=6515100 '
+              '+a=6371200 +b=6371200 +to_meter=4762.5 +no_defs')
+
+def grid_era(eras, time):
+    '''
+    Returns the value in effect at a time, for settings that change with the QPE grid (e.g. Sep. 2020).
+            Parameters:
+                    eras (str or dict): One value for every time, or {first valid time: value} per grid era
+                    time (Timestamp): Valid time of a QPE file
+            Returns:
+                    value: The value of the latest era starting at or before time
+    '''
+    if not isinstance(eras, dict):
+        return eras
+    starts = sorted((pd.Timestamp(str(start)), value) for start, value in eras.items())
+    current = [value for start, value in starts if start <= time]
+    if not current:
+        raise Exception(f"Invalid value for 'eras'. No grid era starts at or before {time} (first: {starts[0][0]}).")
+    return current[-1]
+
 class RainfallProcessor:
+    '''
+    Decodes CNRFC QPE files and runs the AWI recurrence over them.
+            Parameters:
+                    latlon_csv_path (str or dict): QPE_latlons CSV of the grid, or {first valid time: CSV} per grid
+                                                   era; each file must match the grid size of its CSV
+                    crs_proj4 (str or dict): PROJ string of the grid, or {first valid time: PROJ string} per era
+                    output_dir (str): Directory of the prism files
+    '''
     def __init__(self, latlon_csv_path, crs_proj4, output_dir):
+        # rasterio, metpy and rioxarray are imported on first use to keep module import light
+        import rasterio
         self.latlon_csv_path = latlon_csv_path
-        self.crs = rasterio.crs.CRS.from_proj4(crs_proj4)
+        if isinstance(crs_proj4, dict):
+            self.crs = {start: rasterio.crs.CRS.from_proj4(proj4) for start, proj4 in crs_proj4.items()}
+        else:
+            self.crs = rasterio.crs.CRS.from_proj4(crs_proj4)
         self.output_dir = output_dir
+        self._grid_axes = {}
 
-    def process_file_CNRFC(self, filepath, year):
-        ds = xr.open_dataset(filepath, decode_times=False, decode_coords="all")
-        ds = ds.squeeze()
+    def grid_axes(self, latlon_csv_path):
+        '''
+        Returns the (latitude, longitude) grid axes described by a QPE_latlons CSV, read once per CSV.
+        '''
+        if latlon_csv_path not in self._grid_axes:
+            df = pd.read_csv(latlon_csv_path, sep=',')
+            latvec = df.loc[df['Grid x'] == 0, 'Grid y'].values
+            lonvec = df.loc[df['Grid y'] == 0, 'Grid x'].values
+            self._grid_axes[latlon_csv_path] = (latvec, lonvec)
+        return self._grid_axes[latlon_csv_path]
 
-        df = pd.read_csv(self.latlon_csv_path, sep=',')
-        forlatvec = df.loc[df['Grid x'] == 0]
-        latvec = forlatvec['Grid y'].values
-        forlonvec = df.loc[df['Grid y'] == 0]
-        lonvec = forlonvec['Grid x'].values
+    def process_file_CNRFC(self, filepath, year, dtype=None):
+        '''
+        Returns the rain of one QPE file in metres on the EPSG:4326 grid. With dtype (e.g. 'float32') the grid
+        is cast once after decoding and converted to metres in that dtype, so no float64 copy is made.
+        '''
+        from metpy.units import units
+        import rioxarray
+        with instrumentation.stage('qpe_decode'):
+            # open_dataset is lazy; load() inside the stage so the decode itself is timed
+            ds = xr.open_dataset(filepath, decode_times=False, decode_coords="all")
+            ds = ds.squeeze().load()
+            instrumentation.read_file(filepath)
+
+        # Valid time from the qpe.YYYYMMDD_HHMM.nc filename, in nanosecond precision
+        rtime = np.datetime64(parse_qpe_time(filepath), 'ns')
+
+        # The grid changed over the archive, so the CSV and projection are those of the file's era
+        latlon_csv_path = grid_era(self.latlon_csv_path, pd.Timestamp(rtime))
+        latvec, lonvec = self.grid_axes(latlon_csv_path)
+        if (ds.sizes['dimy'], ds.sizes['dimx']) != (len(latvec), len(lonvec)):
+            raise Exception(f"Invalid value for 'latlon_csv_path'. {latlon_csv_path} describes a {len(latvec)} x "
+                            f"{len(lonvec)} grid but {filepath} is {ds.sizes['dimy']} x {ds.sizes['dimx']}; "
+                            f"give one CSV per grid era.")
 
         ds = ds.rename_dims(dimx="longitude", dimy="latitude")
         ds = ds.assign_coords(longitude=("longitude", lonvec), latitude=("latitude", latvec))
 
         rain = ds['qpe_grid']
-        rain = rain.metpy.convert_units('m')
-        rain.rio.write_crs(self.crs, inplace=True)
+        if dtype is None:
+            rain = rain.metpy.convert_units('m')
+        else:
+            factor = np.asarray(units(rain.attrs['units']).to('m').magnitude, dtype=dtype)
+            rain = (rain.astype(dtype, copy=False) * factor).assign_attrs(rain.attrs, units='m')
+        rain.rio.write_crs(grid_era(self.crs, pd.Timestamp(rtime)), inplace=True)
 
         # Set nodata value explicitly
         rain.rio.set_nodata(3.4028234663852886e+38, inplace=True)
 
-        rain_lonlat = rain.rio.reproject("EPSG:4326")
-
-        hour = filepath[-7:-5]
-        day = filepath[-10:-8]
-        month = filepath[-12:-10]
-        year = filepath[-16:-12]
-
-        date = f"{year}-{month}-{day}T{hour}:00"
-        
-        # Convert to nanosecond precision
-        rtime = np.datetime64(date, 'ns')
+        with instrumentation.stage('qpe_reproject'):
+            rain_lonlat = rain.rio.reproject("EPSG:4326")
 
         rain_lonlat = rain_lonlat.assign_coords({"time": rtime})
 
         return rain_lonlat
 
-    def process_dir_CNRFC_AWI_WY(self, filepath, min_lon, max_lon, min_lat, max_lat, year, WY):
-        filenames = sorted(glob.glob(filepath))
+    def iter_rain(self, index, year, fill='skip', dtype=None):
+        '''
+        Yields (step, rain) for each step of a QPEFileIndex, with rain on the reprojected EPSG:4326 grid.
+        Missing steps are zero-filled or interpolated from the neighbouring files depending on fill;
+        the two most recent decoded files are kept so interpolation does not decode them twice.
+        dtype is passed to process_file_CNRFC.
+        '''
+        decoded = {}
+
+        def decode(path):
+            if path not in decoded:
+                if len(decoded) >= 2:
+                    decoded.pop(next(iter(decoded)))
+                decoded[path] = self.process_file_CNRFC(path, year, dtype)
+            return decoded[path]
 
-        rain = self.process_file_CNRFC(filenames[1], year)
-        rain = rain.where(rain < 1.0e38)
-        rain = rain.rio.write_crs(4326)
-        rain = rain.rio.clip_box(minx=min_lon, miny=min_lat, maxx=max_lon, maxy=max_lat)
+        template = None
+        for step in index.iter_steps(fill=fill):
+            if step.kind == 'file':
+                rain = decode(step.path)
+                template = rain
+            elif step.kind == 'zero':
+                if template is None:
+                    template = decode(index.paths[0])
+                rain = xr.zeros_like(template)
+            else:
+                before, after, weight = step.neighbors
+                rain = decode(before) * (1 - weight) + decode(after) * weight
+            rain = rain.assign_coords({"time": np.datetime64(step.time, 'ns')})
+            yield step, rain
 
-        rainPrism = xr.DataArray()
-        AWI_prism = xr.DataArray()
-        AWI_old = xr.zeros_like(rain)
-        AWI_old[:] = -0.18
-        dt_hrs = 6.0
+    @instrumented('awi_water_year')
+    def process_dir_CNRFC_AWI_WY(self, filepath, min_lon, max_lon, min_lat, max_lat, year, WY, fill='skip'):
+        '''
+        Runs the AWI recurrence over a water year of QPE files and writes the rain and AWI prisms.
+                Parameters:
+                        filepath (str or QPEFileIndex): Glob pattern of the QPE files, or a prebuilt index
+                        min_lon, max_lon, min_lat, max_lat (float): Clip box
+                        year (int): Unused, kept for compatibility
+                        WY (str): Water year used in the output filenames
+                        fill (str): Gap handling, see QPEFileIndex.iter_steps; every step uses its true dt_hrs
+                Returns:
+                        rainPrism, AWI_prism (xarray DataArray): Prisms stacked along 'z'
+        '''
+        index = filepath if isinstance(filepath, QPEFileIndex) else QPEFileIndex.from_glob(filepath)
+        if len(index.gaps()) or len(index.duplicates):
+            print(f"QPE index: {len(index.gaps())} gaps, {len(index.duplicates)} duplicate files ignored")
 
-        for file in filenames:
+        rain_steps = []
+        AWI_steps = []
+        AWI_old = None
+
+        for step, rain in self.iter_rain(index, year, fill=fill):
+            file = step.path or f"{step.kind} fill {step.time}"
+            dt_hrs = step.dt_hrs
             print(f"Processing {file}", end='\r', flush=True)
-            rain = self.process_file_CNRFC(file, year)
             rain = rain.where(rain < 1.0e5)
             rain = rain.rio.write_crs(4326)
             try:
@@ -79,17 +172,23 @@ class RainfallProcessor:
                 print(f"Skipping file {file} due to insufficient data after clipping.")
                 continue
             
-            rainPrism = xr.concat([rainPrism, rain], 'z')
+            # Initial state at field capacity, shaped like the first clipped grid
+            if AWI_old is None:
+                AWI_old = xr.zeros_like(rain)
+                AWI_old[:] = -0.18
+
+            rain_steps.append(rain)
 
             AWI_new = self.AWI_run_step(AWI_old, rain, dt_hrs)
             AWI_new['time'] = rain['time']
-            AWI_prism = xr.concat([AWI_prism, AWI_new], 'z')
+            AWI_steps.append(AWI_new)
 
             AWI_old = AWI_new
             time.sleep(0.01)
 
-        rainPrism = rainPrism.rename({'x': 'longitude', 'y': 'latitude'})
-        AWI_prism = AWI_prism.rename({'x': 'longitude', 'y': 'latitude'})
+        # One concat per prism, so the first z slice is the first step; unnamed, as the readers expect
+        rainPrism = xr.concat(rain_steps, 'z').rename({'x': 'longitude', 'y': 'latitude'}).rename(None)
+        AWI_prism = xr.concat(AWI_steps, 'z').rename({'x': 'longitude', 'y': 'latitude'}).rename(None)
 
         outfile1 = os.path.join(self.output_dir, f"rain_prism_{WY}.nc")
         outfile2 = os.path.join(self.output_dir, f"AWI_prism_{WY}.nc")
@@ -100,8 +199,11 @@ class RainfallProcessor:
         if os.path.exists(outfile2):
             os.remove(outfile2)
 
-        rainPrism.to_netcdf(outfile1)
-        AWI_prism.to_netcdf(outfile2)
+        with instrumentation.stage('awi_write', WY=str(WY)):
+            rainPrism.to_netcdf(outfile1)
+            AWI_prism.to_netcdf(outfile2)
+            instrumentation.wrote_file(outfile1)
+            instrumentation.wrote_file(outfile2)
 
         print("\nFiles exported")
         
@@ -112,6 +214,212 @@ class RainfallProcessor:
 
         return rainPrism, AWI_prism
 
+    @instrumented('awi_water_year_memmap')
+    def process_dir_CNRFC_AWI_WY_memmap(self, filepath, min_lon, max_lon, min_lat, max_lat, year, WY, fill='skip'):
+        '''
+        Low-memory version of process_dir_CNRFC_AWI_WY. Files are decoded in float32, rain is masked in place
+        inside a memory-mapped scratch array on disk, and the AWI recurrence reads and writes through a second
+        mapping, so only one decoded grid is held in memory at a time. The NetCDF outputs have the same layout
+        as process_dir_CNRFC_AWI_WY (one z slice per step, time along z, EPSG:4326 spatial_ref) in float32;
+        the rain_prism_{WY}.f32 and AWI_prism_{WY}.f32 scratch files are removed once they are written.
+        The prisms are on the clipped grid of the first file; files of a later grid era (see grid_era) whose
+        clipped grid differs are interpolated onto it rather than dropped.
+                Parameters:
+                        Same as process_dir_CNRFC_AWI_WY
+                Returns:
+                        rainPrism, AWI_prism (xarray DataArray): float32 prisms (z, latitude, longitude), read
+                                                                 lazily from the written NetCDF files
+        '''
+        index = filepath if isinstance(filepath, QPEFileIndex) else QPEFileIndex.from_glob(filepath)
+        steps = list(index.iter_steps(fill=fill))
+
+        def clip(rain):
+            clipped = rain.rio.write_crs(4326).rio.clip_box(minx=min_lon, miny=min_lat, maxx=max_lon, maxy=max_lat)
+            x_idx = np.nonzero(np.isin(rain['x'].values, clipped['x'].values))[0]
+            y_idx = np.nonzero(np.isin(rain['y'].values, clipped['y'].values))[0]
+            return clipped, (slice(y_idx[0], y_idx[-1] + 1), slice(x_idx[0], x_idx[-1] + 1))
+
+        # The prisms are on the clipped grid of the first file. The clip window is found once per reprojected
+        # grid; files of a later grid era whose clipped grid differs are interpolated onto the first one
+        rain = self.process_file_CNRFC(index.paths[0], year, 'float32')
+        clipped, window = clip(rain)
+        lons, lats = clipped['x'].values, clipped['y'].values
+        shape = (len(steps), len(lats), len(lons))
+        if shape[1] <= 1 or shape[2] <= 1:
+            raise ValueError("Clip box leaves insufficient data.")
+        windows = {(rain['x'].values.tobytes(), rain['y'].values.tobytes()): window}
+
+        def clipped_values(rain):
+            key = (rain['x'].values.tobytes(), rain['y'].values.tobytes())
+            if key not in windows:
+                era_clipped, era_window = clip(rain)
+                same_grid = np.array_equal(era_clipped['x'].values, lons) and np.array_equal(era_clipped['y'].values, lats)
+                if not same_grid:
+                    print(f"\nGrid change at {rain['time'].values}: interpolating onto the first file's grid")
+                windows[key] = era_window if same_grid else None
+            if windows[key] is None:
+                return rain.where(rain < 1.0e5).interp(x=lons, y=lats).values
+            return rain.values[windows[key]]
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        rain_path = os.path.join(self.output_dir, f"rain_prism_{WY}.f32")
+        awi_path = os.path.join(self.output_dir, f"AWI_prism_{WY}.f32")
+        rain_mm = np.memmap(rain_path, dtype='float32', mode='w+', shape=shape)
+        awi_mm = np.memmap(awi_path, dtype='float32', mode='w+', shape=shape)
+
+        AWI_old = np.full(shape[1:], -0.18, dtype='float32')
+        times = []
+        step = 0
+
+        for qpe_step, rain in self.iter_rain(index, year, fill=fill, dtype='float32'):
+            file = qpe_step.path or f"{qpe_step.kind} fill {qpe_step.time}"
+            print(f"Processing {file}", end='\r', flush=True)
+            values = clipped_values(rain)
+
+            # Convert and mask in place in the mapped slot
+            slot = rain_mm[step]
+            slot[...] = values
+            slot[~(slot < 1.0e5)] = np.nan
+
+            self.AWI_run_step_inplace(AWI_old, slot, qpe_step.dt_hrs, out=awi_mm[step])
+            AWI_old = awi_mm[step]
+            times.append(rain['time'].values)
+            step += 1
+
+        rain_mm.flush()
+        awi_mm.flush()
+
+        coords = {
+            'time': ('z', np.array(times, dtype='datetime64[ns]')),
+            'latitude': lats,
+            'longitude': lons,
+        }
+        rainPrism = xr.DataArray(rain_mm[:step], coords=coords, dims=('z', 'latitude', 'longitude')).rio.write_crs(4326)
+        AWI_prism = xr.DataArray(awi_mm[:step], coords=coords, dims=('z', 'latitude', 'longitude')).rio.write_crs(4326)
+        # spatial_ref stays a coordinate, as in the dense AWI prism; with a grid_mapping link it would be written
+        # as a second data variable and open_dataarray could not read the files
+        for prism in (rainPrism, AWI_prism):
+            prism.encoding.pop('grid_mapping', None)
+
+        outfile1 = os.path.join(self.output_dir, f"rain_prism_{WY}.nc")
+        outfile2 = os.path.join(self.output_dir, f"AWI_prism_{WY}.nc")
+        for outfile in (outfile1, outfile2):
+            if os.path.exists(outfile):
+                os.remove(outfile)
+        with instrumentation.stage('awi_write', WY=str(WY)):
+            rainPrism.to_netcdf(outfile1)
+            AWI_prism.to_netcdf(outfile2)
+            instrumentation.wrote_file(outfile1)
+            instrumentation.wrote_file(outfile2)
+
+        # Drop every view of the mappings before removing the scratch files (required on Windows)
+        rainPrism = AWI_prism = rain_mm = awi_mm = slot = AWI_old = None
+        os.remove(rain_path)
+        os.remove(awi_path)
+
+        print("\nFiles exported")
+        print(f"The file {outfile2} contains {step} time steps.")
+
+        return xr.open_dataarray(outfile1), xr.open_dataarray(outfile2)
+
+    @instrumented('awi_water_year_regions')
+    def process_dir_CNRFC_AWI_regions(self, filepath, regions, year, WY, fill='skip'):
+        '''
+        Runs the AWI recurrence for several regions in one pass over the QPE files. Each file is decoded and
+        reprojected once and the grid is fanned out to a per-region AWI state.
+                Parameters:
+                        filepath (str or QPEFileIndex): Glob pattern of the QPE files, or a prebuilt index
+                        regions (dict): Region name -> (min_lon, max_lon, min_lat, max_lat) or a shapely polygon
+                                        in EPSG:4326; cells outside a polygon are set to nan
+                        year (int): Unused, kept for compatibility
+                        WY (str): Water year used in the output filenames
+                        fill (str): Gap handling, see QPEFileIndex.iter_steps
+                Returns:
+                        prisms (dict): Region name -> (rainPrism, AWI_prism), also written as
+                                       rain_prism_{WY}_{name}.nc and AWI_prism_{WY}_{name}.nc
+        '''
+        import shapely
+
+        index = filepath if isinstance(filepath, QPEFileIndex) else QPEFileIndex.from_glob(filepath)
+        windows = None
+        states = {name: {'rain': [], 'awi': [], 'old': None} for name in regions}
+
+        for step, rain in self.iter_rain(index, year, fill=fill):
+            print(f"Processing {step.path or step.time}", end='\r', flush=True)
+            rain = rain.where(rain < 1.0e5)
+
+            # Index windows and polygon masks are computed once from the first grid
+            if windows is None:
+                windows = {}
+                lons = rain['x'].values
+                lats = rain['y'].values
+                for name, region in regions.items():
+                    if isinstance(region, (tuple, list)):
+                        min_lon, max_lon, min_lat, max_lat = region
+                        geometry = None
+                    else:
+                        geometry = region
+                        min_lon, min_lat, max_lon, max_lat = region.bounds
+                    x_idx = np.nonzero((lons >= min_lon) & (lons <= max_lon))[0]
+                    y_idx = np.nonzero((lats >= min_lat) & (lats <= max_lat))[0]
+                    if x_idx.size <= 1 or y_idx.size <= 1:
+                        raise ValueError(f"Region '{name}' leaves insufficient data after clipping.")
+                    inside = None
+                    if geometry is not None:
+                        lon_grid, lat_grid = np.meshgrid(lons[x_idx], lats[y_idx])
+                        # Cells on the boundary count as inside, as in astar_regions
+                        inside = xr.DataArray(shapely.intersects_xy(geometry, lon_grid, lat_grid), dims=('y', 'x'))
+                    windows[name] = (slice(y_idx[0], y_idx[-1] + 1), slice(x_idx[0], x_idx[-1] + 1), inside)
+
+            for name, (y_window, x_window, inside) in windows.items():
+                state = states[name]
+                region_rain = rain.isel(y=y_window, x=x_window)
+                if inside is not None:
+                    region_rain = region_rain.where(inside)
+                if state['old'] is None:
+                    state['old'] = xr.zeros_like(region_rain)
+                    state['old'][:] = -0.18
+                AWI_new = self.AWI_run_step(state['old'], region_rain, step.dt_hrs)
+                AWI_new['time'] = region_rain['time']
+                state['rain'].append(region_rain)
+                state['awi'].append(AWI_new)
+                state['old'] = AWI_new
+
+        prisms = {}
+        for name, state in states.items():
+            # Unnamed, as in process_dir_CNRFC_AWI_WY, so the readers find __xarray_dataarray_variable__
+            rainPrism = xr.concat(state['rain'], 'z').rename({'x': 'longitude', 'y': 'latitude'}).rename(None)
+            AWI_prism = xr.concat(state['awi'], 'z').rename({'x': 'longitude', 'y': 'latitude'}).rename(None)
+            outfile1 = os.path.join(self.output_dir, f"rain_prism_{WY}_{name}.nc")
+            outfile2 = os.path.join(self.output_dir, f"AWI_prism_{WY}_{name}.nc")
+            for outfile in (outfile1, outfile2):
+                if os.path.exists(outfile):
+                    os.remove(outfile)
+            with instrumentation.stage('awi_write', WY=str(WY), region=name):
+                rainPrism.to_netcdf(outfile1)
+                AWI_prism.to_netcdf(outfile2)
+                instrumentation.wrote_file(outfile1)
+                instrumentation.wrote_file(outfile2)
+            prisms[name] = (rainPrism, AWI_prism)
+
+        print(f"\nFiles exported for {len(prisms)} regions")
+        return prisms
+
+    def AWI_run_step_inplace(self, AWI_t_minus_dt, rain_m, dt_hrs, out):
+        '''
+        float32 numpy version of AWI_run_step that writes into out without temporaries the size of the grid
+        beyond one boolean mask.
+        '''
+        kd = 0.01  # Drainage proportionality constant from Godt et al., 2006; [1/hrs]
+        decay = np.float32(np.exp(-kd*dt_hrs))
+        gain = np.float32((1.-np.exp(-kd*dt_hrs))/(kd*dt_hrs))
+
+        wet = AWI_t_minus_dt > 0.
+        np.add(AWI_t_minus_dt, rain_m, out=out)
+        out[wet] = AWI_t_minus_dt[wet]*decay + rain_m[wet]*gain
+        return out
+
+    @instrumented('awi_step')
     def AWI_run_step(self, AWI_t_minus_dt, rain_m, dt_hrs):
         kd = 0.01  # Drainage proportionality constant from Godt et al., 2006; [1/hrs]
         Ii_m_hr = rain_m / dt_hrs
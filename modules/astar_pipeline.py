@@ -0,0 +1,356 @@
+'''
+Batch runner for the A* workflow: download -> RainfallProcessor -> A* -> region extraction.
+
+Example usage, from the project root:
+    python -m modules.astar_pipeline astar_config.yml
+    python -m modules.astar_pipeline astar_config.yml --workers 4 --force regions
+
+Example config (YAML or JSON):
+    threshold: 1.1
+    field_capacity: 0.18
+    bounds: [-125, -113, 32, 43]      # min_lon, max_lon, min_lat, max_lat
+    low_memory: false                 # float32 memory-mapped AWI run
+    region_store: region_store        # optional, regions of every storm are appended here
+    regrid_cache: .regrid_cache       # optional, sparse recurrence -> QPE remap weights (see modules/regrid.py)
+    latlon_csv: astar_needed_DoNotTouch/QPE_latlons_new.csv   # optional, or {first valid time: CSV} per grid era
+    water_years:
+      - WY: 2023
+        months: [10, 11, 12, 1, 2, 3]  # optional, defaults to the whole water year
+        storms:
+          - [2023-01-01, 2023-03-30]
+      - WY: 2019
+        storms:
+          - [2019-02-01, 2019-02-28]
+    opera:                            # optional, DIST-ALERT time and area cubes for the same storms
+      output_dir: OPERA_Exports
+      granule_table: OPERA_Exports/granules   # optional, looks up hrefs of granules given by id only
+      anom_threshold: 0
+      step: 3
+      granules:
+        - id: OPERA_L3_DIST-ALERT-HLS_T10SGD_20230328T183909Z_20230404T003620Z_S2B_30_v1
+          hrefs:                      # optional with granule_table
+            VEG-ANOM-MAX: https://.../OPERA_L3_DIST-ALERT-HLS_..._VEG-ANOM-MAX.tif
+            VEG-DIST-DATE: https://.../OPERA_L3_DIST-ALERT-HLS_..._VEG-DIST-DATE.tif
+            VEG-DIST-STATUS: https://.../OPERA_L3_DIST-ALERT-HLS_..._VEG-DIST-STATUS.tif
+          windows:
+            - [2023-01-01, 2023-03-30]
+
+Independent water years run in parallel. Each stage is memoized by a content hash of its parameters,
+input files and upstream stages (see modules/task_graph.py), so changing only the threshold reruns only
+region extraction; --force reruns the named stages. With region_store set, every storm's regions are added
+to that RegionStore (see modules/region_store.py) once all water years finish. With an opera section, each
+granule is stacked once ('stack') and a time and area cube is built per date window ('area'); the hrefs and
+windows are task parameters, so a new granule or window reruns only its own tasks.
+'''
+# Library Imports
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from modules.download_unzip import download_and_unzip_qpe
+from modules.RainfallProcessor import HRAP_PROJ4, RainfallProcessor
+from modules.figure_and_boundingboxes import astar_regions
+from modules.regrid import Regridder
+from modules.task_graph import TaskGraph
+from modules.region_store import RegionStore
+
+STAGES = ['download', 'awi', 'astar', 'regions', 'stack', 'area']
+WATER_YEAR_MONTHS = [10, 11, 12, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+
+def load_config(path):
+    '''
+    Returns the run configuration from a YAML or JSON file, with defaults filled in.
+    '''
+    with open(path) as f:
+        if path.endswith(('.yml', '.yaml')):
+            import yaml
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+
+    project_root = os.path.abspath(config.get('project_root', os.getcwd()))
+    config.setdefault('project_root', project_root)
+    config.setdefault('threshold', 1.1)
+    config.setdefault('field_capacity', 0.18)
+    config.setdefault('bounds', [-125, -113, 32, 43])
+    config.setdefault('low_memory', False)
+    config.setdefault('region_store', None)
+    config.setdefault('regrid_cache', os.path.join(project_root, '.regrid_cache'))
+    config.setdefault('latlon_csv', os.path.join(project_root, 'astar_needed_DoNotTouch', 'QPE_latlons_new.csv'))
+    config.setdefault('recurrence', os.path.join(project_root, 'astar_needed_DoNotTouch', 'AWI_15yr_evd_smooth.nc'))
+    for entry in config['water_years']:
+        entry['WY'] = str(entry['WY'])
+        entry.setdefault('months', WATER_YEAR_MONTHS)
+        entry.setdefault('storms', [])
+    opera = config.setdefault('opera', None)
+    if opera:
+        opera.setdefault('output_dir', os.path.join(project_root, 'OPERA_Exports'))
+        opera.setdefault('granule_table', None)
+        opera.setdefault('anom_threshold', 0)
+        opera.setdefault('pixel_area', 30 * 30)
+        opera.setdefault('step', 3)
+        for granule in opera['granules']:
+            granule.setdefault('hrefs', None)
+            granule['windows'] = [[str(start), str(end)] for start, end in granule.get('windows', [])]
+    return config
+
+def water_year_paths(config, WY):
+    year_dir = os.path.join(config['project_root'], f'wy{WY}_astar')
+    output_dir = os.path.join(year_dir, 'processing_results')
+    return {
+        'data_dir': os.path.join(year_dir, 'wy_data'),
+        'output_dir': output_dir,
+        'awi': os.path.join(output_dir, f'AWI_prism_{WY}.nc'),
+        'rain': os.path.join(output_dir, f'rain_prism_{WY}.nc'),
+        'astar': os.path.join(output_dir, f'Astar_prism_{WY}.nc'),
+    }
+
+def compute_astar(awi_path, recurrence_path, field_capacity, weights_dir=None):
+    '''
+    Returns A* for a water year: (AWI + field capacity) divided by the recurrence grid interpolated to the AWI grid.
+    The bilinear weights are cached in weights_dir, so later years on the same clip box reuse them.
+    '''
+    a_prime = xr.open_dataset(awi_path).fillna(0)
+    a_prime = a_prime['__xarray_dataarray_variable__'].rename('AWI') + field_capacity
+    awi_15yr = xr.open_dataset(recurrence_path)['tp']
+    awi_15yr = Regridder.from_dataarrays(awi_15yr, a_prime.isel(z=0), cache_dir=weights_dir)(awi_15yr)
+    return (a_prime / awi_15yr).rename('astar')
+
+def download_month(year, month, WY, project_root):
+    return download_and_unzip_qpe(year, month, WY, project_root=project_root, skip_existing=True)
+
+def run_awi(data_dir, output_dir, latlon_csv, bounds, WY, low_memory=False):
+    processor = RainfallProcessor(latlon_csv_path=latlon_csv, crs_proj4=HRAP_PROJ4, output_dir=output_dir)
+    min_lon, max_lon, min_lat, max_lat = bounds
+    process = processor.process_dir_CNRFC_AWI_WY_memmap if low_memory else processor.process_dir_CNRFC_AWI_WY
+    process(os.path.join(data_dir, '*.nc'), min_lon, max_lon, min_lat, max_lat, None, WY)
+    return [os.path.join(output_dir, f'AWI_prism_{WY}.nc'), os.path.join(output_dir, f'rain_prism_{WY}.nc')]
+
+def write_astar(awi_path, recurrence_path, field_capacity, output_path, weights_dir=None):
+    astar = compute_astar(awi_path, recurrence_path, field_capacity, weights_dir)
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    astar.to_netcdf(output_path)
+    return output_path
+
+def extract_regions(astar_path, storm_begin, storm_end, threshold, storm_dir):
+    astar = xr.open_dataarray(astar_path).load()
+    regions, _ = astar_regions(astar, np.datetime64(storm_begin), np.datetime64(storm_end), threshold)
+    os.makedirs(storm_dir, exist_ok=True)
+    # As in fig_boundingboxes: the CSV is sorted by area, the polygons keep their contour order
+    bbox = regions.sort_values(by='area', ascending=False)[['min_lon', 'min_lat', 'max_lon', 'max_lat']]
+    bbox.to_csv(os.path.join(storm_dir, 'bounding_box_coords.csv'), index=False)
+    regions.drop(columns=['exceedance']).to_file(os.path.join(storm_dir, 'polygons.geojson'), driver='GeoJSON')
+    regions.to_parquet(os.path.join(storm_dir, 'regions.parquet'))
+    return len(regions)
+
+def build_graph(config, entry):
+    '''
+    Returns the task graph for one water year: download per month -> awi -> astar -> regions per storm.
+    '''
+    WY = entry['WY']
+    paths = water_year_paths(config, WY)
+    os.makedirs(paths['output_dir'], exist_ok=True)
+    graph = TaskGraph(cache_dir=os.path.join(paths['output_dir'], '.task_cache'))
+
+    # Downloads always run; files already on disk are skipped individually
+    downloads = []
+    for month in entry['months']:
+        year = int(WY) - 1 if month >= 10 else int(WY)
+        downloads.append(f'download_{month:02d}')
+        graph.add(downloads[-1], download_month, params={'year': year, 'month': month, 'WY': WY,
+                                                          'project_root': config['project_root']}, cache=False)
+
+    graph.add('awi', run_awi,
+              params={'data_dir': paths['data_dir'], 'output_dir': paths['output_dir'],
+                      'latlon_csv': config['latlon_csv'], 'bounds': config['bounds'], 'WY': WY,
+                      'low_memory': config['low_memory']},
+              inputs=[os.path.join(paths['data_dir'], '*.nc')], outputs=[paths['awi'], paths['rain']], deps=downloads)
+    graph.add('astar', write_astar,
+              params={'awi_path': paths['awi'], 'recurrence_path': config['recurrence'],
+                      'field_capacity': config['field_capacity'], 'output_path': paths['astar'],
+                      'weights_dir': config['regrid_cache']},
+              inputs=[paths['awi'], config['recurrence']], outputs=[paths['astar']], deps=['awi'])
+    for storm_begin, storm_end in entry['storms']:
+        storm_begin, storm_end = str(storm_begin), str(storm_end)
+        storm_dir = os.path.join(paths['output_dir'], f'storm_{storm_begin}_{storm_end}')
+        graph.add(f'regions_{storm_begin}_{storm_end}', extract_regions,
+                  params={'astar_path': paths['astar'], 'storm_begin': storm_begin, 'storm_end': storm_end,
+                          'threshold': config['threshold'], 'storm_dir': storm_dir},
+                  inputs=[paths['astar']], deps=['astar'],
+                  outputs=[os.path.join(storm_dir, 'polygons.geojson'), os.path.join(storm_dir, 'regions.parquet')])
+    return graph
+
+def granule_items(opera):
+    '''
+    Returns the STAC item dict of every configured granule, from its hrefs or else from the granule table.
+    '''
+    items = {}
+    missing = [granule['id'] for granule in opera['granules'] if not granule['hrefs']]
+    if missing:
+        if not opera['granule_table']:
+            raise Exception(f"Invalid value for 'opera'. Granules without hrefs need a granule_table: {missing}")
+        from modules.granule_table import GranuleTable, stac_item
+        table = GranuleTable(opera['granule_table']).table.set_index('granule_id', drop=False)
+        unknown = [granule_id for granule_id in missing if granule_id not in table.index]
+        if unknown:
+            raise Exception(f"Invalid value for 'opera'. Granules not in the granule table: {unknown}")
+        items.update({granule_id: stac_item(table.loc[granule_id]) for granule_id in missing})
+    for granule in opera['granules']:
+        if granule['hrefs']:
+            items[granule['id']] = {'id': granule['id'],
+                                    'assets': {band: {'href': href} for band, href in granule['hrefs'].items()}}
+    return items
+
+def stack_granule(stac_item, bands, output_path):
+    '''
+    Writes the stacked DIST-ALERT bands of a granule to NetCDF and returns its path and CRS.
+    '''
+    from modules.stack_bands import stack_bands
+
+    cube, crs = stack_bands(stac_item, bands)
+    cube.attrs['crs'] = crs
+    tmp_path = output_path + '.tmp'
+    cube.to_netcdf(tmp_path)
+    os.replace(tmp_path, output_path)
+    return {'path': output_path, 'crs': crs}
+
+def area_cube(stack, start_date, end_date, anom_threshold, pixel_area, step, output_path):
+    '''
+    Writes the time and area cube of a stacked granule over a date window (see dist_utils.time_and_area_cube).
+    '''
+    from modules.dist_utils import DIST_REF_DATE, time_and_area_cube
+
+    with xr.open_dataset(stack['path']) as cube:
+        bands = cube['z'].load()
+    veg_anom_max, dist_date, dist_status = (bands.sel(band=band) for band in (1, 2, 3))
+    bounds = [0, dist_status.sizes['latitude'], 0, dist_status.sizes['longitude']]
+    starting_day = (pd.Timestamp(start_date) - DIST_REF_DATE).days
+    ending_day = (pd.Timestamp(end_date) - DIST_REF_DATE).days
+    areas = time_and_area_cube(dist_status, dist_date, veg_anom_max, anom_threshold, pixel_area, bounds,
+                               starting_day, ending_day, DIST_REF_DATE, step)
+    areas.attrs['crs'] = stack['crs']
+    tmp_path = output_path + '.tmp'
+    areas.to_netcdf(tmp_path)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+def build_opera_graph(config):
+    '''
+    Returns the task graph of the OPERA granules: stack per granule -> area cube per date window.
+    '''
+    from modules.dist_utils import DIST_BANDS
+
+    opera = config['opera']
+    os.makedirs(opera['output_dir'], exist_ok=True)
+    graph = TaskGraph(cache_dir=os.path.join(opera['output_dir'], '.task_cache'))
+    items = granule_items(opera)
+    for granule in opera['granules']:
+        granule_id = granule['id']
+        stack_path = os.path.join(opera['output_dir'], f'{granule_id}_stack.nc')
+        stack = graph.add(f'stack_{granule_id}', stack_granule,
+                          params={'stac_item': items[granule_id], 'bands': DIST_BANDS, 'output_path': stack_path},
+                          outputs=[stack_path])
+        for start_date, end_date in granule['windows']:
+            area_path = os.path.join(opera['output_dir'], f'{granule_id}_area_{start_date}_{end_date}.nc')
+            graph.add(f'area_{granule_id}_{start_date}_{end_date}', area_cube,
+                      params={'stack': stack, 'start_date': start_date, 'end_date': end_date,
+                              'anom_threshold': opera['anom_threshold'], 'pixel_area': opera['pixel_area'],
+                              'step': opera['step'], 'output_path': area_path},
+                      inputs=[stack_path], outputs=[area_path])
+    return graph
+
+def run_opera(config, force=()):
+    '''
+    Runs the OPERA stack and area tasks, skipping those whose cache key is unchanged.
+            Parameters:
+                    config (dict): Run configuration from load_config, with an 'opera' section
+                    force (list): Stages to rerun regardless of their cache ('stack', 'area')
+            Returns:
+                    summary (dict): Task name -> 'ran' or 'cached', and the area cube path per window
+    '''
+    graph = build_opera_graph(config)
+    forced = [name for name in graph.tasks if name.split('_')[0] in force]
+    results = graph.run(force=forced)
+    summary = {'opera': len(config['opera']['granules'])}
+    summary.update(graph.status)
+    summary['areas'] = {name: results[name] for name in graph.tasks if name.startswith('area_')}
+    return summary
+
+def run_water_year(config, entry, force=()):
+    '''
+    Runs every stage for one water year, skipping stages whose cache key is unchanged.
+            Parameters:
+                    config (dict): Run configuration from load_config
+                    entry (dict): Water year entry with 'WY', 'months' and 'storms'
+                    force (list): Stages to rerun regardless of their cache ('download', 'awi', 'astar', 'regions')
+            Returns:
+                    summary (dict): Task name -> 'ran' or 'cached', the file counts per download month
+                                    and the region count per storm
+    '''
+    graph = build_graph(config, entry)
+    forced = [name for name in graph.tasks if name.split('_')[0] in force]
+    results = graph.run(force=forced)
+    summary = {'WY': entry['WY']}
+    summary.update(graph.status)
+    # Downloads always run; a month is 'cached' when every file was already on disk or known missing
+    downloads = {name: results[name] for name in graph.tasks if name.startswith('download_')}
+    for name, counts in downloads.items():
+        summary[name] = 'ran' if counts['downloaded'] else 'cached'
+    summary['downloads'] = downloads
+    summary['regions'] = {name: results[name] for name in graph.tasks if name.startswith('regions_')}
+    return summary
+
+def store_regions(config):
+    '''
+    Appends every configured storm's regions to the region store; reruns replace the earlier entries.
+    '''
+    import geopandas as gpd
+
+    with RegionStore(config['region_store']) as store:
+        for entry in config['water_years']:
+            output_dir = water_year_paths(config, entry['WY'])['output_dir']
+            for storm_begin, storm_end in entry['storms']:
+                storm_begin, storm_end = str(storm_begin), str(storm_end)
+                storm_dir = os.path.join(output_dir, f'storm_{storm_begin}_{storm_end}')
+                regions = gpd.read_parquet(os.path.join(storm_dir, 'regions.parquet'))
+                store.append(regions, storm_begin, storm_end, config['threshold'], WY=entry['WY'])
+
+def run(config, workers=None, force=()):
+    '''
+    Runs all configured water years, in parallel across years, then the OPERA tasks if configured.
+    '''
+    entries = config['water_years']
+    if workers == 1 or len(entries) == 1:
+        summaries = [run_water_year(config, entry, force) for entry in entries]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_water_year, config, entry, force) for entry in entries]
+            summaries = [future.result() for future in futures]
+    # The store is written from this process only, so parallel years never race on its index
+    if config['region_store']:
+        store_regions(config)
+    if config['opera']:
+        summaries.append(run_opera(config, force))
+    return summaries
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the A* pipeline for a set of water years and storms.')
+    parser.add_argument('config', help='YAML or JSON run configuration')
+    parser.add_argument('--workers', type=int, default=None, help='Parallel water years (default: CPU count)')
+    parser.add_argument('--force', nargs='*', default=[], choices=STAGES, help='Stages to rerun')
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    for summary in run(config, workers=args.workers, force=args.force):
+        print(json.dumps(summary))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
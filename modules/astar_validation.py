@@ -0,0 +1,227 @@
+'''
+Scores A* thresholds against a dated landslide inventory over a storm catalog.
+
+Each storm (e.g. from modules/storm_catalog.py) is evaluated per grid cell: a cell is forecast positive
+when its storm maximum A* reaches the threshold and observed positive when the inventory has a landslide
+in it between the storm's first day and end + lag_days; a landslide inside several storm windows counts for
+the latest storm to begin before it. Counts for all thresholds come from one sort per storm, lead times from
+one vectorized comparison per landslide, and confidence intervals from a storm bootstrap split across worker
+processes.
+
+Example usage:
+    inventory = load_inventory('landslide_inventory.csv')
+    catalog = pd.read_csv('storm_catalog/storm_catalog.csv', parse_dates=['begin', 'end'], dtype={'WY': str})
+    scores = evaluate_thresholds(astar_paths, catalog, inventory, thresholds=np.arange(0.8, 1.6, 0.05))
+'''
+# Library Imports
+import numpy as np
+import pandas as pd
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor
+
+from modules.instrumentation import instrumented
+
+COUNT_COLUMNS = ['hits', 'misses', 'false_alarms', 'correct_negatives']
+
+def load_inventory(path, lat_col='lat', lon_col='lon', date_col='date'):
+    '''
+    Returns a landslide inventory with 'lat', 'lon' and 'date' columns from a CSV file.
+    '''
+    inventory = pd.read_csv(path)
+    inventory = inventory.rename(columns={lat_col: 'lat', lon_col: 'lon', date_col: 'date'})
+    inventory['date'] = pd.to_datetime(inventory['date'])
+    return inventory.dropna(subset=['lat', 'lon', 'date']).reset_index(drop=True)
+
+class GridIndex:
+    '''
+    KD-tree over the cell centres of an A* grid, mapping points to flat cell indices in one query.
+    '''
+    def __init__(self, lats, lons):
+        from scipy.spatial import cKDTree
+
+        self.shape = (len(lats), len(lons))
+        lon_grid, lat_grid = np.meshgrid(lons, lats)
+        self.tree = cKDTree(np.column_stack([lon_grid.ravel(), lat_grid.ravel()]))
+        # Points farther than one cell diagonal from any centre are outside the grid
+        self.max_distance = np.hypot(np.abs(np.diff(lons)).max(), np.abs(np.diff(lats)).max())
+
+    def cells(self, lats, lons):
+        '''
+        Returns the flat cell index of each point, -1 outside the grid.
+        '''
+        distance, cell = self.tree.query(np.column_stack([lons, lats]))
+        return np.where(distance <= self.max_distance, cell, -1)
+
+def storm_counts(storm_max, observed, thresholds):
+    '''
+    Returns a (len(thresholds), 4) array of hits, misses, false alarms and correct negatives for one storm.
+            Parameters:
+                    storm_max (numpy array): Storm maximum A* per cell (flat)
+                    observed (numpy array): True for cells with a landslide during the storm (flat)
+                    thresholds (numpy array): Thresholds to score
+    '''
+    valid = np.isfinite(storm_max)
+    positives = np.sort(storm_max[valid & observed])
+    negatives = np.sort(storm_max[valid & ~observed])
+    hits = positives.size - np.searchsorted(positives, thresholds, side='left')
+    false_alarms = negatives.size - np.searchsorted(negatives, thresholds, side='left')
+    return np.column_stack([hits, positives.size - hits, false_alarms, negatives.size - false_alarms])
+
+def lead_hours(series, times, event_dates, thresholds):
+    '''
+    Returns (landslides, thresholds) hours between the first A* exceedance before each landslide and the end of
+    its day (inventory dates have no time of day, so the landslide may have happened any time that day).
+    nan where the threshold was not reached before the landslide.
+            Parameters:
+                    series (numpy array): (landslides, timesteps) A* at each landslide's cell over its storm
+                    times (numpy array): Timesteps of series
+                    event_dates (numpy array): Landslide dates (the whole day counts)
+                    thresholds (numpy array): Thresholds to score
+    '''
+    day_end = event_dates.astype('datetime64[D]') + np.timedelta64(1, 'D')
+    before = times[None, :] < day_end[:, None]
+    reached = (series[:, None, :] >= thresholds[None, :, None]) & before[:, None, :]
+    first = reached.argmax(axis=2)
+    lead = (day_end[:, None] - times[first]) / np.timedelta64(1, 'h')
+    return np.where(reached.any(axis=2), lead, np.nan)
+
+def attribute_landslides(storms, inventory, lag_days):
+    '''
+    Returns the storm_id each landslide is attributed to (None if no storm), so a landslide inside overlapping
+    storm windows counts once: the latest storm beginning on or before its date whose window
+    [begin day, end + lag_days] contains it. Dates are compared by day, as inventory dates have no time of day.
+    '''
+    dates = inventory['date'].values.astype('datetime64[D]')
+    storm = np.full(len(inventory), None, dtype=object)
+    assigned = np.zeros(len(inventory), dtype=bool)
+    for row in storms.sort_values('begin', ascending=False).itertuples():
+        begin = np.datetime64(pd.Timestamp(row.begin), 'D')
+        stop = np.datetime64(pd.Timestamp(row.end) + pd.Timedelta(days=lag_days), 'D')
+        inside = ~assigned & (dates >= begin) & (dates <= stop)
+        storm[inside] = row.storm_id
+        assigned |= inside
+    return pd.Series(storm, index=inventory.index, name='storm')
+
+def evaluate_water_year(astar_path, storms, inventory, thresholds, lag_days):
+    '''
+    Returns per-storm counts (storms, thresholds, 4) and per-landslide lead times for one water year.
+    Landslides are matched by their 'storm' column (see attribute_landslides), computed here if absent.
+    '''
+    thresholds = np.asarray(thresholds, dtype='float64')
+    if 'storm' not in inventory:
+        inventory = inventory.assign(storm=attribute_landslides(storms, inventory, lag_days))
+    counts = np.zeros((len(storms), len(thresholds), 4), dtype='int64')
+    leads = []
+    with xr.open_dataarray(astar_path) as astar:
+        index = GridIndex(astar['latitude'].values, astar['longitude'].values)
+        cells = index.cells(inventory['lat'].values, inventory['lon'].values)
+        times = astar['time'].values
+        for s, storm in enumerate(storms.itertuples()):
+            begin = np.datetime64(pd.Timestamp(storm.begin))
+            end = np.datetime64(pd.Timestamp(storm.end))
+            stop = np.datetime64(pd.Timestamp(storm.end) + pd.Timedelta(days=lag_days))
+            window = np.nonzero((times >= begin) & (times <= stop))[0]
+            if window.size == 0:
+                continue
+            block = astar.isel(z=slice(window[0], window[-1] + 1)).values
+            storm_window = times[window[0]:window[-1] + 1] <= end
+            storm_max = np.nanmax(block[storm_window], axis=0).ravel() if storm_window.any() else np.full(block[0].size, np.nan)
+
+            dates = inventory['date'].values
+            matched = (inventory['storm'].values == storm.storm_id) & (cells >= 0)
+            observed = np.zeros(storm_max.size, dtype=bool)
+            observed[cells[matched]] = True
+            counts[s] = storm_counts(storm_max, observed, thresholds)
+
+            if matched.any():
+                flat = block.reshape(block.shape[0], -1)
+                series = flat[:, cells[matched]].T
+                lead = lead_hours(series, times[window[0]:window[-1] + 1], dates[matched], thresholds)
+                leads.append(pd.DataFrame(lead, columns=thresholds, index=inventory.index[matched]).assign(storm=storm.storm_id))
+    leads = pd.concat(leads) if leads else pd.DataFrame(columns=list(thresholds) + ['storm'])
+    return counts, leads
+
+def scores_from_counts(counts):
+    '''
+    Returns POD, FAR and POFD for (..., 4) count arrays.
+    '''
+    hits, misses, false_alarms, correct_negatives = np.moveaxis(counts.astype('float64'), -1, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {'pod': hits / (hits + misses), 'far': false_alarms / (hits + false_alarms),
+                'pofd': false_alarms / (false_alarms + correct_negatives)}
+
+def _bootstrap_chunk(counts, n_boot, seed):
+    '''
+    Returns the scores of n_boot storm resamples, (n_boot, thresholds) per score.
+    '''
+    rng = np.random.default_rng(seed)
+    n_storms = counts.shape[0]
+    weights = np.stack([np.bincount(rng.integers(0, n_storms, n_storms), minlength=n_storms) for _ in range(n_boot)])
+    resampled = np.tensordot(weights, counts, axes=(1, 0))
+    return scores_from_counts(resampled)
+
+def bootstrap_ci(counts, n_boot=1000, alpha=0.05, seed=0, max_workers=None, chunk=250):
+    '''
+    Returns lower and upper percentile bounds of each score from a storm bootstrap run in parallel chunks.
+    '''
+    sizes = [min(chunk, n_boot - start) for start in range(0, n_boot, chunk)]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        parts = list(pool.map(_bootstrap_chunk, [counts] * len(sizes), sizes, [seed + i for i in range(len(sizes))]))
+    bounds = {}
+    for score in parts[0]:
+        samples = np.concatenate([part[score] for part in parts])
+        bounds[f'{score}_lo'] = np.nanpercentile(samples, 100 * alpha / 2, axis=0)
+        bounds[f'{score}_hi'] = np.nanpercentile(samples, 100 * (1 - alpha / 2), axis=0)
+    return bounds
+
+@instrumented('astar_validation')
+def evaluate_thresholds(astar_paths, storms, inventory, thresholds, lag_days=7, n_boot=1000, alpha=0.05,
+                        max_workers=None):
+    '''
+    Scores A* thresholds against a landslide inventory over many storms and water years.
+            Parameters:
+                    astar_paths (dict): WY -> Astar_prism_{WY}.nc path
+                    storms (DataFrame): Storm catalog with 'WY', 'storm_id', 'begin' and 'end' columns
+                    inventory (DataFrame): Landslides with 'lat', 'lon' and 'date' (see load_inventory)
+                    thresholds (array): Thresholds to score
+                    lag_days (int): Days after a storm's end a landslide is still attributed to it
+                    n_boot (int): Bootstrap resamples of the storms (0 disables the intervals)
+                    alpha (float): Confidence intervals cover 1 - alpha
+                    max_workers (int): Worker processes (defaults to the CPU count)
+            Returns:
+                    scores (DataFrame): One row per threshold with counts, pod, far, pofd, their intervals and
+                                        the median and interquartile lead time in hours
+                    leads (DataFrame): Lead time per matched landslide (rows) and threshold (columns)
+    '''
+    thresholds = np.asarray(thresholds, dtype='float64')
+    storms = storms.copy()
+    storms['WY'] = storms['WY'].astype(str)
+    astar_paths = {str(WY): path for WY, path in astar_paths.items()}
+    years = [WY for WY in sorted(storms['WY'].unique()) if WY in astar_paths]
+    # Attributed over the whole catalog, so storms of adjacent water years do not both claim a landslide
+    inventory = inventory.assign(storm=attribute_landslides(storms[storms['WY'].isin(years)], inventory, lag_days))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(evaluate_water_year, astar_paths[WY], storms[storms['WY'] == WY], inventory,
+                               thresholds, lag_days) for WY in years]
+        results = [future.result() for future in futures]
+    if not results:
+        raise Exception("No storm matches the given A* files.")
+    counts = np.concatenate([result[0] for result in results])
+    leads = pd.concat([result[1] for result in results])
+
+    scores = pd.DataFrame(counts.sum(axis=0), columns=COUNT_COLUMNS)
+    scores.insert(0, 'threshold', thresholds)
+    for score, values in scores_from_counts(counts.sum(axis=0)).items():
+        scores[score] = values
+    if n_boot:
+        for column, values in bootstrap_ci(counts, n_boot, alpha, max_workers=max_workers).items():
+            scores[column] = values
+    lead_values = leads[list(thresholds)].to_numpy(dtype='float64') if len(leads) else np.full((0, len(thresholds)), np.nan)
+    with np.errstate(invalid='ignore'):
+        scores['lead_hours_median'] = np.nanmedian(lead_values, axis=0) if len(leads) else np.nan
+        scores['lead_hours_q25'] = np.nanpercentile(lead_values, 25, axis=0) if len(leads) else np.nan
+        scores['lead_hours_q75'] = np.nanpercentile(lead_values, 75, axis=0) if len(leads) else np.nan
+    scores['storms'] = counts.shape[0]
+    scores['landslides_matched'] = leads.index.nunique()
+    return scores, leads
@@ -0,0 +1,187 @@
+'''
+Builds the AWI recurrence climatology (the grid stored as astar_needed_DoNotTouch/AWI_15yr_evd_smooth.nc)
+from archived CNRFC QPE. Files before the Sep. 2020 grid change are decoded with the latlon CSV of their own
+grid era, and every year's maximum is then interpolated onto the grid of the reference water year.
+
+Example usage, as a scheduled batch job from the project root:
+    python -m modules.awi_climatology --water-years 2006-2023 --output AWI_15yr_evd_smooth.nc \
+        --latlon-csv 2005-10-01=QPE_latlons_old.csv 2020-09-01=QPE_latlons_new.csv --reference-wy 2023
+'''
+# Library Imports
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xarray as xr
+from scipy import ndimage
+
+from modules.RainfallProcessor import HRAP_PROJ4, RainfallProcessor
+from modules.instrumentation import instrumented
+
+EULER_GAMMA = 0.5772156649
+
+def water_year_max(WY, qpe_pattern, latlon_csv_path, work_dir, bounds, field_capacity=0.18, low_memory=True):
+    '''
+    Runs the AWI recurrence for one water year and writes its per-pixel maximum to disk.
+            Parameters:
+                    WY (str): Water year
+                    qpe_pattern (str): Glob pattern of the year's QPE files, with {WY} as a placeholder
+                    latlon_csv_path (str or dict): QPE_latlons CSV, or {first valid time: CSV} per grid era
+                    work_dir (str): Directory for the year's AWI prism and maximum grid
+                    bounds (tuple): min_lon, max_lon, min_lat, max_lat
+                    field_capacity (float): Added to AWI as in the A* workflow
+                    low_memory (bool): Use the float32 memory-mapped AWI run
+            Returns:
+                    max_path (str): Path of the AWI_annual_max_{WY}.nc file
+    '''
+    year_dir = os.path.join(work_dir, f'wy{WY}')
+    os.makedirs(year_dir, exist_ok=True)
+    max_path = os.path.join(work_dir, f'AWI_annual_max_{WY}.nc')
+    if os.path.exists(max_path):
+        return max_path
+
+    processor = RainfallProcessor(latlon_csv_path=latlon_csv_path, crs_proj4=HRAP_PROJ4, output_dir=year_dir)
+    min_lon, max_lon, min_lat, max_lat = bounds
+    process = processor.process_dir_CNRFC_AWI_WY_memmap if low_memory else processor.process_dir_CNRFC_AWI_WY
+    _, AWI_prism = process(
+        filepath=qpe_pattern.format(WY=WY), min_lon=min_lon, max_lon=max_lon,
+        min_lat=min_lat, max_lat=max_lat, year=None, WY=WY)
+
+    # Only the annual maximum is kept in memory once the prism is on disk
+    annual_max = (AWI_prism.max(dim='z', skipna=True) + field_capacity).rename('AWI_max')
+    annual_max = annual_max.drop_vars([c for c in annual_max.coords if c not in annual_max.dims])
+    annual_max = annual_max.expand_dims(WY=[int(WY)])
+    annual_max.to_netcdf(max_path)
+    return max_path
+
+def gumbel_return_level(annual_max, return_period):
+    '''
+    Returns the per-pixel return level of a Gumbel (EV1) fit by the method of moments.
+            Parameters:
+                    annual_max (numpy array): Annual maxima with years on axis 0
+                    return_period (float): Return period in years
+            Returns:
+                    level (numpy array): Return level grid
+    '''
+    mean = np.nanmean(annual_max, axis=0)
+    std = np.nanstd(annual_max, axis=0, ddof=1)
+    scale = std * np.sqrt(6.0) / np.pi
+    location = mean - EULER_GAMMA * scale
+    return location - scale * np.log(-np.log(1.0 - 1.0 / return_period))
+
+def smooth_nan(grid, sigma):
+    '''
+    Gaussian smoothing that ignores nan pixels (normalized convolution).
+    '''
+    valid = np.isfinite(grid)
+    filled = ndimage.gaussian_filter(np.where(valid, grid, 0.0), sigma)
+    weight = ndimage.gaussian_filter(valid.astype('float64'), sigma)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smoothed = filled / weight
+    return np.where(valid, smoothed, np.nan)
+
+@instrumented('awi_climatology')
+def build_awi_climatology(water_years, qpe_pattern, latlon_csv_path, work_dir, output_path,
+                          bounds=(-125, -113, 32, 43), return_period=15, sigma=1.0, field_capacity=0.18,
+                          max_workers=None, reference_WY=None):
+    '''
+    Builds the AWI recurrence climatology over many water years on the grid of one reference water year.
+    Each water year runs in its own worker process and streams its prism and annual maximum to disk;
+    the extreme value fit is then vectorized over all pixels.
+            Parameters:
+                    water_years (list): Water years to include (e.g., range(2006, 2024))
+                    qpe_pattern (str): Glob pattern of QPE files with {WY} (e.g., 'wy{WY}_astar/wy_data/*.nc')
+                    latlon_csv_path (str or dict): QPE_latlons CSV, or {first valid time: CSV} per grid era
+                    work_dir (str): Directory for per-year intermediate files (reused when rerun)
+                    output_path (str): Output NetCDF, variable 'tp' as in AWI_15yr_evd_smooth.nc
+                    bounds (tuple): min_lon, max_lon, min_lat, max_lat
+                    return_period (float): Return period in years
+                    sigma (float): Gaussian smoothing radius in pixels (0 disables)
+                    field_capacity (float): Added to AWI as in the A* workflow
+                    max_workers (int): Worker processes (defaults to the CPU count)
+                    reference_WY (int): Water year whose grid the climatology is on (defaults to the latest,
+                                        i.e. the current grid)
+            Returns:
+                    recurrence (xarray DataArray): Return level grid
+    '''
+    os.makedirs(work_dir, exist_ok=True)
+    water_years = [str(WY) for WY in water_years]
+    reference_WY = str(max(int(WY) for WY in water_years) if reference_WY is None else reference_WY)
+    if reference_WY not in water_years:
+        raise Exception(f"Invalid value for 'reference_WY'. It should be one of the water years, not {reference_WY}.")
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(water_year_max, WY, qpe_pattern, latlon_csv_path, work_dir, bounds, field_capacity)
+                   for WY in water_years]
+        max_paths = [future.result() for future in futures]
+
+    # Years before the Sep. 2020 projection shift sit on a different grid; bring them onto the reference one
+    maxima = [xr.open_dataarray(path).load() for path in max_paths]
+    reference = maxima[water_years.index(reference_WY)].isel(WY=0, drop=True)
+    aligned = []
+    for grid in maxima:
+        if grid.shape[1:] != reference.shape or not all(grid[dim].equals(reference[dim]) for dim in reference.dims):
+            grid = grid.interp_like(reference)
+        aligned.append(grid)
+    annual_max = xr.concat(aligned, dim='WY')
+    print(f"Fitting {return_period}-yr recurrence over {annual_max.sizes['WY']} water years")
+
+    level = gumbel_return_level(annual_max.values, return_period)
+    if sigma > 0:
+        level = smooth_nan(level, sigma)
+
+    recurrence = xr.DataArray(level, coords=reference.coords, dims=reference.dims, name='tp')
+    recurrence.attrs.update({'return_period_yr': return_period, 'distribution': 'gumbel',
+                             'water_years': f'{water_years[0]}-{water_years[-1]}', 'smoothing_sigma_px': sigma,
+                             'reference_water_year': int(reference_WY)})
+
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    recurrence.to_dataset().to_netcdf(output_path)
+    print(f"Climatology saved to {output_path}")
+    return recurrence
+
+def _parse_years(text):
+    if '-' in text:
+        first, last = text.split('-')
+        return list(range(int(first), int(last) + 1))
+    return [int(year) for year in text.split(',')]
+
+def _parse_latlon_csvs(values):
+    '''
+    Returns a single CSV path, or {first valid time: CSV} from 'START=PATH' arguments.
+    '''
+    if len(values) == 1 and '=' not in values[0]:
+        return values[0]
+    eras = {}
+    for value in values:
+        if '=' not in value:
+            raise Exception(f"Invalid value for '--latlon-csv'. Give one path or START=PATH per grid era, not {value}.")
+        start, path = value.split('=', 1)
+        eras[start] = path
+    return eras
+
+def main(argv=None):
+    project_root = os.getcwd()
+    parser = argparse.ArgumentParser(description='Build the AWI recurrence climatology from archived QPE.')
+    parser.add_argument('--water-years', required=True, help="Range '2006-2023' or list '2019,2021,2023'")
+    parser.add_argument('--qpe-pattern', default=os.path.join(project_root, 'wy{WY}_astar', 'wy_data', '*.nc'))
+    parser.add_argument('--latlon-csv', nargs='+',
+                        default=[os.path.join(project_root, 'astar_needed_DoNotTouch', 'QPE_latlons_new.csv')],
+                        help="One CSV, or START=PATH per grid era (e.g. 2005-10-01=old.csv 2020-09-01=new.csv)")
+    parser.add_argument('--work-dir', default=os.path.join(project_root, 'awi_climatology'))
+    parser.add_argument('--output', default=os.path.join(project_root, 'awi_climatology', 'AWI_15yr_evd_smooth.nc'))
+    parser.add_argument('--return-period', type=float, default=15)
+    parser.add_argument('--sigma', type=float, default=1.0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--reference-wy', type=int, default=None, help='Water year of the output grid (default: latest)')
+    args = parser.parse_args(argv)
+
+    build_awi_climatology(_parse_years(args.water_years), args.qpe_pattern, _parse_latlon_csvs(args.latlon_csv),
+                          args.work_dir, args.output, return_period=args.return_period, sigma=args.sigma,
+                          max_workers=args.workers, reference_WY=args.reference_wy)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
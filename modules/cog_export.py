@@ -0,0 +1,159 @@
+'''
+Cloud-Optimized GeoTIFF export of AWI, A* and storm-maximum grids.
+
+Grids are written tiled and compressed with internal overviews, either one COG per timestep or one
+multiband COG per prism (band descriptions hold the timestamps). Timesteps are written in parallel
+worker processes that each read their own slice from the NetCDF file.
+
+Example usage, from the project root:
+    python -m modules.cog_export wy2023_astar/processing_results/Astar_prism_2023.nc --output-dir cogs
+    python -m modules.cog_export wy2023_astar/processing_results/Astar_prism_2023.nc --mode stack
+'''
+# Library Imports
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from modules.instrumentation import instrumentation, instrumented
+
+COG_OPTIONS = {'BLOCKSIZE': 256, 'COMPRESS': 'DEFLATE', 'PREDICTOR': 3, 'OVERVIEWS': 'AUTO',
+               'OVERVIEW_RESAMPLING': 'AVERAGE', 'BIGTIFF': 'IF_SAFER'}
+
+def grid_transform(lats, lons):
+    '''
+    Returns the north-up affine transform of a regular lat/lon grid of cell centres, and whether rows must be flipped.
+    '''
+    from rasterio.transform import from_origin
+
+    dx = abs(float(lons[1] - lons[0]))
+    dy = abs(float(lats[1] - lats[0]))
+    flip = lats[0] < lats[-1]
+    return from_origin(float(lons.min()) - dx / 2, float(lats.max()) + dy / 2, dx, dy), flip
+
+def write_cog(data, lats, lons, path, crs='EPSG:4326', descriptions=None, nodata=np.nan, **options):
+    '''
+    Writes a 2-D grid or a (bands, lat, lon) stack as a Cloud-Optimized GeoTIFF.
+            Parameters:
+                    data (numpy array): Grid or stack, rows along latitude
+                    lats, lons (array): Cell centre coordinates
+                    path (str): Output .tif path
+                    crs (str): CRS of the coordinates
+                    descriptions (list): Optional band descriptions (e.g. timestamps)
+                    nodata (float): Nodata value
+                    options: Overrides of COG_OPTIONS (e.g. COMPRESS='ZSTD', BLOCKSIZE=512)
+            Returns:
+                    path (str): Output path
+    '''
+    from rasterio.io import MemoryFile
+    from rasterio.shutil import copy as rio_copy
+
+    data = np.asarray(data, dtype='float32')
+    if data.ndim == 2:
+        data = data[None]
+    transform, flip = grid_transform(np.asarray(lats), np.asarray(lons))
+    if flip:
+        data = data[:, ::-1, :]
+    profile = {'driver': 'GTiff', 'count': data.shape[0], 'height': data.shape[1], 'width': data.shape[2],
+               'dtype': 'float32', 'crs': crs, 'transform': transform, 'nodata': nodata}
+    cog_options = dict(COG_OPTIONS, **options)
+
+    # The COG driver only creates by copy, so the grid is staged in memory first
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dst:
+            dst.write(data)
+            for band, description in enumerate(descriptions or [], start=1):
+                dst.set_band_description(band, str(description))
+        with memfile.open() as src:
+            tmp_path = path + '.tmp.tif'
+            rio_copy(src, tmp_path, driver='COG', **cog_options)
+    os.replace(tmp_path, path)
+    instrumentation.wrote_file(path)
+    return path
+
+def _write_timestep(nc_path, z, path, options):
+    with xr.open_dataarray(nc_path) as prism:
+        grid = prism.transpose('z', 'latitude', 'longitude').isel(z=z)
+        return write_cog(grid.values, prism['latitude'].values, prism['longitude'].values, path,
+                         descriptions=[pd.Timestamp(grid['time'].values).isoformat()], **options)
+
+@instrumented('cog_export')
+def export_prism(nc_path, output_dir, name=None, mode='timesteps', start=None, end=None, max_workers=None, **options):
+    '''
+    Exports an AWI or A* prism as COGs.
+            Parameters:
+                    nc_path (str): NetCDF prism with dims (z, latitude, longitude) and a 'time' coordinate
+                    output_dir (str): Output directory
+                    name (str): Filename prefix (defaults to the NetCDF basename)
+                    mode (str): 'timesteps' for one COG per timestep, 'stack' for one multiband COG
+                    start, end (str or datetime): Optional time window
+                    max_workers (int): Worker processes for 'timesteps' (defaults to the CPU count)
+                    options: Overrides of COG_OPTIONS
+            Returns:
+                    paths (list): Written files
+    '''
+    if mode not in ('timesteps', 'stack'):
+        raise Exception("Invalid value for 'mode'. It should be 'timesteps' or 'stack'.")
+    name = name or os.path.splitext(os.path.basename(nc_path))[0]
+    os.makedirs(output_dir, exist_ok=True)
+    with xr.open_dataarray(nc_path) as prism:
+        prism = prism.transpose('z', 'latitude', 'longitude')
+        times = pd.DatetimeIndex(prism['time'].values)
+        keep = np.ones(len(times), dtype=bool)
+        if start is not None:
+            keep &= times >= pd.Timestamp(start)
+        if end is not None:
+            keep &= times <= pd.Timestamp(end)
+        steps = np.nonzero(keep)[0]
+
+        if mode == 'stack':
+            path = os.path.join(output_dir, f'{name}.tif')
+            block = prism.isel(z=steps)
+            write_cog(block.values, prism['latitude'].values, prism['longitude'].values, path,
+                      descriptions=[time.isoformat() for time in times[steps]], **options)
+            return [path]
+
+    paths = [os.path.join(output_dir, f'{name}_{times[z]:%Y%m%dT%H%M}.tif') for z in steps]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_write_timestep, nc_path, int(z), path, options) for z, path in zip(steps, paths)]
+        return [future.result() for future in futures]
+
+@instrumented('cog_export_storm_max')
+def export_storm_max(astar, beginning_date, end_date, path, **options):
+    '''
+    Writes the maximum A* over a storm window as a COG.
+            Parameters:
+                    astar (xarray DataArray): A* prism with a 'time' coordinate along 'z'
+                    beginning_date, end_date (str or datetime64): Storm window
+                    path (str): Output .tif path
+            Returns:
+                    path (str): Output path
+    '''
+    times = astar['time'].values
+    window = (times >= np.datetime64(beginning_date)) & (times <= np.datetime64(end_date))
+    storm_max = astar.isel(z=np.nonzero(window)[0]).max(dim='z')
+    description = f'max {pd.Timestamp(beginning_date).isoformat()} - {pd.Timestamp(end_date).isoformat()}'
+    return write_cog(storm_max.values, astar['latitude'].values, astar['longitude'].values, path,
+                     descriptions=[description], **options)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export AWI or A* prisms as Cloud-Optimized GeoTIFFs.')
+    parser.add_argument('prism', help='NetCDF prism (e.g. Astar_prism_2023.nc)')
+    parser.add_argument('--output-dir', default='cogs')
+    parser.add_argument('--mode', choices=['timesteps', 'stack'], default='timesteps')
+    parser.add_argument('--start', default=None)
+    parser.add_argument('--end', default=None)
+    parser.add_argument('--compress', default=COG_OPTIONS['COMPRESS'])
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    paths = export_prism(args.prism, args.output_dir, mode=args.mode, start=args.start, end=args.end,
+                         max_workers=args.workers, COMPRESS=args.compress)
+    print(f"Wrote {len(paths)} COGs to {args.output_dir}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+'''
+Lazy, chunked DIST-ALERT processing: the date/status/anomaly filter, the status area statistics and the
+GeoTIFF export of each tile are built as one dask graph and computed together, so every chunk is read
+once, memory stays bounded by the chunk size and many tiles run in parallel on one node.
+
+Example usage:
+    results = process_tiles([item.to_dict() for item in items], '2023-01-01', '2023-01-25',
+                            output_dir='OPERA_Exports', num_workers=16)
+'''
+# Library Imports
+import os
+import threading
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from modules.dist_utils import DIST_BANDS, DIST_REF_DATE, compute_areas
+from modules.earthdata_session import remote_env
+from modules.instrumentation import instrumented
+from modules.stack_bands import stack_bands
+
+STATUS_NODATA = 255
+
+def filter_disturbance(cube, start_date, end_date, anom_threshold=0):
+    '''
+    Returns the VEG-DIST-STATUS band kept where disturbance was first detected in [start_date, end_date].
+    Works on eager and dask-backed cubes alike; with dask nothing is computed here.
+            Parameters:
+                    cube (xarray Dataset): Output of stack_bands with the DIST_BANDS order
+                    start_date, end_date (str or datetime): Disturbance date window
+                    anom_threshold (int): Keep pixels whose VEG-ANOM-MAX is above this value
+            Returns:
+                    status (xarray DataArray): uint8 status, 0 where not disturbed in the window, 255 for nodata
+    '''
+    min_day = (pd.Timestamp(start_date) - DIST_REF_DATE).days
+    max_day = (pd.Timestamp(end_date) - DIST_REF_DATE).days
+    anom = cube.z.sel(band=1)
+    date = cube.z.sel(band=2)
+    status = cube.z.sel(band=3)
+
+    keep = ((date >= min_day) & (date <= max_day) & (anom > anom_threshold) & (anom <= 100)
+            & (status > 0) & (status < STATUS_NODATA))
+    filtered = xr.where(keep, status, xr.where(status == STATUS_NODATA, STATUS_NODATA, 0)).astype('uint8')
+    filtered = filtered.rename('VEG-DIST-STATUS')
+    return filtered.rio.set_spatial_dims(x_dim='longitude', y_dim='latitude').rio.write_nodata(STATUS_NODATA)
+
+def status_counts(filtered):
+    '''
+    Returns the pixel count of each status value (0-255); lazy for dask-backed input.
+    '''
+    data = filtered.data
+    if hasattr(data, 'dask'):
+        import dask.array as dsa
+        return dsa.bincount(data.ravel(), minlength=256)
+    return np.bincount(np.asarray(data).ravel(), minlength=256)
+
+def tile_graph(stac_item, start_date, end_date, anom_threshold=0, output_path=None, chunks=None):
+    '''
+    Returns the lazy pieces for one tile: the status counts and, if output_path is given, the GeoTIFF write.
+    '''
+    chunks = chunks or {'x': 1024, 'y': 1024}
+    cube, crs = stack_bands(stac_item, DIST_BANDS, chunks=chunks)
+    filtered = filter_disturbance(cube, start_date, end_date, anom_threshold).rio.write_crs(crs)
+    write = None
+    if output_path is not None:
+        write = filtered.rio.to_raster(output_path, tiled=True, compress='DEFLATE', lock=threading.Lock(),
+                                       compute=False)
+    return status_counts(filtered), write
+
+@instrumented('dist_process_tiles')
+def process_tiles(stac_items, start_date, end_date, anom_threshold=0, output_dir=None, pixel_area=30 * 30,
+                  chunks=None, num_workers=None):
+    '''
+    Filters, measures and exports many DIST-ALERT tiles in one parallel dask computation.
+            Parameters:
+                    stac_items (list): STAC item dicts
+                    start_date, end_date (str or datetime): Disturbance date window
+                    anom_threshold (int): Keep pixels whose VEG-ANOM-MAX is above this value
+                    output_dir (str): If given, each tile's filtered status is written to {item id}_VEG-DIST-STATUS.tif
+                    pixel_area (float): Area of one pixel (m2)
+                    chunks (dict): Chunk shape used to open the bands (default 1024 x 1024)
+                    num_workers (int): Threads used by the dask scheduler (default: CPU count)
+            Returns:
+                    areas (DataFrame): compute_areas table per tile, with a 'Tile' column
+    '''
+    import dask
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    counts, writes = [], []
+    for item in stac_items:
+        output_path = None if output_dir is None else os.path.join(output_dir, f"{item['id']}_VEG-DIST-STATUS.tif")
+        tile_counts, write = tile_graph(item, start_date, end_date, anom_threshold, output_path, chunks)
+        counts.append(tile_counts)
+        if write is not None:
+            writes.append(write)
+
+    # One compute call, so the export and the statistics of a tile share their band reads
+    hrefs = [asset['href'] for item in stac_items for asset in item['assets'].values()]
+    with remote_env(hrefs):
+        counts, _ = dask.compute(counts, writes, scheduler='threads', num_workers=num_workers)
+
+    frames = []
+    date = f'{pd.Timestamp(start_date).date()} - {pd.Timestamp(end_date).date()}'
+    for item, tile_counts in zip(stac_items, counts):
+        stats = [{k: int(tile_counts[k]) for k in range(5)}]
+        areas = compute_areas(stats, pixel_area, product='alert', date=date)
+        areas.insert(0, 'Tile', item['id'].split('_')[3])
+        frames.append(areas)
+    return pd.concat(frames, ignore_index=True)
@@ -1,17 +1,29 @@
 import numpy as np
 import xarray as xr
 import pandas as pd
-import holoviews as hv
-import panel as pn
 import param
-import hvplot.xarray
-from bokeh.models import FixedTicker
-from bokeh.plotting import show, output_notebook
-import cartopy.crs as ccrs
-import geoviews as gv
 
-output_notebook()
-pn.extension()
+# holoviews, panel, bokeh, cartopy and geoviews are loaded on first use by _load_visualization(),
+# so build_pyramid and select_level stay importable from headless jobs.
+hv = pn = gv = ccrs = FixedTicker = None
+
+def _load_visualization():
+    '''
+    Imports the plotting stack and initializes the notebook output once.
+    '''
+    global hv, pn, gv, ccrs, FixedTicker
+    if pn is not None:
+        return
+    import holoviews as hv
+    import panel as pn
+    import hvplot.xarray
+    from bokeh.models import FixedTicker
+    from bokeh.plotting import output_notebook
+    import cartopy.crs as ccrs
+    import geoviews as gv
+
+    output_notebook()
+    pn.extension()
 
 class VegDistVisualizer(param.Parameterized):
     da = param.Parameter()
@@ -25,13 +37,21 @@ class VegDistVisualizer(param.Parameterized):
     max_date_slider = param.Parameter()
     
     base = param.Parameter()
+    plot_size = param.Integer(default=400)
     
     def __init__(self, da, **params):
         super().__init__(**params)
+        _load_visualization()
         
         self.da = da
         self.start_date = pd.Timestamp('2020-12-31')
-        self.max_value = da.z.sel({'band': 2}).max().item()
+
+        # Precompute the day index and validity masks once, with nearest-neighbour overviews;
+        # each render then picks the overview that matches the visible range
+        self.pyramid = build_pyramid(da)
+        self._windows = {}
+
+        self.max_value = int(self.pyramid[0]['date'].max().item())
         self.max_date = self.start_date + pd.to_timedelta(self.max_value, unit='D')
         self.min_date = self.start_date
 
@@ -44,62 +64,69 @@ class VegDistVisualizer(param.Parameterized):
 
         self.base = gv.tile_sources.EsriImagery.opts(width=1000, height=1000, padding=0.1)
 
-    @pn.depends('min_date_slider.value', 'max_date_slider.value')
-    def veg_dist_date_plot(self):
-        min_days = (pd.Timestamp(self.min_date_slider.value) - self.start_date).days
-        max_days = (pd.Timestamp(self.max_date_slider.value) - self.start_date).days
+    def _slider_days(self, min_value=None, max_value=None):
+        min_value = self.min_date_slider.value if min_value is None else min_value
+        max_value = self.max_date_slider.value if max_value is None else max_value
+        min_days = (pd.Timestamp(min_value) - self.start_date).days
+        max_days = (pd.Timestamp(max_value) - self.start_date).days
+        return min_days, max_days
 
-        masked_veg_dist_date = self.da.z.sel({'band': 2}).where(
-            (self.da.z.sel({'band': 2}) >= min_days) & (self.da.z.sel({'band': 2}) <= max_days), np.nan
-        )
+    def _window(self, level, min_days, max_days):
+        '''
+        Returns the three filtered layers of an overview level for a date window, shared by the three plots.
+        The layers are kept per level, since the plots can show different levels, and only recomputed when the
+        window changes.
+        '''
+        window = (min_days, max_days)
+        if level not in self._windows or self._windows[level][0] != window:
+            layer = self.pyramid[level]
+            in_window = (layer['date'] >= min_days) & (layer['date'] <= max_days)
+            self._windows[level] = (window, (
+                layer['date'].where(in_window),
+                layer['status'].where(in_window & layer['status_valid']),
+                layer['anom'].where(in_window & layer['anom_valid']),
+            ))
+        return self._windows[level][1]
 
-        plot = masked_veg_dist_date.hvplot.image(
-            x='longitude', 
-            y='latitude', 
-            crs=ccrs.PlateCarree(), 
-            rasterize=True, 
-            dynamic=False, 
-            aspect='equal', 
-            cmap='hot_r', 
-            alpha=0.8,
-            width=400, 
-            height=400
-        ).opts(
-            title="VEG_DIST_DATE", 
-            xlabel='Longitude', 
-            ylabel='Latitude', 
-            clim=(min_days, max_days),
-            colorbar=True,
-            colorbar_opts={
-                'title': 'Days',
-                'ticker': FixedTicker(ticks=list(range(min_days, max_days + 1))),
-                'title_standoff': 10,
-                'label_standoff': 8,
-                'major_label_text_font_size': '10pt',
-                'title_text_font_size': '12pt'
-            }
-        ) * self.base
-
-        return plot
-
-    @pn.depends('min_date_slider.value', 'max_date_slider.value')
-    def veg_dist_status_plot(self):
-        min_days = (pd.Timestamp(self.min_date_slider.value) - self.start_date).days
-        max_days = (pd.Timestamp(self.max_date_slider.value) - self.start_date).days
-
-        veg_dist_date_filtered = self.da.z.sel({'band': 2}).where(
-            (self.da.z.sel({'band': 2}) >= min_days) & (self.da.z.sel({'band': 2}) <= max_days)
-        )
+    def _streams(self):
+        '''
+        Returns the streams of one plot: its visible range and the throttled values of the two sliders.
+        '''
+        return [
+            hv.streams.RangeXY(),
+            hv.streams.Params(self.min_date_slider, ['value_throttled'], rename={'value_throttled': 'min_value'}),
+            hv.streams.Params(self.max_date_slider, ['value_throttled'], rename={'value_throttled': 'max_value'}),
+        ]
 
-        veg_dist_date_filtered, veg_dist_status = xr.align(
-            veg_dist_date_filtered, self.da.z.sel({'band': 3}), join='inner', copy=False
-        )
+    def _visible(self, x_range, y_range):
+        '''
+        Returns the visible range in longitude and latitude. geoviews reports the range of the PlateCarree
+        images in longitude and latitude already; a range in Web Mercator metres (e.g. from a plain holoviews
+        stream) is projected.
+        '''
+        if x_range is None or y_range is None:
+            return None, None
+        if max(map(abs, x_range)) <= 180 and max(map(abs, y_range)) <= 90:
+            return tuple(x_range), tuple(y_range)
+        corners = ccrs.PlateCarree().transform_points(ccrs.GOOGLE_MERCATOR, np.array(x_range), np.array(y_range))
+        return (corners[0, 0], corners[1, 0]), (corners[0, 1], corners[1, 1])
 
-        veg_dist_status_filtered = veg_dist_status.where(
-            veg_dist_date_filtered.notnull() & ((veg_dist_status != 0) & (veg_dist_status != 255)), np.nan
-        )
+    def _layer(self, band, x_range, y_range, min_value, max_value):
+        '''
+        Returns one filtered band at the overview level matching the plot size over the visible range,
+        cropped to that range.
+        '''
+        min_days, max_days = self._slider_days(min_value, max_value)
+        lon_range, lat_range = self._visible(x_range, y_range)
+        level = select_level(self.pyramid, self.plot_size, lon_range, lat_range)
+        layer = self._window(level, min_days, max_days)[band]
+        if lon_range is not None:
+            layer = layer.isel(longitude=_in_range(layer['longitude'].values, lon_range),
+                               latitude=_in_range(layer['latitude'].values, lat_range))
+        return layer, min_days, max_days
 
-        plot = veg_dist_status_filtered.hvplot.image(
+    def _image(self, layer):
+        return layer.hvplot.image(
             x='longitude', 
             y='latitude', 
             crs=ccrs.PlateCarree(), 
@@ -108,60 +135,126 @@ class VegDistVisualizer(param.Parameterized):
             aspect='equal', 
             cmap='hot_r', 
             alpha=0.8,
-            width=400, 
-            height=400
-        ).opts(
-            title="VEG_DIST_STATUS", 
-            clim=(0, 4), 
-            colorbar_opts={'ticker': FixedTicker(ticks=[0, 1, 2, 3, 4])}, 
-            xlabel='Longitude', 
-            ylabel='Latitude'
-        ) * self.base
-
-        return plot
-
-    @pn.depends('min_date_slider.value', 'max_date_slider.value')
-    def veg_anom_max_plot(self):
-        min_days = (pd.Timestamp(self.min_date_slider.value) - self.start_date).days
-        max_days = (pd.Timestamp(self.max_date_slider.value) - self.start_date).days
-
-        veg_anom_max_filtered = self.da.z.sel({'band': 1}).where(
-            (self.da.z.sel({'band': 1}) != 0) & 
-            (self.da.z.sel({'band': 1}) != 255) & 
-            (self.da.z.sel({'band': 2}) >= min_days) & 
-            (self.da.z.sel({'band': 2}) <= max_days), np.nan
+            width=self.plot_size, 
+            height=self.plot_size
         )
 
-        plot = veg_anom_max_filtered.hvplot.image(
-            x='longitude', 
-            y='latitude', 
-            crs=ccrs.PlateCarree(), 
-            rasterize=True, 
-            dynamic=False, 
-            aspect='equal', 
-            cmap='hot_r', 
-            alpha=0.8,
-            width=400, 
-            height=400
-        ).opts(
-            title="VEG_ANOM_MAX", 
-            xlabel='Longitude', 
-            ylabel='Latitude',
-            clim=(0, 100)
-        ) * self.base
+    def veg_dist_date_plot(self):
+        def render(x_range, y_range, min_value, max_value):
+            masked_veg_dist_date, min_days, max_days = self._layer(0, x_range, y_range, min_value, max_value)
+            return self._image(masked_veg_dist_date).opts(
+                title="VEG_DIST_DATE", 
+                xlabel='Longitude', 
+                ylabel='Latitude', 
+                clim=(min_days, max_days),
+                colorbar=True,
+                colorbar_opts={
+                    'title': 'Days',
+                    'ticker': FixedTicker(ticks=list(range(min_days, max_days + 1))),
+                    'title_standoff': 10,
+                    'label_standoff': 8,
+                    'major_label_text_font_size': '10pt',
+                    'title_text_font_size': '12pt'
+                }
+            )
+
+        return hv.DynamicMap(render, streams=self._streams()) * self.base
 
-        return plot
+    def veg_dist_status_plot(self):
+        def render(x_range, y_range, min_value, max_value):
+            veg_dist_status_filtered, _, _ = self._layer(1, x_range, y_range, min_value, max_value)
+            return self._image(veg_dist_status_filtered).opts(
+                title="VEG_DIST_STATUS", 
+                clim=(0, 4), 
+                colorbar_opts={'ticker': FixedTicker(ticks=[0, 1, 2, 3, 4])}, 
+                xlabel='Longitude', 
+                ylabel='Latitude'
+            )
+
+        return hv.DynamicMap(render, streams=self._streams()) * self.base
+
+    def veg_anom_max_plot(self):
+        def render(x_range, y_range, min_value, max_value):
+            veg_anom_max_filtered, _, _ = self._layer(2, x_range, y_range, min_value, max_value)
+            return self._image(veg_anom_max_filtered).opts(
+                title="VEG_ANOM_MAX", 
+                xlabel='Longitude', 
+                ylabel='Latitude',
+                clim=(0, 100)
+            )
+
+        return hv.DynamicMap(render, streams=self._streams()) * self.base
 
     def panel_layout(self):
         return pn.Column(
             pn.Row(self.min_date_slider, self.max_date_slider, sizing_mode='scale_width'),
             pn.Row(
-                pn.panel(self.veg_dist_date_plot, sizing_mode='scale_width'), 
-                pn.panel(self.veg_dist_status_plot, sizing_mode='scale_width'),
-                pn.panel(self.veg_anom_max_plot, sizing_mode='scale_width')
+                pn.panel(self.veg_dist_date_plot(), sizing_mode='scale_width'), 
+                pn.panel(self.veg_dist_status_plot(), sizing_mode='scale_width'),
+                pn.panel(self.veg_anom_max_plot(), sizing_mode='scale_width')
             )
         )
 
 
+def _in_range(values, value_range):
+    '''
+    Returns the indices of coordinate values inside a (low, high) range, in either order.
+    '''
+    low, high = min(value_range), max(value_range)
+    return np.nonzero((values >= low) & (values <= high))[0]
+
+
+def build_pyramid(da, min_size=256):
+    '''
+    Returns a list of overview levels for a stacked DIST-ALERT cube, finest first.
+            Parameters:
+                    da (xarray Dataset): Band cube from stack_bands (band 1 VEG-ANOM-MAX, 2 VEG-DIST-DATE, 3 VEG-DIST-STATUS)
+                    min_size (int): Stop adding levels once either side would fall below this many pixels
+            Returns:
+                    levels (list): One dict per level with the 'date' day index, 'status' and 'anom' bands
+                                   and the 'status_valid' / 'anom_valid' masks (not 0 and not 255)
+    '''
+    anom = da.z.sel({'band': 1}).load()
+    date = da.z.sel({'band': 2}).load()
+    status = da.z.sel({'band': 3}).load()
+    date, status, anom = xr.align(date, status, anom, join='inner', copy=False)
+
+    levels = []
+    factor = 1
+    while True:
+        # Nearest-neighbour decimation keeps the categorical status classes exact
+        window = {'latitude': slice(None, None, factor), 'longitude': slice(None, None, factor)}
+        level_anom = anom.isel(window)
+        level_status = status.isel(window)
+        levels.append({
+            'date': date.isel(window),
+            'status': level_status,
+            'anom': level_anom,
+            'status_valid': (level_status != 0) & (level_status != 255),
+            'anom_valid': (level_anom != 0) & (level_anom != 255),
+        })
+        factor *= 2
+        if min(date.sizes['latitude'], date.sizes['longitude']) // factor < min_size:
+            break
+    return levels
 
 
+def select_level(levels, plot_size, x_range=None, y_range=None):
+    '''
+    Returns the index of the coarsest overview that still covers the plot at one pixel per screen pixel.
+            Parameters:
+                    levels (list): Output of build_pyramid, finest first
+                    plot_size (int): Plot width and height in screen pixels
+                    x_range, y_range (tuple): Visible longitude and latitude range; the full extent if not given
+            Returns:
+                    index (int): Index into levels
+    '''
+    for index in range(len(levels) - 1, -1, -1):
+        date = levels[index]['date']
+        if x_range is None or y_range is None:
+            shape = date.shape
+        else:
+            shape = (len(_in_range(date['latitude'].values, y_range)), len(_in_range(date['longitude'].values, x_range)))
+        if min(shape) >= plot_size:
+            return index
+    return 0
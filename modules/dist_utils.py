@@ -1,58 +1,37 @@
 # Library Imports
+# Only the compute dependencies are imported here. GDAL, rasterio, rioxarray, folium, matplotlib,
+# pyproj and shapely are imported inside the functions that use them, so headless jobs that only
+# need masking and area statistics do not pay for them at import time.
 import os
 import re
 import math
 from datetime import datetime, timedelta
 import pandas as pd
 import xarray as xr
-import rasterio as rio
-from rasterio.merge import merge
-import rioxarray
-from osgeo import gdal
 import numpy as np
 import numpy.ma as ma
-import folium
-from shapely.geometry import shape, Point, Polygon
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from netrc import netrc
-from pyproj import Transformer
-from subprocess import Popen
-from getpass import getpass
 from http import cookiejar
 from urllib import request
 import tempfile
+from functools import lru_cache
+
+from modules.instrumentation import instrumentation, instrumented
+from modules.earthdata_session import EARTHDATA_URS, netrc_credentials, remote_env
+
+# VEG-DIST-DATE is stored as days since this date
+DIST_REF_DATE = pd.Timestamp('2020-12-31')
+DIST_BANDS = ['VEG-ANOM-MAX', 'VEG-DIST-DATE', 'VEG-DIST-STATUS']
 
 def check_netrc():
     '''
     Checks that user possesses necessary credentials for accessing Earthdata in .netrc file. If not present, user is prompted to 
     enter username and password, which are placed in a .netrc file in user's home directory. 
     '''
-    # -----------------------------------AUTHENTICATION CONFIGURATION-------------------------------- #
-    urs = 'urs.earthdata.nasa.gov'    # Earthdata URL to call for authentication
-    prompts = ['Enter NASA Earthdata Login Username \n(or create an account at urs.earthdata.nasa.gov): ',
-           'Enter NASA Earthdata Login Password: ']
-
-    # Determine if netrc file exists, and if so, if it includes NASA Earthdata Login Credentials
     try:
-        netrcDir = os.path.expanduser("~/.netrc")
-        netrc(netrcDir).authenticators(urs)[0]
+        netrc_credentials(machine=EARTHDATA_URS, prompt=False)
         print('netrc exists and includes NASA Earthdata login credentials.')
-        
-    # Below, create a netrc file and prompt user for NASA Earthdata Login Username and Password
-    except FileNotFoundError:
-        homeDir = os.path.expanduser("~")
-        Popen('touch {0}.netrc | chmod og-rw {0}.netrc | echo machine {1} >> {0}.netrc'.format(homeDir + os.sep, urs), shell=True)
-        Popen('echo login {} >> {}.netrc'.format(getpass(prompt=prompts[0]), homeDir + os.sep), shell=True)
-        Popen('echo password {} >> {}.netrc'.format(getpass(prompt=prompts[1]), homeDir + os.sep), shell=True)
-
-    # Determine OS and edit netrc file if it exists but is not set up for NASA Earthdata Login
-    except TypeError:
-        homeDir = os.path.expanduser("~")
-        Popen('echo machine {1} >> {0}.netrc'.format(homeDir + os.sep, urs), shell=True)
-        Popen('echo login {} >> {}.netrc'.format(getpass(prompt=prompts[0]), homeDir + os.sep), shell=True)
-        Popen('echo password {} >> {}.netrc'.format(getpass(prompt=prompts[1]), homeDir + os.sep), shell=True)
-    #return netrc(netrcDir).authenticators(urs)
+    except Exception:
+        netrc_credentials(machine=EARTHDATA_URS)
     return 
 
 def clipPercentile(x):
@@ -76,6 +55,7 @@ def colorize(array, cmap='hot_r'):
             Returns:
                 Pixels with RGB values corresponding to the specified cmap.
     '''
+    import matplotlib.pyplot as plt
     normed_data = (array - array.min()) / (array.max() - array.min()) 
     cm = plt.cm.get_cmap(cmap)
     return cm(normed_data) 
@@ -155,6 +135,7 @@ def getbasemaps():
     '''
     Add custom base maps to folium.
     '''
+    import folium
     basemaps = {
         'Google Maps': folium.TileLayer(
             tiles = 'https://mt1.google.com/vt/lyrs=m&x={x}&y={y}&z={z}',
@@ -211,26 +192,21 @@ def get_pixel_value_at_coordinate(filepath, coords, output_epsg):
                     coords (list): Coordinate lat,lon
                     output_epsg (int): EPSG code for the raster data
             Returns:
-                Single pixel value (for a single banded raster)
+                Single pixel value (for a single banded raster), in the raster's dtype; nodata is returned as is
     '''
-    # Create a coordinate transformer
-    EPSG_WGS84 = 4326
-
-    transformer = Transformer.from_crs(EPSG_WGS84, output_epsg, always_xy=True)
-
-    # Convert the input latitude and longitude to EPSG 3857
-    x, y = transformer.transform(coords[1], coords[0])
-
-    # Open the GeoTIFF file
-    with rio.open(filepath) as dataset:
+    # Single-point case of the batch sampler
+    values = sample_points([filepath], [coords], output_epsg=output_epsg, native=True)
+    if values.mask[0, 0]:
+        raise Exception("Invalid value for 'coords'. It should be inside the raster.")
+    return values.data[0, 0]
 
-        # Get the row and column indices corresponding to the transformed coordinates
-        row, col = dataset.index(x, y)
-        
-        # Read the pixel value at the computed row and column indices
-        pixel_value = dataset.read(1, window=((row, row + 1), (col, col + 1)))
-
-    return pixel_value[0][0]
+@lru_cache(maxsize=32)
+def get_transformer(src_crs, dst_crs):
+    '''
+    Returns a cached pyproj Transformer (always_xy) between two CRS definitions.
+    '''
+    from pyproj import Transformer
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
 
 def handle_draw(target, action, geo_json):
     '''
@@ -249,6 +225,7 @@ def intersection_percent(item, aoi):
                                                     the AOI (An item that completely covers
                                                     the AOI has a value of 100)
     '''
+    from shapely.geometry import shape
     geom_item = shape(item.geometry)
     geom_aoi = shape(aoi)
     intersected_geom = geom_aoi.intersection(geom_item)
@@ -256,6 +233,7 @@ def intersection_percent(item, aoi):
 
     return intersection_percent
 
+@instrumented('dist_write_status_visual')
 def make_veg_dist_status_visual(filepath, filename):
     '''
     Return a rendered visual of a VEG-DIST-STATUS tile.
@@ -265,6 +243,8 @@ def make_veg_dist_status_visual(filepath, filename):
             Returns:
                 No returns. Saves .tif file locally.
     '''
+    import rasterio as rio
+    from osgeo import gdal
     print('making VEG-DIST-STATUS rendering...')
 
     # make output subdirectory, if not already present
@@ -299,6 +279,7 @@ def make_veg_dist_status_visual(filepath, filename):
 
     return
 
+@instrumented('hls_write_true_color')
 def make_hls_true_color(filepath, bandlist, filename):
     '''
     Return a rendered true color of an input HLS tile.
@@ -309,6 +290,8 @@ def make_hls_true_color(filepath, bandlist, filename):
             Returns:
                 No returns. Saves .tif file locally.
     '''
+    import rasterio as rio
+    from osgeo import gdal
 
     print('making hls true color rendering...')
 
@@ -366,6 +349,7 @@ def make_hls_true_color(filepath, bandlist, filename):
     print(filename+' written successfully.')
     return                     
 
+@instrumented('hls_write_false_color')
 def make_hls_false_color(filepath, bandlist, filename):
     '''
     Return a rendered false color of an input HLS tile.
@@ -376,6 +360,8 @@ def make_hls_false_color(filepath, bandlist, filename):
             Returns:
                 No returns. Saves .tif file locally.
     '''
+    import rasterio as rio
+    from osgeo import gdal
     print('making false color rendering...')
 
     # make output subdirectory, if not already present
@@ -432,6 +418,7 @@ def make_hls_false_color(filepath, bandlist, filename):
     print(filename+' written successfully.')
     return
 
+@instrumented('hls_write_ndvi')
 def make_hls_ndvi(filepath, bandlist, filename):
     '''
     Return a rendered ndvi of an input HLS tile.
@@ -442,6 +429,8 @@ def make_hls_ndvi(filepath, bandlist, filename):
             Returns:
                 No returns. Saves .tif file locally.
     '''
+    import rasterio as rio
+    from osgeo import gdal
     
     print('making ndvi rendering...')
 
@@ -507,44 +496,81 @@ def make_hls_ndvi(filepath, bandlist, filename):
     
     return
 
-def mask_rasters(merged_VEG_ANOM_MAX, merged_VEG_DIST_DATE, merged_VEG_DIST_STATUS):
+# Bits of the validity mask shared by the three DIST-ALERT bands
+ANOM_VALID, DATE_VALID, STATUS_VALID = 1, 2, 4
+
+def dist_validity(VEG_ANOM_MAX, VEG_DIST_DATE, VEG_DIST_STATUS, block_rows=1024):
     '''
-    Return VEG-ANOM-MAX, VEG-DIST-DATE, VEG-DIST-STATUS rasters with nan values masked.
+    Returns one uint8 bitmask with the validity of each DIST-ALERT band, built block by block so the
+    temporaries never exceed a few rows of the raster.
+            Parameters:
+                    VEG_ANOM_MAX, VEG_DIST_DATE, VEG_DIST_STATUS (array): Bands in their native dtypes
+                    block_rows (int): Rows evaluated per block
+            Returns:
+                    bits (numpy array): ANOM_VALID where VEG-ANOM-MAX <= 100, DATE_VALID where VEG-DIST-DATE > 0,
+                                        STATUS_VALID where 0 < VEG-DIST-STATUS < 255
+    '''
+    bits = np.zeros(VEG_DIST_STATUS.shape, dtype='uint8')
+    for row in range(0, bits.shape[0], block_rows):
+        rows = slice(row, row + block_rows)
+        status = VEG_DIST_STATUS[rows]
+        block = bits[rows]
+        block |= (VEG_ANOM_MAX[rows] <= 100).view('uint8')
+        block |= (VEG_DIST_DATE[rows] > 0).view('uint8') << 1
+        block |= ((status > 0) & (status < 255)).view('uint8') << 2
+    return bits
+
+@instrumented('dist_mask_rasters')
+def mask_rasters(merged_VEG_ANOM_MAX, merged_VEG_DIST_DATE, merged_VEG_DIST_STATUS, as_mask=False):
+    '''
+    Return VEG-ANOM-MAX, VEG-DIST-DATE, VEG-DIST-STATUS rasters with invalid values masked.
+    By default the rasters are float64 copies with nan at the masked pixels. With as_mask=True the
+    masked arrays are views on the input data in its native dtype, and only the masks are allocated.
+    nan values of float inputs fail every rule and are masked too.
             Parameters:
                     merged_VEG_ANOM_MAX (array): Merged VEG-ANOM-MAX arrays
                     merged_VEG_DIST_DATE (array): Merged VEG-DIST-DATE arrays
                     merged_VEG_DIST_STATUS (array): Merged VEG-DIST-STATUS arrays
+                    as_mask (bool): Return native dtype views with a mask instead of float64 arrays with nan
             Returns:
-                    masked_VEG_ANOM_MAX (array): merged_VEG_ANOM_MAX array with nan values masked
-                    masked_VEG_DIST_DATE (array): merged_VEG_DIST_DATE array with nan values masked
-                    masked_VEG_DIST_STATUS (array): merged_VEG_DIST_STATUS array with nan values masked
-    '''
-    raster_da_VEG_ANOM_MAX = merged_VEG_ANOM_MAX.where((merged_VEG_ANOM_MAX<=100), np.nan)
-    arr_raster_da_VEG_ANOM_MAX = raster_da_VEG_ANOM_MAX.values
-    masked_VEG_ANOM_MAX = ma.masked_invalid(arr_raster_da_VEG_ANOM_MAX)
-    
-    raster_da_VEG_DIST_DATE = merged_VEG_DIST_DATE.where((merged_VEG_DIST_DATE>0), np.nan)
-    arr_raster_da_VEG_DIST_DATE = raster_da_VEG_DIST_DATE.values
-    masked_VEG_DIST_DATE = ma.masked_invalid(arr_raster_da_VEG_DIST_DATE)
-    
-    raster_da_VEG_DIST_STATUS = merged_VEG_DIST_STATUS.where((merged_VEG_DIST_STATUS>0) & (merged_VEG_DIST_STATUS<255), np.nan)
-    arr_raster_da_VEG_DIST_STATUS = raster_da_VEG_DIST_STATUS.values
-    masked_VEG_DIST_STATUS = ma.masked_invalid(arr_raster_da_VEG_DIST_STATUS)
-    
+                    masked_VEG_ANOM_MAX (array): merged_VEG_ANOM_MAX masked where above 100
+                    masked_VEG_DIST_DATE (array): merged_VEG_DIST_DATE masked where not positive
+                    masked_VEG_DIST_STATUS (array): merged_VEG_DIST_STATUS masked where 0 or 255
+    '''
+    anom = np.asarray(getattr(merged_VEG_ANOM_MAX, 'values', merged_VEG_ANOM_MAX))
+    date = np.asarray(getattr(merged_VEG_DIST_DATE, 'values', merged_VEG_DIST_DATE))
+    status = np.asarray(getattr(merged_VEG_DIST_STATUS, 'values', merged_VEG_DIST_STATUS))
+    bits = dist_validity(anom, date, status)
+
+    masked = []
+    for band, bit in ((anom, ANOM_VALID), (date, DATE_VALID), (status, STATUS_VALID)):
+        mask = (bits & bit) == 0
+        if not as_mask:
+            band = band.astype('float64')
+            band[mask] = np.nan
+        masked.append(ma.MaskedArray(band, mask=mask, copy=False))
+    masked_VEG_ANOM_MAX, masked_VEG_DIST_DATE, masked_VEG_DIST_STATUS = masked
+
     return masked_VEG_ANOM_MAX, masked_VEG_DIST_DATE, masked_VEG_DIST_STATUS
 
+@instrumented('dist_merge_rasters')
 def merge_rasters(input_files, output_file, write=True):
     """
     Function to take a list of raster tiles, mosaic them using rasterio, and output the file.
     :param input_files: list of input raster files 
     """
+    import rasterio as rio
+    from rasterio.merge import merge
 
-    # Open the input rasters and retrieve metadata
-    src_files = [rio.open(file) for file in input_files]
-    meta = src_files[0].meta
-    
-    #mosaic the src_files
-    mosaic, out_trans = merge(src_files)
+    # Open the input rasters and retrieve metadata, under the Earthdata GDAL options for remote files
+    with remote_env(input_files):
+        src_files = [rio.open(file) for file in input_files]
+        for file in input_files:
+            instrumentation.read_file(file)
+        meta = src_files[0].meta
+
+        #mosaic the src_files
+        mosaic, out_trans = merge(src_files)
 
     # Update the metadata
     out_meta = meta.copy()
@@ -557,6 +583,7 @@ def merge_rasters(input_files, output_file, write=True):
     if write==True:
         with rio.open(output_file, 'w', **out_meta) as dst:
             dst.write(mosaic)
+        instrumentation.wrote_file(output_file)
 
         #Close the input rasters
     for src in src_files:
@@ -564,6 +591,81 @@ def merge_rasters(input_files, output_file, write=True):
     
     return mosaic
 
+@instrumented('dist_sample_points')
+def sample_points(filepaths, coords, output_epsg=None, band=1, native=False):
+    '''
+    Returns pixel values for many lat/lon points across many single banded rasters.
+    Points are transformed in one vectorized call per CRS and grouped by internal block,
+    so each block a point falls into is read once per raster.
+            Parameters:
+                    filepaths (list): M paths or urls to geotiffs
+                    coords (array): N x 2 array of lat,lon coordinates
+                    output_epsg (int): EPSG code of the rasters; if None it is read from each file
+                    band (int): Band index to sample
+                    native (bool): Return the pixel values in the rasters' own dtype, nodata values included
+            Returns:
+                    values (numpy array): N x M float array, nan where a point falls outside a raster or on nodata.
+                                          With native=True, an N x M masked array in the rasters' dtype,
+                                          masked only where a point falls outside a raster
+    '''
+    import rasterio as rio
+    from rasterio.transform import rowcol
+    from rasterio.windows import Window
+    coords = np.atleast_2d(np.asarray(coords, dtype='float64'))
+    columns = []
+    insides = []
+    nodatas = []
+    projected = {}
+
+    for filepath in filepaths:
+        with remote_env(filepath), rio.open(filepath) as dataset:
+            crs = output_epsg if output_epsg is not None else dataset.crs.to_string()
+
+            # Transform every point once per CRS
+            instrumentation.cache_hit(crs in projected)
+            if crs not in projected:
+                projected[crs] = get_transformer(4326, crs).transform(coords[:, 1], coords[:, 0])
+            xs, ys = projected[crs]
+
+            rows, cols = rowcol(dataset.transform, xs, ys)
+            rows = np.asarray(rows)
+            cols = np.asarray(cols)
+            inside = (rows >= 0) & (rows < dataset.height) & (cols >= 0) & (cols < dataset.width)
+            column = np.zeros(coords.shape[0], dtype=dataset.dtypes[band - 1])
+            columns.append(column)
+            insides.append(inside)
+            nodatas.append(dataset.nodata)
+            if not inside.any():
+                continue
+
+            # Group points by the internal block they fall into
+            block_h, block_w = dataset.block_shapes[band - 1]
+            point_idx = np.nonzero(inside)[0]
+            block_id = (rows[point_idx] // block_h) * ((dataset.width + block_w - 1) // block_w) + cols[point_idx] // block_w
+            order = np.argsort(block_id, kind='stable')
+            point_idx = point_idx[order]
+            block_id = block_id[order]
+            splits = np.nonzero(np.diff(block_id))[0] + 1
+
+            for group in np.split(point_idx, splits):
+                row0 = (rows[group[0]] // block_h) * block_h
+                col0 = (cols[group[0]] // block_w) * block_w
+                window = Window(col0, row0, min(block_w, dataset.width - col0), min(block_h, dataset.height - row0))
+                block = dataset.read(band, window=window)
+                instrumentation.add_bytes_read(block.nbytes)
+                column[group] = block[rows[group] - row0, cols[group] - col0]
+
+    if native:
+        if not columns:
+            return ma.MaskedArray(np.zeros((coords.shape[0], 0)))
+        return ma.MaskedArray(np.stack(columns, axis=1), mask=~np.stack(insides, axis=1))
+
+    values = np.full((coords.shape[0], len(filepaths)), np.nan)
+    for j, (column, inside, nodata) in enumerate(zip(columns, insides, nodatas)):
+        valid = inside if nodata is None else inside & (column != nodata)
+        values[valid, j] = column[valid]
+    return values
+
 def scaleto255(x):
     '''
     Returns an array containing values between 0-255 that correspond to the original input array. 
@@ -576,6 +678,7 @@ def scaleto255(x):
     x_scaled = ((x - np.nanmin(x))) * (255/(np.nanmax(x)-np.nanmin(x)))
     return(x_scaled)
 
+@instrumented('dist_stack_bands')
 def stack_bands(bandpath:str, bandlist:list): 
     '''
     Returns geocube with three bands stacked into one multi-dimensional array.
@@ -590,11 +693,13 @@ def stack_bands(bandpath:str, bandlist:list):
             Updates: Changed load data library from xarray to rioxarray due to deprecation of xarray.open_rasterio().
             This required excluding the .scales method as well, which may cause problems, but I will wait and see.
     '''
+    import rioxarray
     bandStack = []; bandS = []; bandStack_ = [];
     for i,band in enumerate(bandlist):
         if i==0:
             #bandStack_ = xr.open_rasterio(bandpath%band)
-            bandStack_ = rioxarray.open_rasterio(bandpath%band)
+            with remote_env(bandpath%band):
+                bandStack_ = rioxarray.open_rasterio(bandpath%band)
             #crs = pyproj.CRS.to_epsg(pyproj.CRS.from_proj4(bandStack_.crs))
             crs = bandStack_.rio.crs.to_epsg()
             #bandStack_ = bandStack_ * bandStack_.scales[0]
@@ -605,7 +710,8 @@ def stack_bands(bandpath:str, bandlist:list):
             bandStack = bandStack.expand_dims(dim='band')  
         else:
             #bandS = xr.open_rasterio(bandpath%band)
-            bandS = rioxarray.open_rasterio(bandpath%band)
+            with remote_env(bandpath%band):
+                bandS = rioxarray.open_rasterio(bandpath%band)
             #bandS = bandS * bandS.scales[0]
             bandS = bandS.squeeze(drop=True)
             bandS = bandS.to_dataset(name='z')
@@ -613,6 +719,9 @@ def stack_bands(bandpath:str, bandlist:list):
             bandS = bandS.rename({'x':'longitude', 'y':'latitude', 'band':'band'})
             bandS = bandS.expand_dims(dim='band')
             bandStack = xr.concat([bandStack, bandS], dim='band')
+    # Read while the GDAL options are set, rather than lazily after they are removed
+    with remote_env(bandpath):
+        bandStack = bandStack.load()
     return bandStack, crs
 
 def standard_date(day, ref_date):
@@ -629,6 +738,7 @@ def standard_date(day, ref_date):
     res = res_date.strftime("%m-%d-%Y")
     return res
 
+@instrumented('dist_time_and_area_cube')
 def time_and_area_cube(dist_status, dist_date, veg_anom_max, anom_threshold, pixel_area, bounds, starting_day, ending_day, ref_date, step=3):
     '''
     Returns geocube with time and area dimensions.
@@ -665,6 +775,7 @@ def time_and_area_cube(dist_status, dist_date, veg_anom_max, anom_threshold, pix
     area_extent = xr.concat(expanded_array2[:], dim='time')
     return area_extent
 
+@instrumented('dist_reproject_for_folium')
 def transform_data_for_folium(url=[]):
 
     '''
@@ -675,14 +786,18 @@ def transform_data_for_folium(url=[]):
                 reproj (array): Array that is reprojected to EPSG 4326
                 colormap (cmap): Colormap of choice
     '''
-    src = rioxarray.open_rasterio(url)
-    reproj = src.rio.reproject("EPSG:4326")             # Folium maps are in EPSG:4326
+    import matplotlib as mpl
+    import rioxarray
+    with remote_env(url):
+        src = rioxarray.open_rasterio(url)
+        reproj = src.rio.reproject("EPSG:4326")         # Folium maps are in EPSG:4326
     colormap = mpl.colormaps["hot_r"]
     
     return reproj, colormap
 
 ### Functions below this point are in-progress ###
 
+@instrumented('hls_merge_and_stack')
 def merge_and_stack_geotiffs(input_files, bandlist, output_file):
     '''
     Produces a merged multiband raster from individual multiband rasters.
@@ -694,6 +809,7 @@ def merge_and_stack_geotiffs(input_files, bandlist, output_file):
             Returns:
                     None
     '''
+    import rasterio as rio
 
     # Get a list of the full file paths for each single band raster
     all_filepaths = []
@@ -737,6 +853,7 @@ def merge_and_stack_geotiffs(input_files, bandlist, output_file):
                                                                                                                                                             
     return 
 
+@instrumented('hls_write_rendering')
 def make_rendering(raster, product, output_file):
     '''
     Produces a rendered version of an input raster.
@@ -747,6 +864,7 @@ def make_rendering(raster, product, output_file):
             Returns:
                     None
     '''
+    import rasterio as rio
 
     print('making hls true color rendering...')
 
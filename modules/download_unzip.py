@@ -1,12 +1,57 @@
 # Library Imports
 import os
 import gzip
+import json
 import shutil
+import warnings
 
 import pandas as pd
 import requests
 
-def download_and_unzip_qpe(year, month, WY):
+from modules.instrumentation import instrumentation, instrumented
+
+# Archive files missing this long after their valid time are not expected to appear later
+MISSING_AFTER = pd.Timedelta(days=2)
+
+def _read_missing(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(json.load(f))
+
+def _write_missing(path, missing):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(sorted(missing), f, indent=1)
+    os.replace(tmp_path, path)
+
+def _download_file(url, file_path):
+    '''
+    Downloads and unzips one file to file_path. The content goes to a .part file that is renamed
+    once the whole response has been read, so an interrupted download never looks complete.
+    Returns the HTTP status code.
+    '''
+    tmp_path = file_path + '.part'
+    response = requests.get(url, stream=True, timeout=60)
+    if response.status_code != 200:
+        return response.status_code
+    try:
+        with gzip.GzipFile(fileobj=response.raw) as f_in:
+            with open(tmp_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        size = response.headers.get('Content-Length')
+        if size is not None and response.raw.tell() != int(size):
+            raise IOError(f"Incomplete download of {url}: {response.raw.tell()} of {size} bytes")
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    instrumentation.add_bytes_read(response.raw.tell())
+    instrumentation.wrote_file(file_path)
+    return response.status_code
+
+@instrumented('qpe_download_month')
+def download_and_unzip_qpe(year, month, WY, project_root=None, skip_existing=False):
     '''The download_and_unzip_qpe function downloads and unzips QPE 6-hour observed precipitation files 
     for a specified year and month from the CNRFC archive. It generates the appropriate file names 
     and URLs, downloads the files, unzips them directly from the response stream, 
@@ -15,6 +60,11 @@ def download_and_unzip_qpe(year, month, WY):
         year (int): The year for which to download the files (e.g., 2023).
         month (int): The month for which to download the files (e.g., 10 for October).
         WY (str): The water year for which the data is being processed (e.g., '2023').
+        project_root (str): Directory holding the wy{WY}_astar folders (defaults to the current working directory).
+        skip_existing (bool): Skip files that were already downloaded and unzipped, and files the archive
+                              was missing on an earlier run (recorded in wy_data/.missing.json).
+    Returns:
+        counts (dict): Number of files 'downloaded', 'existing' (skipped), 'missing' and 'failed'
     Example usage:
         download_and_unzip_qpe(2023, 10, '2023')  # Replace with desired year, month, and WY
     '''
@@ -55,7 +105,8 @@ def download_and_unzip_qpe(year, month, WY):
     print(df)
 
     # Define the project root directory using the current working directory
-    project_root = os.getcwd()
+    if project_root is None:
+        project_root = os.getcwd()
 
     # Directory to save the unzipped files, dynamically generated using the year and WY
     unzip_dir = os.path.join(project_root, f'wy{WY}_astar', 'wy_data')
@@ -63,24 +114,44 @@ def download_and_unzip_qpe(year, month, WY):
     # Create directory if it doesn't exist
     os.makedirs(unzip_dir, exist_ok=True)
 
+    # Files the archive did not have on earlier runs
+    missing_path = os.path.join(unzip_dir, '.missing.json')
+    missing = _read_missing(missing_path)
+    now = pd.Timestamp.now('UTC').tz_localize(None)
+    counts = {'downloaded': 0, 'existing': 0, 'missing': 0, 'failed': 0}
+
     # Download, unzip, and save the files directly without keeping the zipped files
     for index, row in df.iterrows():
         file_name = row['File Names']
         url = row['URL']
         unzipped_file_name = file_name[:-3]  # Remove .gz extension
         unzipped_file_path = os.path.join(unzip_dir, unzipped_file_name)
+        # Files are renamed into place only once complete, so an existing file is a finished download
+        if skip_existing and (os.path.exists(unzipped_file_path) or file_name in missing):
+            counts['existing' if file_name not in missing else 'missing'] += 1
+            continue
         
         # Download the file
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            # Unzip the file content and save it directly
-            with gzip.GzipFile(fileobj=response.raw) as f_in:
-                with open(unzipped_file_path, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-        #     print(f"Downloaded and unzipped: {unzipped_file_name}")
-        # else:
-        #     print(f"Failed to download: {file_name}")
-
-    print("Download and extraction complete.")
-
-
+        with instrumentation.stage('qpe_download'):
+            try:
+                status_code = _download_file(url, unzipped_file_path)
+            except Exception as error:
+                warnings.warn(f"Failed to download {file_name}: {error}")
+                counts['failed'] += 1
+                continue
+        if status_code == 200:
+            counts['downloaded'] += 1
+            missing.discard(file_name)
+        elif status_code == 404:
+            counts['missing'] += 1
+            # Recent files may still be posted, so only older misses are recorded
+            valid_time = pd.to_datetime(file_name[4:17], format='%Y%m%d_%H%M')
+            if now - valid_time > MISSING_AFTER:
+                missing.add(file_name)
+        else:
+            warnings.warn(f"Failed to download {file_name}: HTTP {status_code}")
+            counts['failed'] += 1
+
+    _write_missing(missing_path, missing)
+    print(f"Download and extraction complete: {counts}")
+    return counts
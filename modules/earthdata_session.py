@@ -0,0 +1,263 @@
+'''
+Shared Earthdata session: credentials, the GDAL /vsicurl/ environment and a pooled async HTTP client.
+
+Credentials are read from ~/.netrc once (written there on first use if missing), the GDAL options the
+OPERA notebook used to set by hand are applied inside a rasterio.Env around remote reads (GDAL sees them
+from every thread while the block runs, and they are removed afterwards), and asset reads can be issued
+concurrently from asyncio. Local files never touch the session.
+
+Example usage:
+    with remote_env(hrefs):                 # GDAL options for rasterio/rioxarray readers of remote hrefs
+        cube = rioxarray.open_rasterio(hrefs[0]).load()
+    arrays = get_session().read_many([href_1, href_2, href_3])
+    arrays = await get_session().read_many_async([href_1, href_2, href_3])   # in a notebook cell
+
+    async def main():
+        async with EarthdataSession() as session:
+            header = await session.fetch(href, byte_range=(0, 16383))
+'''
+# Library Imports
+import os
+import stat
+import base64
+import asyncio
+import warnings
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from netrc import netrc
+from getpass import getpass
+from urllib.parse import urljoin, urlparse
+
+EARTHDATA_URS = 'urs.earthdata.nasa.gov'
+
+# GDAL configuration shared by every /vsicurl/ reader
+GDAL_HTTP_OPTIONS = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': 'TIF,TIFF',
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+    'GDAL_HTTP_VERSION': '2',
+    'GDAL_HTTP_MULTIPLEX': 'YES',
+    'GDAL_HTTP_NETRC': 'YES',
+    'GDAL_HTTP_MAX_RETRY': '4',
+    'GDAL_HTTP_RETRY_DELAY': '1',
+    'VSI_CACHE': 'TRUE',
+}
+
+def write_netrc(username, password, path=None, machine=EARTHDATA_URS):
+    '''
+    Appends Earthdata credentials to a .netrc file, creating it readable by the owner only.
+    '''
+    path = os.path.expanduser(path or '~/.netrc')
+    with open(path, 'a') as f:
+        f.write(f'machine {machine}\n    login {username}\n    password {password}\n')
+    os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+    return path
+
+def netrc_credentials(path=None, machine=EARTHDATA_URS, prompt=True):
+    '''
+    Returns (username, password) for machine from .netrc, prompting for and storing them if absent.
+    '''
+    path = os.path.expanduser(path or '~/.netrc')
+    try:
+        authenticators = netrc(path).authenticators(machine)
+    except FileNotFoundError:
+        authenticators = None
+    if authenticators is not None:
+        return authenticators[0], authenticators[2]
+    if not prompt:
+        raise Exception(f"No credentials for {machine} in {path}.")
+    username = getpass(prompt='Enter NASA Earthdata Login Username \n(or create an account at urs.earthdata.nasa.gov): ')
+    password = getpass(prompt='Enter NASA Earthdata Login Password: ')
+    write_netrc(username, password, path, machine)
+    return username, password
+
+class EarthdataSession:
+    '''
+    Authenticates once and shares one HTTP connection pool, cookie jar and GDAL environment across readers.
+            Parameters:
+                    netrc_path (str): .netrc with the Earthdata credentials (default ~/.netrc)
+                    cookie_file (str): Cookie jar shared by GDAL readers
+                    urs (str): Login host; redirects to it are answered with basic auth
+                    max_connections (int): Size of the HTTP connection pool and of concurrent asset reads
+                    gdal_options (dict): Extra or overriding GDAL configuration options
+    '''
+    def __init__(self, netrc_path=None, cookie_file='~/cookies.txt', urs=EARTHDATA_URS, max_connections=16,
+                 gdal_options=None):
+        self.netrc_path = os.path.expanduser(netrc_path or '~/.netrc')
+        self.cookie_file = os.path.expanduser(cookie_file)
+        self.urs = urs
+        self.max_connections = max_connections
+        self.gdal_options = dict(GDAL_HTTP_OPTIONS)
+        self.gdal_options.update({'GDAL_HTTP_COOKIEFILE': self.cookie_file, 'GDAL_HTTP_COOKIEJAR': self.cookie_file,
+                                  'GDAL_HTTP_NETRC_FILE': self.netrc_path})
+        self.gdal_options.update(gdal_options or {})
+        self._credentials = None
+        self._http = None
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    @property
+    def credentials(self):
+        return self.get_credentials()
+
+    def get_credentials(self, prompt=True):
+        '''
+        Returns (username, password), read once; prompts for them if they are not in .netrc and prompt is True.
+        '''
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = netrc_credentials(self.netrc_path, self.urs, prompt=prompt)
+            return self._credentials
+
+    def activate(self):
+        '''
+        Applies the GDAL options process-wide through environment variables, for interactive sessions that read
+        lazily outside any rasterio_env() block. Library code uses remote_env() instead; nothing calls this.
+        '''
+        for key, value in self.gdal_options.items():
+            os.environ[key] = str(value)
+        return self
+
+    def rasterio_env(self):
+        '''
+        Returns a rasterio.Env carrying the session's GDAL options, for scoped use instead of activate().
+        '''
+        import rasterio
+        return rasterio.Env(**self.gdal_options)
+
+    # ---------------------------------------- async HTTP ---------------------------------------- #
+    async def __aenter__(self):
+        await self._http_session()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _bind_loop(self):
+        '''
+        Creates the semaphore and HTTP session for the running event loop; asyncio objects belong to one loop.
+        An open HTTP session of the previous loop is closed on that loop if it still runs in another thread;
+        a session whose loop has stopped can no longer be closed, which is reported.
+        '''
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            stale, stale_loop = self._http, self._loop
+            if stale is not None and not stale.closed:
+                if stale_loop.is_running():
+                    asyncio.run_coroutine_threadsafe(stale.close(), stale_loop)
+                else:
+                    warnings.warn("EarthdataSession: the HTTP session of a finished event loop was left open; "
+                                  "use 'async with' or await close() before the loop ends.", ResourceWarning)
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+            self._http = None
+
+    async def _http_session(self):
+        import aiohttp
+
+        self._bind_loop()
+        if self._http is None or self._http.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self._http = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.CookieJar(unsafe=True))
+        return self._http
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    async def fetch(self, url, byte_range=None, max_redirects=10):
+        '''
+        Returns the body of url, following the Earthdata login redirects with the session's credentials.
+        Once the login host sets its cookie, later requests on the session go straight to the data.
+                Parameters:
+                        url (str): Asset url
+                        byte_range (tuple): Optional inclusive (start, end) byte range
+                Returns:
+                        content (bytes): Response body
+        '''
+        http = await self._http_session()
+        headers = {} if byte_range is None else {'Range': f'bytes={byte_range[0]}-{byte_range[1]}'}
+        async with self._semaphore:
+            for _ in range(max_redirects):
+                request_headers = dict(headers)
+                if urlparse(url).netloc == self.urs:
+                    # Read in a thread and never prompt, so the event loop is not blocked on .netrc or stdin
+                    username, password = await asyncio.to_thread(self.get_credentials, False)
+                    token = base64.b64encode(f'{username}:{password}'.encode()).decode()
+                    request_headers['Authorization'] = f'Basic {token}'
+                async with http.get(url, headers=request_headers, allow_redirects=False) as response:
+                    if response.status in (301, 302, 303, 307, 308):
+                        url = urljoin(str(response.url), response.headers['Location'])
+                        continue
+                    response.raise_for_status()
+                    return await response.read()
+        raise Exception(f"Too many redirects for {url}.")
+
+    # ---------------------------------------- asset reads ---------------------------------------- #
+    def read(self, href, band=1, window=None):
+        '''
+        Returns one band of a raster asset as a numpy array, read under the session's GDAL options.
+        '''
+        import rasterio
+
+        with self.rasterio_env():
+            with rasterio.open(href) as src:
+                return src.read(band, window=window)
+
+    async def read_async(self, href, band=1, window=None):
+        self._bind_loop()
+        async with self._semaphore:
+            return await asyncio.to_thread(self.read, href, band, window)
+
+    async def read_many_async(self, hrefs, band=1, window=None):
+        '''
+        Reads many assets concurrently; GDAL releases the GIL during I/O, so reads overlap in threads.
+        '''
+        return await asyncio.gather(*(self.read_async(href, band, window) for href in hrefs))
+
+    def read_many(self, hrefs, band=1, window=None):
+        '''
+        Synchronous wrapper of read_many_async. In a notebook, whose event loop is already running, prefer
+        'await session.read_many_async(hrefs)'; called from a running loop, this runs the reads on a new loop in a
+        worker thread and blocks until they finish.
+        '''
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.read_many_async(hrefs, band, window))
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            return pool.submit(asyncio.run, self.read_many_async(hrefs, band, window)).result()
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session(**kwargs):
+    '''
+    Returns the process-wide EarthdataSession, created on first use with kwargs; later kwargs are ignored.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = EarthdataSession(**kwargs)
+        elif kwargs:
+            warnings.warn(f"get_session: the session already exists, so {sorted(kwargs)} are ignored.")
+        return _session
+
+def is_remote(href):
+    return str(href).startswith(('http://', 'https://', '/vsicurl/'))
+
+def remote_env(hrefs):
+    '''
+    Returns the shared session's rasterio.Env if any href is remote, or a no-op context for local files.
+            Parameters:
+                    hrefs (str or list): Paths or urls about to be read
+            Returns:
+                    env (context manager): Open and read the rasters, including lazy arrays, inside it
+    '''
+    hrefs = [hrefs] if isinstance(hrefs, str) else list(hrefs)
+    if any(is_remote(href) for href in hrefs):
+        return get_session().rasterio_env()
+    return contextlib.nullcontext()
@@ -0,0 +1,278 @@
+# Library Imports
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from scipy import ndimage
+from shapely.geometry import shape
+
+from modules.dist_utils import DIST_BANDS, DIST_REF_DATE
+from modules.figure_and_boundingboxes import astar_regions
+from modules.granule_table import GranuleTable, filter_granules, granule_frame, newest_per_tile, stac_items
+from modules.instrumentation import instrumentation
+from modules.stack_bands import stack_bands
+
+# Equal-area CRS used to measure merged candidates
+AREA_CRS = 'EPSG:6933'
+
+def dissolve_candidates(candidates):
+    '''
+    Returns one candidate per disturbed patch. Overlapping A* regions clip the same patches from a tile, so
+    candidates of the same MGRS tile and first disturbance date whose polygons overlap are merged before
+    scoring; disjoint patches stay separate. The geometry is the union, area is measured on the union (so
+    overlaps count once), mean_anom is area weighted and region and exceedance are the earliest.
+            Parameters:
+                    candidates (GeoDataFrame): Per-region candidates (EPSG:4326) from detect_region with 'region'
+            Returns:
+                    candidates (GeoDataFrame): Merged candidates with the same columns
+    '''
+    columns = list(candidates.columns)
+    candidates = candidates.assign(anom_area=candidates['mean_anom'] * candidates['area_m2'])
+
+    # Each candidate is one connected patch, so it lies in exactly one part of its group's union
+    patch = np.empty(len(candidates), dtype='int64')
+    patches = 0
+    for rows in candidates.groupby(['tile', 'first_dist_date']).indices.values():
+        geoms = candidates.geometry.values[rows]
+        parts = shapely.get_parts(shapely.union_all(geoms))
+        query, part = shapely.STRtree(parts).query(shapely.point_on_surface(geoms), predicate='intersects')
+        first = np.unique(query, return_index=True)[1]
+        patch[rows[query[first]]] = patches + part[first]
+        patches += len(parts)
+
+    merged = candidates.assign(patch=patch).dissolve(by=['tile', 'first_dist_date', 'patch'], as_index=False,
+                                                     aggfunc={'granule': 'first', 'max_status': 'max',
+                                                              'anom_area': 'sum', 'area_m2': 'sum',
+                                                              'exceedance': 'min', 'region': 'min'})
+    merged['mean_anom'] = merged['anom_area'] / merged['area_m2']
+    merged['area_m2'] = merged.geometry.to_crs(AREA_CRS).area
+    merged['lead_days'] = (merged['first_dist_date'] - merged['exceedance']).dt.days
+    return merged[columns]
+
+class LandslideEventDetector:
+    '''
+    Fuses A* hazard regions with OPERA DIST-ALERT disturbance to produce ranked candidate landslide polygons.
+    For each region the detector searches DIST-ALERT granules between the A* exceedance and the end of the
+    search window, reads the most recent granule of each MGRS tile (VEG-DIST-DATE is cumulative, so older
+    granules of the same tile add nothing) and keeps disturbed pixels first detected after the exceedance.
+    Regions run concurrently and share the STAC client and the granule cache, so a tile covering several
+    regions is read once while it stays among the granule_cache_size most recently used granules. With
+    granule_table set, search results are also appended to that GranuleTable (see modules/granule_table.py).
+    '''
+    def __init__(self, stac_url='https://cmr.earthdata.nasa.gov/cloudstac/LPCLOUD/',
+                 collections=('OPERA_L3_DIST-ALERT-HLS_V1',), overlap_threshold=0, cloud_cover_threshold=20,
+                 anom_threshold=0, min_pixels=3, max_workers=4, granule_table=None, granule_cache_size=4):
+        from pystac_client import Client
+        self.client = Client.open(stac_url)
+        self.collections = list(collections)
+        self.overlap_threshold = overlap_threshold
+        self.cloud_cover_threshold = cloud_cover_threshold
+        self.anom_threshold = anom_threshold
+        self.min_pixels = min_pixels
+        self.max_workers = max_workers
+        self.granule_table = GranuleTable(granule_table) if isinstance(granule_table, str) else granule_table
+        self.granule_cache_size = granule_cache_size
+        self._granules = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, cache, key, func, *args):
+        '''
+        Returns func(*args) from cache, computing it once even when several regions ask at the same time.
+        '''
+        with self._lock:
+            entry = cache.get(key)
+            owner = entry is None
+            if owner:
+                entry = cache[key] = Future()
+            cache.move_to_end(key)
+            # Full-tile cubes are large, so only the most recently used are kept; callers hold their own Future
+            while len(cache) > self.granule_cache_size:
+                cache.popitem(last=False)
+        instrumentation.cache_hit(not owner)
+        if owner:
+            try:
+                entry.set_result(func(*args))
+            except Exception as e:
+                entry.set_exception(e)
+        return entry.result()
+
+    def search(self, aoi, start_date, stop_date):
+        '''
+        Returns the newest DIST-ALERT item per MGRS tile that passes the overlap and cloud cover filters.
+                Parameters:
+                        aoi (shapely geometry): Area of interest in EPSG:4326
+                        start_date (datetime): Start of the search window
+                        stop_date (datetime): End of the search window
+                Returns:
+                        items (list): STAC item dicts, one per tile
+        '''
+        search = self.client.search(collections=self.collections, intersects=aoi.__geo_interface__,
+                                    datetime=[start_date, stop_date], limit=50, max_items=1000)
+        granules = granule_frame(search.items())
+        if self.granule_table is not None:
+            with self._lock:
+                self.granule_table.append(granules)
+        granules = filter_granules(granules, aoi, max_cloud=self.cloud_cover_threshold,
+                                   min_overlap=self.overlap_threshold)
+        return stac_items(newest_per_tile(granules))
+
+    def load_granule(self, item):
+        '''
+        Returns the stacked DIST-ALERT bands and CRS for an item, read once per detector.
+        '''
+        return self._cached(self._granules, item['id'], stack_bands, item, DIST_BANDS)
+
+    def granule_candidates(self, item, region, exceedance, stop_date):
+        '''
+        Returns candidate polygons for one granule clipped to one region.
+                Parameters:
+                        item (dict): DIST-ALERT STAC item
+                        region (GeoSeries row): A* region with geometry and bounding box
+                        exceedance (datetime64): First A* exceedance in the region
+                        stop_date (datetime): Last disturbance date to keep
+                Returns:
+                        candidates (GeoDataFrame): One row per connected disturbed patch (EPSG:4326)
+        '''
+        from affine import Affine
+        from rasterio import features
+
+        cube, crs = self.load_granule(item)
+        minx, miny, maxx, maxy = gpd.GeoSeries([region.geometry], crs='EPSG:4326').to_crs(crs).total_bounds
+
+        xs = cube['longitude'].values
+        ys = cube['latitude'].values
+        x_idx = np.nonzero((xs >= minx) & (xs <= maxx))[0]
+        y_idx = np.nonzero((ys >= miny) & (ys <= maxy))[0]
+        if x_idx.size < 2 or y_idx.size < 2:
+            return gpd.GeoDataFrame(geometry=[], crs='EPSG:4326')
+
+        sub = cube.z.isel(longitude=x_idx, latitude=y_idx)
+        anom = sub.sel(band=1).values
+        date = sub.sel(band=2).values
+        status = sub.sel(band=3).values
+
+        first_day = (pd.Timestamp(exceedance) - DIST_REF_DATE).days
+        last_day = (pd.Timestamp(stop_date) - DIST_REF_DATE).days
+        mask = ((date >= first_day) & (date <= last_day) & (status != 0) & (status != 255)
+                & (anom > self.anom_threshold) & (anom <= 100))
+
+        labels, count = ndimage.label(mask)
+        if count == 0:
+            return gpd.GeoDataFrame(geometry=[], crs='EPSG:4326')
+
+        # Per-patch statistics in one pass over the labels
+        index = np.arange(1, count + 1)
+        pixels = ndimage.sum_labels(mask, labels, index)
+        mean_anom = ndimage.mean(anom, labels, index)
+        first_date = ndimage.minimum(date, labels, index)
+        max_status = ndimage.maximum(status, labels, index)
+
+        x_sub = xs[x_idx]
+        y_sub = ys[y_idx]
+        dx = x_sub[1] - x_sub[0]
+        dy = y_sub[1] - y_sub[0]
+        transform = Affine.translation(x_sub[0] - dx / 2, y_sub[0] - dy / 2) * Affine.scale(dx, dy)
+
+        geoms = {}
+        for geom, value in features.shapes(labels.astype('int32'), mask=mask, transform=transform):
+            geoms.setdefault(int(value), []).append(shape(geom))
+
+        rows = []
+        pixel_area = abs(dx * dy)
+        for label in index:
+            if pixels[label - 1] < self.min_pixels:
+                continue
+            patch = gpd.GeoSeries(geoms[label], crs=crs).unary_union
+            rows.append({
+                'tile': item['id'].split('_')[3],
+                'granule': item['id'],
+                'first_dist_date': DIST_REF_DATE + pd.Timedelta(days=int(first_date[label - 1])),
+                'max_status': int(max_status[label - 1]),
+                'mean_anom': float(mean_anom[label - 1]),
+                'area_m2': float(pixels[label - 1] * pixel_area),
+                'geometry': patch,
+            })
+        if not rows:
+            return gpd.GeoDataFrame(geometry=[], crs='EPSG:4326')
+        return gpd.GeoDataFrame(rows, geometry='geometry', crs=crs).to_crs('EPSG:4326')
+
+    def detect_region(self, region, stop_date):
+        '''
+        Returns candidate polygons for one A* region, from its exceedance to stop_date.
+        '''
+        exceedance = pd.Timestamp(region.exceedance)
+        items = self.search(region.geometry, exceedance.to_pydatetime(), pd.Timestamp(stop_date).to_pydatetime())
+        frames = [self.granule_candidates(item, region, exceedance, stop_date) for item in items]
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return gpd.GeoDataFrame(geometry=[], crs='EPSG:4326')
+        candidates = pd.concat(frames, ignore_index=True)
+        candidates['exceedance'] = exceedance
+        candidates['lead_days'] = (candidates['first_dist_date'] - exceedance).dt.days
+        return candidates
+
+    def detect(self, astar, beginning_date, end_date, threshold, lag_days=30, output_dir=None):
+        '''
+        Returns ranked candidate landslide polygons for a storm.
+                Parameters:
+                        astar (xarray DataArray): A* prism
+                        beginning_date (str or datetime64): Storm beginning date
+                        end_date (str or datetime64): Storm ending date
+                        threshold (float): A* hazard threshold
+                        lag_days (int): Days after end_date to keep looking for disturbance
+                        output_dir (str): If given, candidates are written to landslide_candidates.geojson
+                Returns:
+                        candidates (GeoDataFrame): Candidate polygons (EPSG:4326) sorted by score, with 'rank' and
+                                                   'region' columns. score = area_m2 * mean_anom / 100, doubled
+                                                   for confirmed disturbance (status 2 or 4).
+        '''
+        regions, _ = astar_regions(astar, beginning_date, end_date, threshold)
+        regions['storm_end'] = pd.Timestamp(end_date)
+        return self.detect_regions(regions, lag_days=lag_days, output_dir=output_dir)
+
+    def detect_regions(self, regions, lag_days=30, output_dir=None):
+        '''
+        Returns ranked candidate landslide polygons for A* regions, e.g. from astar_regions or RegionStore.query.
+                Parameters:
+                        regions (GeoDataFrame): Regions (EPSG:4326) with 'exceedance' and 'storm_end' columns
+                        lag_days (int): Days after each region's storm_end to keep looking for disturbance
+                        output_dir (str): If given, candidates are written to landslide_candidates.geojson
+                Returns:
+                        candidates (GeoDataFrame): As for detect, overlapping duplicates merged
+                                                   (see dissolve_candidates)
+        '''
+        regions = regions[regions['exceedance'].notna()]
+        print(f"Searching DIST-ALERT for {len(regions)} A* regions")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {index: pool.submit(self.detect_region, region,
+                                          pd.Timestamp(region.storm_end) + pd.Timedelta(days=lag_days))
+                       for index, region in regions.iterrows()}
+
+        frames = []
+        for index, future in futures.items():
+            frame = future.result()
+            if not frame.empty:
+                frame['region'] = index
+                frames.append(frame)
+        if not frames:
+            print("No candidate disturbance found.")
+            return gpd.GeoDataFrame(geometry=[], crs='EPSG:4326')
+
+        candidates = dissolve_candidates(pd.concat(frames, ignore_index=True))
+        confirmed = candidates['max_status'].isin([2, 4])
+        candidates['score'] = candidates['area_m2'] * candidates['mean_anom'] / 100 * np.where(confirmed, 2.0, 1.0)
+        candidates = candidates.sort_values(by='score', ascending=False).reset_index(drop=True)
+        candidates['rank'] = np.arange(1, len(candidates) + 1)
+
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+            output_file = os.path.join(output_dir, 'landslide_candidates.geojson')
+            candidates.to_file(output_file, driver='GeoJSON')
+            print(f"Candidates saved to {output_file}")
+
+        return candidates
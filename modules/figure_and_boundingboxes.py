@@ -3,12 +3,28 @@ import os
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 from shapely.geometry import Polygon, box, MultiPolygon
 from skimage import measure
-import matplotlib.pyplot as plt
 import xarray as xr
 
-def fig_boundingboxes(astar, beginning_date, end_date, threshold, output_dir, california_shapefile):
+from modules.instrumentation import instrumentation, instrumented
+
+@instrumented('astar_regions')
+def astar_regions(astar, beginning_date, end_date, threshold):
+    '''
+    Returns the A* hazard regions for a storm window.
+            Parameters:
+                    astar (xarray DataArray): A* prism with a 'time' coordinate along 'z'
+                    beginning_date (str or datetime64): Storm beginning date
+                    end_date (str or datetime64): Storm ending date
+                    threshold (float): A* value that defines a hazard region
+            Returns:
+                    regions (GeoDataFrame): Contour polygons (EPSG:4326), in contour order, with their bounding box,
+                                            bounding box area and the first time any pixel inside the polygon
+                                            reached the threshold ('exceedance')
+                    astar_storm_max (xarray DataArray): Maximum A* over the storm window
+    '''
     # Get the latitude and longitude values
     lats = astar['latitude'].values
     lons = astar['longitude'].values
@@ -46,22 +62,46 @@ def fig_boundingboxes(astar, beginning_date, end_date, threshold, output_dir, ca
         if poly_coords.shape[0] >= 3:  # Ensure there are at least 3 points to form a polygon
             polygons.append(Polygon(poly_coords))
 
+    # Create a table for bounding box coordinates, areas and the first exceedance inside each polygon
+    storm_times = astar_storm['time'].values
+    rows = []
+    for polygon in polygons:
+        minx, miny, maxx, maxy = polygon.bounds
+        area = (maxx - minx) * (maxy - miny)
+        lat_idx = np.nonzero((lats >= miny) & (lats <= maxy))[0]
+        lon_idx = np.nonzero((lons >= minx) & (lons <= maxx))[0]
+        # Pixel centres on the contour count as inside, since the contour runs through them
+        inside = xr.DataArray(shapely.intersects_xy(polygon, *np.meshgrid(lons[lon_idx], lats[lat_idx])),
+                              dims=('latitude', 'longitude'))
+        window = astar_storm.isel(latitude=lat_idx, longitude=lon_idx)
+        peak = window.where(inside).max(dim=['latitude', 'longitude']).values
+        hits = np.nonzero(peak >= threshold)[0]
+        exceedance = storm_times[hits[0]] if hits.size else np.datetime64('NaT')
+        rows.append({'min_lon': minx, 'min_lat': miny, 'max_lon': maxx, 'max_lat': maxy, 'area': area,
+                     'exceedance': exceedance, 'geometry': polygon})
+
+    columns = ['min_lon', 'min_lat', 'max_lon', 'max_lat', 'area', 'exceedance', 'geometry']
+    regions = gpd.GeoDataFrame(pd.DataFrame(rows, columns=columns), geometry='geometry', crs='EPSG:4326')
+
+    return regions, astar_storm_max
+
+@instrumented('fig_boundingboxes')
+def fig_boundingboxes(astar, beginning_date, end_date, threshold, output_dir, california_shapefile):
+    # Get the latitude and longitude values
+    lats = astar['latitude'].values
+    lons = astar['longitude'].values
+
+    # Extract the hazard regions over the storm window
+    regions, astar_storm_max = astar_regions(astar, beginning_date, end_date, threshold)
+    polygons = list(regions.geometry)
+
     # Create bounding boxes for each polygon
     bounding_boxes = [polygon.bounds for polygon in polygons]
     bbox_polygons = [box(*bbox) for bbox in bounding_boxes]
 
-    # Create a table for bounding box coordinates and calculate areas
-    bbox_coords = []
-    for bbox in bounding_boxes:
-        minx, miny, maxx, maxy = bbox
-        area = (maxx - minx) * (maxy - miny)
-        bbox_coords.append({'min_lon': minx, 'min_lat': miny, 'max_lon': maxx, 'max_lat': maxy, 'area': area})
-
-    # Convert to DataFrame and sort by area in descending order
-    bbox_df = pd.DataFrame(bbox_coords)
-    bbox_df_sorted = bbox_df.sort_values(by='area', ascending=False).reset_index(drop=True)
-
-    # Remove the area column before saving to CSV
+    # Sort the bounding boxes by area in descending order and remove the area column before saving to CSV
+    bbox_df_sorted = pd.DataFrame(regions[['min_lon', 'min_lat', 'max_lon', 'max_lat', 'area']])
+    bbox_df_sorted = bbox_df_sorted.sort_values(by='area', ascending=False).reset_index(drop=True)
     bbox_df_sorted = bbox_df_sorted.drop(columns=['area'])
 
     # Save the bounding box coordinates to a CSV file
@@ -82,11 +122,15 @@ def fig_boundingboxes(astar, beginning_date, end_date, threshold, output_dir, ca
     # Save the polygons and bounding boxes to GeoJSON files
     gdf_polygons.to_file(output_file_polygons, driver='GeoJSON')
     gdf_bboxes.to_file(output_file_bboxes, driver='GeoJSON')
+    for written in (bbox_csv_file, output_file_polygons, output_file_bboxes):
+        instrumentation.wrote_file(written)
 
     print(f"Polygons saved to {output_file_polygons}")
     print(f"Bounding boxes saved to {output_file_bboxes}")
     print(f"Bounding box coordinates saved to {bbox_csv_file}")
 
+    import matplotlib.pyplot as plt
+
     # Load the California boundary polygon
     gdf_california = gpd.read_file(california_shapefile)
 
@@ -0,0 +1,190 @@
+'''
+Columnar table of OPERA granule metadata with GeoParquet persistence.
+
+STAC search results are flattened once into typed columns: granule and tile IDs, sensor, acquisition
+time, footprint (stored as WKB by GeoParquet), cloud cover and one href column per band. Tables from
+successive searches are appended to a store on disk, and filtering by date, tile, sensor, cloud cover and
+AOI overlap is a set of vectorized column comparisons, so reads of OPERA granules start from the table
+instead of a fresh search.
+
+Example usage:
+    granules = GranuleTable('OPERA_Exports/granules')
+    granules.append(api.search(collections=collections, intersects=aoi.__geo_interface__).items())
+    dist_data_df = granules.search(aoi, '2023-01-01', '2023-03-30', max_cloud=20, min_overlap=20)
+    da, crs = stack_bands(stac_item(dist_data_df.iloc[0]), ['VEG-ANOM-MAX', 'VEG-DIST-DATE', 'VEG-DIST-STATUS'])
+'''
+# Library Imports
+import os
+import glob
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+GRANULE_COLUMNS = ['granule_id', 'collection', 'tile_id', 'sensor', 'datetime', 'cloud_cover', 'geometry']
+HREF_PREFIX = 'href_'
+
+def asset_band(key):
+    '''
+    Returns the band name of a STAC asset key (e.g. 'VEG-DIST-STATUS' from '..._VEG-DIST-STATUS.tif').
+    '''
+    return os.path.splitext(key.rsplit('_', 1)[-1])[0]
+
+def granule_frame(items):
+    '''
+    Returns one row per STAC item with typed metadata columns and one href column per band.
+            Parameters:
+                    items (iterable): pystac Items or STAC item dicts
+            Returns:
+                    granules (GeoDataFrame): GRANULE_COLUMNS plus href_<band> columns (EPSG:4326)
+    '''
+    items = [item.to_dict() if hasattr(item, 'to_dict') else item for item in items]
+    hrefs = {}
+    for i, item in enumerate(items):
+        for key, asset in item['assets'].items():
+            hrefs.setdefault(HREF_PREFIX + asset_band(key), [None] * len(items))[i] = asset['href']
+
+    ids = pd.Series([item['id'] for item in items], dtype=object)
+    # IDs look like OPERA_L3_DIST-ALERT-HLS_T10SGD_20230105T184741Z_20230110T071812Z_S2A_30_v1
+    parts = (ids.str.split('_', expand=True) if len(ids) else pd.DataFrame()).reindex(columns=range(7)).astype(object)
+    # STAC datetimes vary in precision (with or without fractional seconds), so no format is inferred
+    times = pd.to_datetime(pd.Series([item['properties'].get('datetime') for item in items], dtype=object), utc=True,
+                           format='ISO8601')
+    frame = pd.DataFrame({
+        'granule_id': ids,
+        'collection': pd.Series([item.get('collection') for item in items], dtype=object),
+        'tile_id': parts[3],
+        'sensor': parts[6],
+        'datetime': times.dt.tz_convert(None).astype('datetime64[ns]'),
+        'cloud_cover': pd.Series([item['properties'].get('eo:cloud_cover') for item in items], dtype='float32'),
+    })
+    for column, values in sorted(hrefs.items()):
+        frame[column] = values
+    geometry = gpd.GeoSeries([shapely.geometry.shape(item['geometry']) for item in items], crs='EPSG:4326')
+    return gpd.GeoDataFrame(frame, geometry=geometry)
+
+def _utc(value):
+    '''
+    Returns a timestamp as naive UTC, the convention of the 'datetime' column.
+    '''
+    value = pd.Timestamp(value)
+    return value.tz_convert(None) if value.tzinfo is not None else value
+
+def overlap_percent(granules, aoi):
+    '''
+    Returns the percentage of the AOI covered by each granule footprint, as intersection_percent.
+    '''
+    return shapely.area(shapely.intersection(granules.geometry.values, aoi)) * 100 / aoi.area
+
+def filter_granules(granules, aoi=None, start=None, end=None, tiles=None, sensors=None, max_cloud=None,
+                    min_overlap=None):
+    '''
+    Returns the granules matching every given filter, with an 'overlap' column when an AOI is given.
+            Parameters:
+                    granules (GeoDataFrame): Output of granule_frame or GranuleTable.table
+                    aoi (shapely geometry or bounds tuple): Area of interest in EPSG:4326
+                    start, end (str or datetime): Acquisition time range (inclusive)
+                    tiles (list): MGRS tile IDs (e.g. ['T10SGD'])
+                    sensors (list): Sensors (e.g. ['S2A', 'L9'])
+                    max_cloud (float): Drop cloud cover at or above this percentage (unknown cover is kept)
+                    min_overlap (float): Keep AOI overlap strictly above this percentage
+            Returns:
+                    granules (GeoDataFrame): Matching rows sorted by acquisition time
+    '''
+    keep = np.ones(len(granules), dtype=bool)
+    if start is not None:
+        keep &= (granules['datetime'] >= _utc(start)).values
+    if end is not None:
+        keep &= (granules['datetime'] <= _utc(end)).values
+    if tiles is not None:
+        keep &= granules['tile_id'].isin(list(tiles)).values
+    if sensors is not None:
+        keep &= granules['sensor'].isin(list(sensors)).values
+    if max_cloud is not None:
+        keep &= ~(granules['cloud_cover'] >= max_cloud).values
+    granules = granules[keep]
+    if aoi is not None:
+        if isinstance(aoi, (tuple, list)):
+            aoi = shapely.box(*aoi)
+        granules = granules[shapely.intersects(granules.geometry.values, aoi)]
+        granules = granules.assign(overlap=overlap_percent(granules, aoi))
+        if min_overlap is not None:
+            granules = granules[granules['overlap'] > min_overlap]
+    return granules.sort_values(['datetime', 'granule_id'])
+
+def newest_per_tile(granules):
+    '''
+    Returns the most recent granule of each MGRS tile (VEG-DIST-DATE is cumulative, so older ones add nothing).
+    '''
+    return granules.sort_values('datetime').drop_duplicates('tile_id', keep='last').sort_values('tile_id')
+
+def stac_item(row):
+    '''
+    Returns a minimal STAC item dict for a table row, accepted by stack_bands and dist_lazy.process_tiles.
+    '''
+    assets = {column[len(HREF_PREFIX):]: {'href': href} for column, href in row.items()
+              if column.startswith(HREF_PREFIX) and isinstance(href, str)}
+    return {'id': row['granule_id'], 'collection': row['collection'], 'assets': assets,
+            'geometry': shapely.geometry.mapping(row['geometry']),
+            'properties': {'datetime': pd.Timestamp(row['datetime']).isoformat() + 'Z',
+                           'eo:cloud_cover': float(row['cloud_cover'])}}
+
+def stac_items(granules):
+    return [stac_item(row) for _, row in granules.iterrows()]
+
+class GranuleTable:
+    '''
+    Granule metadata appended across searches, stored as GeoParquet part files under one directory.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.parts_dir = os.path.join(path, 'parts')
+        os.makedirs(self.parts_dir, exist_ok=True)
+        self.table = self._read_parts()
+
+    def __len__(self):
+        return len(self.table)
+
+    def _read_parts(self):
+        parts = [gpd.read_parquet(path) for path in sorted(glob.glob(os.path.join(self.parts_dir, '*.parquet')))]
+        if not parts:
+            return granule_frame([])
+        table = pd.concat(parts, ignore_index=True).drop_duplicates('granule_id', keep='last')
+        return table.sort_values(['datetime', 'granule_id']).reset_index(drop=True)
+
+    def append(self, items):
+        '''
+        Adds granules not already in the table.
+                Parameters:
+                        items (iterable or GeoDataFrame): pystac Items, STAC item dicts or a granule_frame
+                Returns:
+                        added (int): Number of new granules
+        '''
+        frame = items if isinstance(items, gpd.GeoDataFrame) else granule_frame(items)
+        frame = frame[~frame['granule_id'].isin(self.table['granule_id'])].drop_duplicates('granule_id')
+        if frame.empty:
+            return 0
+        key = hashlib.sha1('|'.join(sorted(frame['granule_id'])).encode()).hexdigest()[:16]
+        part_path = os.path.join(self.parts_dir, f'{key}.parquet')
+        tmp_path = part_path + '.tmp'
+        frame.to_parquet(tmp_path)
+        os.replace(tmp_path, part_path)
+
+        table = pd.concat([self.table, frame], ignore_index=True) if len(self.table) else frame
+        self.table = table.sort_values(['datetime', 'granule_id']).reset_index(drop=True)
+        return len(frame)
+
+    def search(self, aoi=None, start=None, end=None, tiles=None, sensors=None, max_cloud=None, min_overlap=None):
+        '''
+        Returns stored granules matching the filters (see filter_granules).
+        '''
+        return filter_granules(self.table, aoi, start, end, tiles, sensors, max_cloud, min_overlap)
+
+    def tiles(self):
+        '''
+        Returns one row per MGRS tile with its granule count and first and last acquisition times.
+        '''
+        return (self.table.groupby('tile_id')
+                .agg(granules=('granule_id', 'size'), first=('datetime', 'min'), last=('datetime', 'max'))
+                .reset_index())
@@ -0,0 +1,235 @@
+'''
+Reprojection-free alignment of 30 m OPERA DIST-ALERT tiles with the A* (QPE) grid.
+
+For each MGRS tile, the A* cell holding every pixel centre is found once and stored as an int32 index
+array (compressed .npz, keyed by the tile grid and the A* grid). After that, per-pixel A* values are an
+integer gather (grid.ravel()[cell]) and disturbance statistics per A* cell are one bincount over the same
+indices, so neither raster is reprojected and the join can run for every new granule.
+
+Example usage:
+    alignment = tile_alignment('T10SGD', x, y, 'EPSG:32610', astar['latitude'], astar['longitude'],
+                               cache_dir='alignment_cache')
+    astar_30m = alignment.lookup(storm_max)                  # A* at each tile pixel, (len(y), len(x))
+    stats = granule_cell_stats(stac_item, astar['latitude'], astar['longitude'], '2023-01-01', '2023-01-25',
+                               astar=storm_max, cache_dir='alignment_cache')
+'''
+# Library Imports
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+from modules.instrumentation import instrumentation, instrumented
+from modules.regrid import grid_hash, nearest_index
+
+STATUS_CLASSES = 5
+# A 3660 x 3660 tile index is about 50 MB, so only the most recently used are kept in memory;
+# the .npz files in cache_dir are the durable cache
+MEMORY_CACHE_SIZE = 4
+_alignment_cache = OrderedDict()
+_alignment_lock = threading.Lock()
+
+class TileAlignment:
+    '''
+    Index from the pixels of one projected tile to the cells of a rectilinear latitude/longitude grid.
+            Parameters:
+                    tile_id (str): MGRS tile ID (e.g. 'T10SGD')
+                    cell (numpy array): int32 (rows, cols) flat grid cell of each pixel, -1 outside the grid
+                    grid_shape (tuple): (latitudes, longitudes) of the grid
+                    crs (str): CRS of the tile
+    '''
+    def __init__(self, tile_id, cell, grid_shape, crs):
+        self.tile_id = tile_id
+        self.cell = np.asarray(cell, dtype='int32')
+        self.grid_shape = tuple(int(n) for n in grid_shape)
+        self.crs = str(crs)
+
+    @classmethod
+    def build(cls, tile_id, x, y, crs, lats, lons, block_rows=512):
+        '''
+        Returns the alignment of a tile with pixel centres x, y (tile CRS) to the grid lats, lons (EPSG:4326).
+        Pixel centres are transformed in blocks of rows to keep memory bounded.
+        '''
+        from modules.dist_utils import get_transformer
+
+        x = np.asarray(x, dtype='float64')
+        y = np.asarray(y, dtype='float64')
+        lats = np.asarray(lats, dtype='float64')
+        lons = np.asarray(lons, dtype='float64')
+        transformer = get_transformer(str(crs), 'EPSG:4326')
+        cell = np.empty((len(y), len(x)), dtype='int32')
+        for start in range(0, len(y), block_rows):
+            xx, yy = np.meshgrid(x, y[start:start + block_rows])
+            pixel_lons, pixel_lats = transformer.transform(xx, yy)
+            cell[start:start + len(xx)] = nearest_index(lats, lons, pixel_lats.ravel(), pixel_lons.ravel()).reshape(xx.shape)
+        return cls(tile_id, cell, (len(lats), len(lons)), crs)
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, cell=self.cell, grid_shape=np.asarray(self.grid_shape),
+                            tile_id=np.asarray(self.tile_id), crs=np.asarray(self.crs))
+        os.replace(tmp_path, path)
+        instrumentation.wrote_file(path)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as saved:
+            return cls(str(saved['tile_id']), saved['cell'], saved['grid_shape'], str(saved['crs']))
+
+    @property
+    def cells(self):
+        '''
+        Returns the flat grid cells the tile covers.
+        '''
+        return np.unique(self.cell[self.cell >= 0])
+
+    def lookup(self, grid, fill=np.nan):
+        '''
+        Returns grid values at every tile pixel.
+                Parameters:
+                        grid (numpy array or DataArray): (..., latitudes, longitudes) field on the aligned grid
+                        fill (float): Value for pixels outside the grid
+                Returns:
+                        values (numpy array): (..., rows, cols) of the tile
+        '''
+        grid = np.asarray(grid)
+        if grid.shape[-2:] != self.grid_shape:
+            raise Exception(f"Invalid value for 'grid'. Its last two dims should be {self.grid_shape}.")
+        flat = grid.reshape(grid.shape[:-2] + (-1,))
+        outside = self.cell < 0
+        values = np.take(flat, np.where(outside, 0, self.cell), axis=-1)
+        if outside.any():
+            values = values.astype(np.result_type(values.dtype, np.asarray(fill).dtype))
+            values[..., outside] = fill
+        return values
+
+    def zonal(self, values, stat='mean', where=None):
+        '''
+        Returns a statistic of tile pixel values for every grid cell.
+                Parameters:
+                        values (numpy array): (rows, cols) pixel values of the tile
+                        stat (str): 'count', 'sum', 'mean' or 'max' over the valid pixels of each cell
+                        where (numpy array): Optional boolean (rows, cols) mask of the pixels to use
+                Returns:
+                        grid (numpy array): (latitudes, longitudes), nan (0 for 'count') where a cell has no pixels
+        '''
+        if stat not in ('count', 'sum', 'mean', 'max'):
+            raise Exception("Invalid value for 'stat'. It should be 'count', 'sum', 'mean' or 'max'.")
+        values = np.asarray(values)
+        valid = self.cell >= 0
+        if where is not None:
+            valid &= np.asarray(where, dtype=bool)
+        if values.dtype.kind == 'f':
+            valid &= np.isfinite(values)
+        cells = self.cell[valid]
+        size = self.grid_shape[0] * self.grid_shape[1]
+        count = np.bincount(cells, minlength=size)
+        if stat == 'count':
+            return count.reshape(self.grid_shape)
+        if stat == 'max':
+            out = np.full(size, np.nan)
+            np.fmax.at(out, cells, values[valid].astype('float64'))
+            return out.reshape(self.grid_shape)
+        total = np.bincount(cells, weights=values[valid].astype('float64'), minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = total / count if stat == 'mean' else np.where(count > 0, total, np.nan)
+        return out.reshape(self.grid_shape)
+
+def tile_alignment(tile_id, x, y, crs, lats, lons, cache_dir=None):
+    '''
+    Returns the TileAlignment of a tile to a grid, building and storing it on the first call.
+            Parameters:
+                    tile_id (str): MGRS tile ID
+                    x, y (array): 1-D pixel centre coordinates of the tile
+                    crs (str): CRS of the tile
+                    lats, lons (array): 1-D grid coordinates (EPSG:4326)
+                    cache_dir (str): If given, alignments are stored there as {tile}_{tile grid}_{grid}.npz
+            Returns:
+                    alignment (TileAlignment)
+    '''
+    key = f'{tile_id}_{grid_hash(x, y, crs=crs)}_{grid_hash(lats, lons)}'
+    with _alignment_lock:
+        if key in _alignment_cache:
+            _alignment_cache.move_to_end(key)
+            instrumentation.cache_hit(True)
+            return _alignment_cache[key]
+    path = None if cache_dir is None else os.path.join(cache_dir, f'{key}.npz')
+    if path is not None and os.path.exists(path):
+        alignment = TileAlignment.load(path)
+        instrumentation.cache_hit(True)
+    else:
+        instrumentation.cache_hit(False)
+        with instrumentation.stage('alignment_build', tile=tile_id):
+            alignment = TileAlignment.build(tile_id, x, y, crs, lats, lons)
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            alignment.save(path)
+    with _alignment_lock:
+        _alignment_cache[key] = alignment
+        while len(_alignment_cache) > MEMORY_CACHE_SIZE:
+            _alignment_cache.popitem(last=False)
+    return alignment
+
+def cell_disturbance(status, alignment, lats, lons, pixel_area=30 * 30):
+    '''
+    Returns per grid cell counts of a filtered VEG-DIST-STATUS tile (see dist_lazy.filter_disturbance).
+            Parameters:
+                    status (numpy array): uint8 (rows, cols) status, 0 not disturbed, 1-4 classes, 255 nodata
+                    alignment (TileAlignment): Alignment of the tile to the grid
+                    lats, lons (array): 1-D grid coordinates
+                    pixel_area (float): Area of one pixel (m2)
+            Returns:
+                    stats (DataFrame): One row per covered cell with row, col, latitude, longitude, valid pixels,
+                                       pixels per status class, disturbed pixels, area and fraction
+    '''
+    status = np.asarray(status)
+    valid = (alignment.cell >= 0) & (status < STATUS_CLASSES)
+    size = alignment.grid_shape[0] * alignment.grid_shape[1]
+    # One bincount over cell * classes + status gives every class count of every cell
+    counts = np.bincount(alignment.cell[valid].astype('int64') * STATUS_CLASSES + status[valid],
+                         minlength=size * STATUS_CLASSES).reshape(size, STATUS_CLASSES)
+    covered = np.nonzero(counts.sum(axis=1))[0]
+    counts = counts[covered]
+    rows, cols = np.divmod(covered, alignment.grid_shape[1])
+
+    stats = pd.DataFrame({'tile_id': alignment.tile_id, 'cell': covered, 'row': rows, 'col': cols,
+                          'latitude': np.asarray(lats)[rows], 'longitude': np.asarray(lons)[cols],
+                          'valid_pixels': counts.sum(axis=1)})
+    for k in range(1, STATUS_CLASSES):
+        stats[f'status_{k}'] = counts[:, k]
+    stats['disturbed_pixels'] = counts[:, 1:].sum(axis=1)
+    stats['disturbed_area_m2'] = stats['disturbed_pixels'] * pixel_area
+    stats['disturbed_fraction'] = stats['disturbed_pixels'] / stats['valid_pixels']
+    return stats
+
+@instrumented('granule_cell_stats')
+def granule_cell_stats(stac_item, lats, lons, start_date, end_date, anom_threshold=0, astar=None, cache_dir=None,
+                       pixel_area=30 * 30):
+    '''
+    Returns disturbance statistics of one DIST-ALERT granule per A* cell, without reprojecting either grid.
+            Parameters:
+                    stac_item (dict): DIST-ALERT STAC item
+                    lats, lons (array): 1-D A* grid coordinates
+                    start_date, end_date (str or datetime): Disturbance date window
+                    anom_threshold (int): Keep pixels whose VEG-ANOM-MAX is above this value
+                    astar (numpy array or DataArray): Optional (latitudes, longitudes) A* grid added as a column
+                    cache_dir (str): Alignment cache directory
+                    pixel_area (float): Area of one pixel (m2)
+            Returns:
+                    stats (DataFrame): cell_disturbance table, with 'granule' and (if given) 'astar' columns
+    '''
+    from modules.dist_lazy import filter_disturbance
+    from modules.dist_utils import DIST_BANDS
+    from modules.stack_bands import stack_bands
+
+    cube, crs = stack_bands(stac_item, DIST_BANDS)
+    status = filter_disturbance(cube, start_date, end_date, anom_threshold).values
+    alignment = tile_alignment(stac_item['id'].split('_')[3], cube['longitude'].values, cube['latitude'].values,
+                               crs, lats, lons, cache_dir)
+    stats = cell_disturbance(status, alignment, lats, lons, pixel_area)
+    stats.insert(0, 'granule', stac_item['id'])
+    if astar is not None:
+        stats['astar'] = np.asarray(astar).ravel()[stats['cell'].values]
+    return stats
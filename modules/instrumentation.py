@@ -0,0 +1,192 @@
+# Library Imports
+import os
+import json
+import time
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+class Instrumentation:
+    '''
+    Opt-in recorder of per-stage wall time, bytes read/written, cache hits and memory.
+    Disabled by default; while disabled, stage() and the instrumented decorator cost a flag check.
+
+    Example usage:
+        from modules.instrumentation import instrumentation
+        instrumentation.enable()
+        processor.process_dir_CNRFC_AWI_WY(...)
+        instrumentation.to_jsonl('metrics.jsonl')
+        print(instrumentation.to_prometheus())
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, trace_memory=False):
+        '''
+        Starts recording. trace_memory=True also tracks the Python heap peak per stage with tracemalloc
+        (slower). Every stage also records max_rss_mb, the process high-water mark (ru_maxrss) when the
+        stage ends: it never decreases over the life of the process, so it is not a peak of that stage.
+        '''
+        self.enabled = True
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.trace_memory = False
+
+    def reset(self):
+        with self._lock:
+            self.records = []
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name, **labels):
+        '''
+        Context manager that records one stage. Nested stages are recorded separately, and bytes or
+        cache events are attributed to the innermost open stage of the current thread. A stage's
+        peak_heap_mb includes the peaks of its nested stages; tracemalloc is process-wide, so stages
+        running concurrently in other threads also count towards it.
+        '''
+        if not self.enabled:
+            yield None
+            return
+        record = {'stage': name, 'labels': labels, 'bytes_read': 0, 'bytes_written': 0,
+                  'cache_hits': 0, 'cache_misses': 0}
+        stack = self._stack()
+        if self.trace_memory:
+            record['peak_heap_mb'] = 0.0
+            # Resetting the peak for this stage would lose the enclosing stage's peak so far, so carry it
+            # into the parent record first
+            if stack and 'peak_heap_mb' in stack[-1]:
+                stack[-1]['peak_heap_mb'] = max(stack[-1]['peak_heap_mb'], tracemalloc.get_traced_memory()[1] / 2**20)
+            tracemalloc.reset_peak()
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - start
+            record['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            if 'peak_heap_mb' in record:
+                # The traced peak is not reset on exit, so the parent's own reading still covers this stage
+                record['peak_heap_mb'] = max(record['peak_heap_mb'], tracemalloc.get_traced_memory()[1] / 2**20)
+            record['timestamp'] = time.time()
+            stack.pop()
+            with self._lock:
+                self.records.append(record)
+
+    def _current(self):
+        stack = self._stack() if self.enabled else None
+        return stack[-1] if stack else None
+
+    def add_bytes_read(self, nbytes):
+        record = self._current()
+        if record is not None:
+            record['bytes_read'] += int(nbytes)
+
+    def add_bytes_written(self, nbytes):
+        record = self._current()
+        if record is not None:
+            record['bytes_written'] += int(nbytes)
+
+    def read_file(self, path):
+        '''
+        Counts the size of a local file as bytes read (remote urls are ignored).
+        '''
+        if self.enabled and os.path.exists(str(path)):
+            self.add_bytes_read(os.path.getsize(path))
+
+    def wrote_file(self, path):
+        '''
+        Counts the size of a local file as bytes written.
+        '''
+        if self.enabled and os.path.exists(str(path)):
+            self.add_bytes_written(os.path.getsize(path))
+
+    def cache_hit(self, hit=True):
+        record = self._current()
+        if record is not None:
+            record['cache_hits' if hit else 'cache_misses'] += 1
+
+    def summary(self):
+        '''
+        Returns totals per stage name: count, wall time, bytes, cache events, the largest heap peak (when
+        traced) and the largest process high-water mark.
+        '''
+        totals = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            total = totals.setdefault(record['stage'], {'count': 0, 'wall_s': 0.0, 'bytes_read': 0,
+                                                        'bytes_written': 0, 'cache_hits': 0,
+                                                        'cache_misses': 0, 'peak_heap_mb': 0.0, 'max_rss_mb': 0.0})
+            total['count'] += 1
+            for key in ('wall_s', 'bytes_read', 'bytes_written', 'cache_hits', 'cache_misses'):
+                total[key] += record[key]
+            total['peak_heap_mb'] = max(total['peak_heap_mb'], record.get('peak_heap_mb', 0.0))
+            total['max_rss_mb'] = max(total['max_rss_mb'], record['max_rss_mb'])
+        return totals
+
+    def to_jsonl(self, path, append=True):
+        '''
+        Writes one JSON object per recorded stage.
+        '''
+        with self._lock:
+            records = list(self.records)
+        with open(path, 'a' if append else 'w') as f:
+            for record in records:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    def to_prometheus(self, prefix='landslide'):
+        '''
+        Returns the per-stage totals in the Prometheus text exposition format.
+        '''
+        metrics = [
+            ('stage_runs_total', 'count', 'counter', 'Number of times the stage ran'),
+            ('stage_seconds_total', 'wall_s', 'counter', 'Wall time spent in the stage'),
+            ('stage_read_bytes_total', 'bytes_read', 'counter', 'Bytes read by the stage'),
+            ('stage_written_bytes_total', 'bytes_written', 'counter', 'Bytes written by the stage'),
+            ('stage_cache_hits_total', 'cache_hits', 'counter', 'Cache hits within the stage'),
+            ('stage_cache_misses_total', 'cache_misses', 'counter', 'Cache misses within the stage'),
+            ('stage_peak_heap_megabytes', 'peak_heap_mb', 'gauge', 'Largest traced Python heap peak of the stage'),
+            ('process_max_rss_megabytes', 'max_rss_mb', 'gauge', 'Process RSS high-water mark at stage end'),
+        ]
+        totals = self.summary()
+        lines = []
+        for metric, key, kind, help_text in metrics:
+            lines.append(f'# HELP {prefix}_{metric} {help_text}')
+            lines.append(f'# TYPE {prefix}_{metric} {kind}')
+            for stage, total in sorted(totals.items()):
+                lines.append(f'{prefix}_{metric}{{stage="{stage}"}} {total[key]}')
+        return '\n'.join(lines) + '\n'
+
+# Shared recorder used by the processing modules
+instrumentation = Instrumentation()
+
+def instrumented(name):
+    '''
+    Decorator that records each call of the function as a stage.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not instrumentation.enabled:
+                return func(*args, **kwargs)
+            with instrumentation.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,437 @@
+'''
+Near-real-time A* monitor.
+
+A long-running asyncio service that polls a QPE source (a local directory or an HTTP directory listing
+such as the CNRFC netcdfqpe archive) and a STAC source (a STAC API or a local static catalog), advances
+the AWI state one QPE file at a time, extracts hazard regions whenever pixels newly cross the A*
+threshold and emits alerts as JSON files and, optionally, webhook POSTs. Every alert records the
+latency from QPE arrival to alert; latencies above max_latency_s are reported.
+
+Example usage, from the project root:
+    python -m modules.monitor monitor_config.yml
+    python -m modules.monitor monitor_config.yml --once      # process what is available and exit
+
+Example config (YAML or JSON):
+    qpe_source: incoming_qpe/              # directory, or https://www.cnrfc.noaa.gov/archive/2024/Jan/netcdfqpe/
+    stac_source: stac/catalog.json         # static catalog, or https://cmr.earthdata.nasa.gov/cloudstac/LPCLOUD/
+    state_dir: monitor_state
+    threshold: 1.1
+    field_capacity: 0.18
+    bounds: [-125, -113, 32, 43]
+    qpe_poll_seconds: 300
+    stac_poll_seconds: 3600
+    lag_days: 30                           # how long alerted regions are watched for disturbance
+    webhook: null
+    max_latency_s: 600
+    regrid_cache: .regrid_cache            # sparse recurrence -> QPE remap weights (see modules/regrid.py)
+    granule_table: null                    # optional GranuleTable directory that polled items are appended to
+    cell_stats: false                      # join each new granule with A* per cell (see modules/grid_alignment.py)
+'''
+# Library Imports
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import asyncio
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from modules.figure_and_boundingboxes import astar_regions
+from modules.granule_table import GranuleTable
+from modules.instrumentation import instrumentation
+from modules.qpe_index import QPEFileIndex, parse_qpe_time
+from modules.RainfallProcessor import HRAP_PROJ4, RainfallProcessor
+from modules.regrid import Regridder
+
+QPE_LINK = re.compile(r'href="(qpe\.\d{8}_\d{4}\.nc(?:\.gz)?)"')
+
+def load_config(path):
+    '''
+    Returns the monitor configuration from a YAML or JSON file, with defaults filled in.
+    '''
+    with open(path) as f:
+        if path.endswith(('.yml', '.yaml')):
+            import yaml
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+
+    project_root = os.path.abspath(config.get('project_root', os.getcwd()))
+    config.setdefault('project_root', project_root)
+    config.setdefault('stac_source', None)
+    config.setdefault('collections', ['OPERA_L3_DIST-ALERT-HLS_V1'])
+    config.setdefault('state_dir', os.path.join(project_root, 'monitor_state'))
+    config.setdefault('threshold', 1.1)
+    config.setdefault('field_capacity', 0.18)
+    config.setdefault('bounds', [-125, -113, 32, 43])
+    config.setdefault('qpe_poll_seconds', 300)
+    config.setdefault('stac_poll_seconds', 3600)
+    config.setdefault('lag_days', 30)
+    config.setdefault('webhook', None)
+    config.setdefault('max_latency_s', 600)
+    config.setdefault('regrid_cache', os.path.join(project_root, '.regrid_cache'))
+    config.setdefault('granule_table', None)
+    config.setdefault('cell_stats', False)
+    config.setdefault('latlon_csv', os.path.join(project_root, 'astar_needed_DoNotTouch', 'QPE_latlons_new.csv'))
+    config.setdefault('recurrence', os.path.join(project_root, 'astar_needed_DoNotTouch', 'AWI_15yr_evd_smooth.nc'))
+    return config
+
+def _write_json(path, payload):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+# ------------------------------------------------------------------------------------------------ #
+# Sources
+# ------------------------------------------------------------------------------------------------ #
+
+class DirectoryQPESource:
+    '''
+    QPE files appearing in a local directory; arrival time is the file's modification time.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    async def poll(self, after):
+        index = await asyncio.to_thread(QPEFileIndex.from_dir, self.directory)
+        files = index.files if after is None else index.files[index.times > after]
+        return [(qpe_time, path, os.path.getmtime(path)) for qpe_time, path in files.items()]
+
+class HTTPQPESource:
+    '''
+    QPE files listed in an HTTP directory index (e.g. the CNRFC netcdfqpe archive), downloaded and
+    unzipped into download_dir; arrival time is when the listing first showed the file.
+    '''
+    def __init__(self, url, download_dir):
+        self.url = url if url.endswith('/') else url + '/'
+        self.download_dir = download_dir
+        os.makedirs(download_dir, exist_ok=True)
+
+    async def poll(self, after):
+        import aiohttp
+
+        async with aiohttp.ClientSession() as http:
+            async with http.get(self.url) as response:
+                response.raise_for_status()
+                listing = await response.text()
+            found = []
+            for name in sorted(set(QPE_LINK.findall(listing))):
+                qpe_time = parse_qpe_time(name[:-3] if name.endswith('.gz') else name)
+                if after is not None and qpe_time <= after:
+                    continue
+                seen = time.time()
+                path = os.path.join(self.download_dir, name[:-3] if name.endswith('.gz') else name)
+                if not os.path.exists(path):
+                    async with http.get(self.url + name) as response:
+                        response.raise_for_status()
+                        content = await response.read()
+                    if name.endswith('.gz'):
+                        content = gzip.decompress(content)
+                    with open(path + '.tmp', 'wb') as f:
+                        f.write(content)
+                    os.replace(path + '.tmp', path)
+                found.append((qpe_time, path, seen))
+        return found
+
+class StacSource:
+    '''
+    DIST-ALERT items from a STAC API or a local static catalog (catalog.json), intersecting an AOI after a date.
+    '''
+    def __init__(self, source, collections):
+        self.source = source
+        self.collections = list(collections)
+        self.static = not source.startswith(('http://', 'https://'))
+
+    def _items(self, aoi, start):
+        if self.static:
+            import pystac
+            catalog = pystac.Catalog.from_file(self.source)
+            items = [item for item in catalog.get_items(recursive=True)
+                     if item.datetime is not None and pd.Timestamp(item.datetime).tz_localize(None) >= start]
+            return [item for item in items if item.geometry is None or _intersects(item.geometry, aoi)]
+        from pystac_client import Client
+        search = Client.open(self.source).search(collections=self.collections, intersects=aoi.__geo_interface__,
+                                                 datetime=f'{start.isoformat()}Z/..', max_items=1000)
+        return list(search.items())
+
+    async def poll(self, aoi, start):
+        return await asyncio.to_thread(self._items, aoi, pd.Timestamp(start))
+
+def _intersects(geometry, aoi):
+    from shapely.geometry import shape
+    return shape(geometry).intersects(aoi)
+
+# ------------------------------------------------------------------------------------------------ #
+# Monitor
+# ------------------------------------------------------------------------------------------------ #
+
+class AstarMonitor:
+    '''
+    Incremental AWI/A* state with alerting. The state (AWI grid, last QPE time, exceedance mask and the
+    regions being watched for disturbance) is saved after every step, so a restart resumes where it stopped.
+    '''
+    def __init__(self, config):
+        self.config = config
+        self.state_dir = config['state_dir']
+        self.alerts_dir = os.path.join(self.state_dir, 'alerts')
+        os.makedirs(self.alerts_dir, exist_ok=True)
+        source = config['qpe_source']
+        if source.startswith(('http://', 'https://')):
+            self.qpe_source = HTTPQPESource(source, os.path.join(self.state_dir, 'qpe'))
+        else:
+            self.qpe_source = DirectoryQPESource(source)
+        self.stac_source = StacSource(config['stac_source'], config['collections']) if config['stac_source'] else None
+        self.granules = GranuleTable(config['granule_table']) if config['granule_table'] else None
+        self.processor = RainfallProcessor(latlon_csv_path=config['latlon_csv'], crs_proj4=HRAP_PROJ4,
+                                           output_dir=self.state_dir)
+        self._stop = asyncio.Event()
+        self.grid = None
+        self.load_state()
+
+    # ----------------------------------------- state ----------------------------------------- #
+    @property
+    def _state_path(self):
+        return os.path.join(self.state_dir, 'state.npz')
+
+    def load_state(self):
+        self.awi = None
+        self.above = None
+        self.last_time = None
+        self.watch = []
+        self.seen_items = set()
+        if os.path.exists(self._state_path):
+            state = np.load(self._state_path, allow_pickle=False)
+            self.awi = state['awi']
+            self.above = state['above']
+            self.last_time = pd.Timestamp(str(state['last_time']))
+        watch_path = os.path.join(self.state_dir, 'watch.json')
+        if os.path.exists(watch_path):
+            with open(watch_path) as f:
+                saved = json.load(f)
+            self.watch = saved['watch']
+            self.seen_items = set(saved['seen_items'])
+
+    def save_state(self):
+        tmp_path = os.path.join(self.state_dir, 'state.tmp.npz')
+        np.savez(tmp_path, awi=self.awi, above=self.above, last_time=str(self.last_time))
+        os.replace(tmp_path, self._state_path)
+        _write_json(os.path.join(self.state_dir, 'watch.json'),
+                    {'watch': self.watch, 'seen_items': sorted(self.seen_items)})
+
+    def _init_grid(self, rain):
+        '''
+        Finds the clip window and interpolates the recurrence grid once, from the first decoded file.
+        '''
+        min_lon, max_lon, min_lat, max_lat = self.config['bounds']
+        clipped = rain.rio.write_crs(4326).rio.clip_box(minx=min_lon, miny=min_lat, maxx=max_lon, maxy=max_lat)
+        x_idx = np.nonzero(np.isin(rain['x'].values, clipped['x'].values))[0]
+        y_idx = np.nonzero(np.isin(rain['y'].values, clipped['y'].values))[0]
+        lats = clipped['y'].values
+        lons = clipped['x'].values
+        recurrence = xr.open_dataset(self.config['recurrence'])['tp']
+        recurrence = Regridder(recurrence['latitude'].values, recurrence['longitude'].values, lats, lons,
+                               cache_dir=self.config['regrid_cache'])(recurrence)
+        self.grid = {'window': (slice(y_idx[0], y_idx[-1] + 1), slice(x_idx[0], x_idx[-1] + 1)),
+                     'lats': lats, 'lons': lons, 'recurrence': recurrence.values.astype('float32')}
+        if self.awi is None:
+            self.awi = np.full((len(lats), len(lons)), -self.config['field_capacity'], dtype='float32')
+            self.above = np.zeros((len(lats), len(lons)), dtype=bool)
+
+    # ---------------------------------------- processing ---------------------------------------- #
+    def step(self, qpe_time, path):
+        '''
+        Advances AWI by one QPE file and returns the A* grid and the pixels that newly crossed the threshold.
+        '''
+        with instrumentation.stage('monitor_step'):
+            rain = self.processor.process_file_CNRFC(path, None)
+            if self.grid is None:
+                self._init_grid(rain)
+            values = rain.values[self.grid['window']].astype('float32')
+            values[~(values < 1.0e5)] = np.nan
+
+            dt_hrs = 6.0 if self.last_time is None else (qpe_time - self.last_time) / pd.Timedelta(hours=1)
+            awi = np.empty_like(self.awi)
+            self.awi = self.processor.AWI_run_step_inplace(self.awi, values, dt_hrs, out=awi)
+            self.last_time = qpe_time
+
+            astar = (self.awi + self.config['field_capacity']) / self.grid['recurrence']
+            above = astar >= self.config['threshold']
+            newly = above & ~self.above
+            self.above = above
+        return astar, newly
+
+    def regions(self, astar, qpe_time):
+        '''
+        Returns the hazard regions of the current A* grid.
+        '''
+        prism = xr.DataArray(astar[None], dims=('z', 'latitude', 'longitude'),
+                             coords={'time': ('z', [np.datetime64(qpe_time, 'ns')]),
+                                     'latitude': self.grid['lats'], 'longitude': self.grid['lons']})
+        regions, _ = astar_regions(prism, qpe_time, qpe_time, self.config['threshold'])
+        return regions
+
+    async def emit(self, kind, payload):
+        '''
+        Writes an alert to the alerts directory and posts it to the webhook, if configured.
+        '''
+        payload = dict(payload, kind=kind, emitted_at=pd.Timestamp.now(tz='UTC').isoformat())
+        name = f"{kind}_{payload['id']}.json"
+        await asyncio.to_thread(_write_json, os.path.join(self.alerts_dir, name), payload)
+        if self.config['webhook']:
+            import aiohttp
+            try:
+                async with aiohttp.ClientSession() as http:
+                    async with http.post(self.config['webhook'], data=json.dumps(payload, default=str),
+                                         headers={'Content-Type': 'application/json'}) as response:
+                        response.raise_for_status()
+            except Exception as e:
+                print(f"Webhook failed for {name}: {e}")
+        print(f"Alert {name}")
+
+    def record_latency(self, qpe_time, arrived, processed, alerted=None):
+        latency = (alerted or processed) - arrived
+        metric = {'qpe_time': str(qpe_time), 'arrived': arrived, 'processed': processed, 'alerted': alerted,
+                  'processing_s': processed - arrived, 'latency_s': latency,
+                  'over_budget': latency > self.config['max_latency_s']}
+        with open(os.path.join(self.state_dir, 'latency.jsonl'), 'a') as f:
+            f.write(json.dumps(metric) + '\n')
+        if metric['over_budget']:
+            print(f"Latency {latency:.0f} s for {qpe_time} exceeds {self.config['max_latency_s']} s")
+        return metric
+
+    def add_watch(self, regions, newly, alert_id, qpe_time):
+        '''
+        Watches the regions that contain newly crossed pixels. A region already watched with the same bounds
+        keeps its first exceedance time and has its stop time extended, so the list grows only with new regions.
+        '''
+        stop = str(qpe_time + pd.Timedelta(days=self.config['lag_days']))
+        rows, cols = np.nonzero(newly)
+        lats, lons = self.grid['lats'][rows], self.grid['lons'][cols]
+        watched = {tuple(entry['bounds']): entry for entry in self.watch}
+        for r in regions.itertuples():
+            bounds = (r.min_lon, r.min_lat, r.max_lon, r.max_lat)
+            if not np.any((lons >= r.min_lon) & (lons <= r.max_lon) & (lats >= r.min_lat) & (lats <= r.max_lat)):
+                continue
+            if bounds in watched:
+                watched[bounds]['stop'] = max(watched[bounds]['stop'], stop, key=pd.Timestamp)
+            else:
+                watched[bounds] = {'alert': alert_id, 'exceedance': str(qpe_time), 'stop': stop,
+                                   'bounds': list(bounds)}
+                self.watch.append(watched[bounds])
+
+    async def process_qpe(self):
+        '''
+        Processes every QPE file newer than the state, in time order. Returns the number of files processed.
+        '''
+        new_files = await self.qpe_source.poll(self.last_time)
+        for qpe_time, path, arrived in new_files:
+            astar, newly = await asyncio.to_thread(self.step, qpe_time, path)
+            processed = time.time()
+            alerted = None
+            if newly.any():
+                regions = await asyncio.to_thread(self.regions, astar, qpe_time)
+                alert_id = f'{qpe_time:%Y%m%dT%H%M}'
+                await self.emit('hazard', {
+                    'id': alert_id, 'qpe_time': qpe_time, 'threshold': self.config['threshold'],
+                    'new_pixels': int(newly.sum()), 'max_astar': float(np.nanmax(astar)),
+                    'regions': json.loads(regions.drop(columns=['exceedance']).to_json()),
+                })
+                alerted = time.time()
+                self.add_watch(regions, newly, alert_id, qpe_time)
+            self.save_state()
+            self.record_latency(qpe_time, arrived, processed, alerted)
+        return len(new_files)
+
+    def cell_stats(self, item, entry):
+        '''
+        Writes the disturbance of a granule per A* cell next to the alerts and returns its summary.
+        '''
+        from modules.grid_alignment import granule_cell_stats
+
+        astar = (self.awi + self.config['field_capacity']) / self.grid['recurrence']
+        stats = granule_cell_stats(item.to_dict(), self.grid['lats'], self.grid['lons'], entry['exceedance'],
+                                   entry['stop'], astar=astar, cache_dir=os.path.join(self.state_dir, 'alignment'))
+        path = os.path.join(self.alerts_dir, f'cells_{item.id}.parquet')
+        stats.to_parquet(path)
+        disturbed = stats[stats['disturbed_pixels'] > 0]
+        return {'cell_stats': path, 'disturbed_cells': len(disturbed),
+                'disturbed_area_m2': float(disturbed['disturbed_area_m2'].sum()),
+                'max_astar_disturbed': float(disturbed['astar'].max()) if len(disturbed) else None}
+
+    async def process_stac(self):
+        '''
+        Searches for new DIST-ALERT items over the watched regions and emits one alert per new item.
+        '''
+        from shapely.geometry import box
+
+        # Watch windows run on the QPE clock, so replays of archived data expire them consistently
+        clock = self.last_time if self.last_time is not None else pd.Timestamp.now()
+        self.watch = [entry for entry in self.watch if pd.Timestamp(entry['stop']) >= clock]
+        for entry in self.watch:
+            items = await self.stac_source.poll(box(*entry['bounds']), entry['exceedance'])
+            if self.granules is not None:
+                self.granules.append(items)
+            for item in items:
+                if item.id in self.seen_items:
+                    continue
+                self.seen_items.add(item.id)
+                payload = {'id': item.id, 'alert': entry['alert'], 'datetime': item.datetime, 'bounds': entry['bounds'],
+                           'assets': {key: asset.href for key, asset in item.assets.items()}}
+                if self.config['cell_stats'] and self.grid is not None:
+                    payload.update(await asyncio.to_thread(self.cell_stats, item, entry))
+                await self.emit('disturbance', payload)
+        self.save_state()
+
+    async def _loop(self, func, seconds):
+        while not self._stop.is_set():
+            try:
+                await func()
+            except Exception as e:
+                print(f"{func.__name__} failed: {e}")
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        self._stop.set()
+
+    async def run(self, once=False):
+        '''
+        Runs the QPE and STAC polling loops until stop() is called, or one pass of each if once is True.
+        '''
+        if once:
+            await self.process_qpe()
+            if self.stac_source is not None and self.awi is not None:
+                await self.process_stac()
+            return
+        loops = [self._loop(self.process_qpe, self.config['qpe_poll_seconds'])]
+        if self.stac_source is not None:
+            loops.append(self._loop(self.process_stac, self.config['stac_poll_seconds']))
+        await asyncio.gather(*loops)
+
+def main(argv=None):
+    import signal
+
+    parser = argparse.ArgumentParser(description='Monitor QPE and DIST-ALERT feeds and emit A* alerts.')
+    parser.add_argument('config', help='YAML or JSON monitor configuration')
+    parser.add_argument('--once', action='store_true', help='Process what is available and exit')
+    args = parser.parse_args(argv)
+
+    async def serve():
+        monitor = AstarMonitor(load_config(args.config))
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, monitor.stop)
+        await monitor.run(once=args.once)
+
+    asyncio.run(serve())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+# Library Imports
+import os
+import re
+import glob
+import warnings
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+# CNRFC archive names, e.g. qpe.20230101_0600.nc
+QPE_NAME = re.compile(r'qpe\.(\d{8})_(\d{4})\.nc$')
+
+# One step of the AWI recurrence. kind is 'file', 'zero' or 'interpolate'; for 'interpolate',
+# neighbors is (previous path, next path, weight of the next file).
+QPEStep = namedtuple('QPEStep', ['time', 'path', 'dt_hrs', 'kind', 'neighbors'])
+
+def parse_qpe_time(path):
+    '''
+    Returns the timestamp encoded in a QPE filename, or None if the name does not match.
+            Parameters:
+                    path (str): Path to a qpe.YYYYMMDD_HHMM.nc file
+            Returns:
+                    time (Timestamp): Valid time of the file
+    '''
+    match = QPE_NAME.search(os.path.basename(path))
+    if match is None:
+        return None
+    return pd.Timestamp(f"{match.group(1)}T{match.group(2)}")
+
+class QPEFileIndex:
+    '''
+    Sorted time index over QPE files, parsed once. Reports gaps and duplicates in the 6-hour cadence,
+    yields gap-aware steps for the AWI recurrence and shards by time range without rescanning directories.
+
+    Example usage:
+        index = QPEFileIndex.from_glob('wy2023_astar/wy_data/*.nc')
+        print(index.gaps())
+        for step in index.iter_steps(fill='zero'):
+            ...
+        shards = index.split(4)   # one per worker
+    '''
+    def __init__(self, paths, cadence='6h'):
+        self.cadence = pd.Timedelta(cadence)
+        rows = []
+        self.unparsed = []
+        for path in paths:
+            time = parse_qpe_time(path)
+            if time is None:
+                self.unparsed.append(path)
+            else:
+                rows.append((time, path))
+        frame = pd.DataFrame(rows, columns=['time', 'path']).sort_values(['time', 'path'], kind='stable')
+        self.duplicates = frame[frame.duplicated('time', keep='first')].reset_index(drop=True)
+        self.files = frame.drop_duplicates('time', keep='first').set_index('time')['path']
+        if self.unparsed:
+            warnings.warn(f"QPE index: {len(self.unparsed)} files do not match qpe.YYYYMMDD_HHMM.nc and are ignored "
+                          f"(e.g. {self.unparsed[0]})")
+
+    @classmethod
+    def from_glob(cls, pattern, cadence='6h'):
+        return cls(glob.glob(pattern), cadence=cadence)
+
+    @classmethod
+    def from_dir(cls, directory, cadence='6h'):
+        return cls(glob.glob(os.path.join(directory, 'qpe.*.nc')), cadence=cadence)
+
+    @classmethod
+    def _from_series(cls, files, cadence):
+        index = cls([], cadence=cadence)
+        index.files = files
+        return index
+
+    def __len__(self):
+        return len(self.files)
+
+    @property
+    def times(self):
+        return self.files.index
+
+    @property
+    def paths(self):
+        return list(self.files.values)
+
+    def expected_times(self):
+        '''
+        Returns the full cadence between the first and last file.
+        '''
+        if len(self.files) == 0:
+            return pd.DatetimeIndex([])
+        return pd.date_range(self.times[0], self.times[-1], freq=self.cadence)
+
+    def gaps(self):
+        '''
+        Returns the missing timestamps as runs, one row per gap with its start, end and number of steps.
+        '''
+        missing = self.expected_times().difference(self.times)
+        if len(missing) == 0:
+            return pd.DataFrame(columns=['start', 'end', 'steps'])
+        run_id = np.cumsum(np.r_[True, np.diff(missing.asi8) != self.cadence.value])
+        runs = pd.DataFrame({'time': missing, 'run': run_id}).groupby('run')['time']
+        return pd.DataFrame({'start': runs.min(), 'end': runs.max(), 'steps': runs.size()}).reset_index(drop=True)
+
+    def off_cadence(self):
+        '''
+        Returns files whose timestamp is not on the cadence grid.
+        '''
+        return self.files[~self.times.isin(self.expected_times())]
+
+    def shard(self, start=None, end=None):
+        '''
+        Returns a new index restricted to start <= time <= end.
+        '''
+        return QPEFileIndex._from_series(self.files.loc[start:end], self.cadence)
+
+    def split(self, n):
+        '''
+        Returns n shards of contiguous time ranges with about the same number of files.
+        '''
+        bounds = np.linspace(0, len(self.files), n + 1).astype(int)
+        return [QPEFileIndex._from_series(self.files.iloc[a:b], self.cadence) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def iter_steps(self, fill='skip'):
+        '''
+        Yields QPEStep tuples in time order.
+                Parameters:
+                        fill (str): 'skip' steps over gaps and uses the true hours since the previous file as
+                                    dt_hrs; 'zero' inserts zero-rain steps for missing times; 'interpolate'
+                                    inserts steps linearly weighted between the neighbouring files
+                Returns:
+                        Generator of QPEStep
+
+        With 'skip', the file after a gap still holds a single cadence-long accumulation but its dt_hrs is the
+        whole gap, so AWI drains over the gap and that rain is spread over it, as if the missing steps were dry.
+        'zero' and 'interpolate' follow the cadence grid, so files off that grid are dropped (with a warning).
+        '''
+        if fill not in ('skip', 'zero', 'interpolate'):
+            raise Exception("Invalid value for 'fill'. It should be 'skip', 'zero' or 'interpolate'.")
+        if len(self.files) == 0:
+            raise Exception(f"Invalid QPE index. It holds no qpe.YYYYMMDD_HHMM.nc files "
+                            f"({len(self.unparsed)} files did not match the name).")
+        cadence_hrs = self.cadence / pd.Timedelta(hours=1)
+
+        if fill == 'skip':
+            previous = None
+            for time, path in self.files.items():
+                dt_hrs = cadence_hrs if previous is None else (time - previous) / pd.Timedelta(hours=1)
+                yield QPEStep(time, path, dt_hrs, 'file', None)
+                previous = time
+            return
+
+        dropped = self.off_cadence()
+        if len(dropped):
+            warnings.warn(f"QPE index: {len(dropped)} files off the {cadence_hrs:g} h cadence are dropped with "
+                          f"fill='{fill}' (e.g. {dropped.iloc[0]})")
+        times = self.times
+        for time in self.expected_times():
+            if time in self.files.index:
+                yield QPEStep(time, self.files[time], cadence_hrs, 'file', None)
+            elif fill == 'zero':
+                yield QPEStep(time, None, cadence_hrs, 'zero', None)
+            else:
+                position = times.searchsorted(time)
+                before, after = times[position - 1], times[position]
+                weight = (time - before) / (after - before)
+                yield QPEStep(time, None, cadence_hrs, 'interpolate', (self.files[before], self.files[after], weight))
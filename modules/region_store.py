@@ -0,0 +1,161 @@
+'''
+Persistent store of A* hazard regions across storms and runs.
+
+Each run's regions are appended as one GeoParquet part file tagged with the storm window, threshold and
+water year, and every region's bounding box is inserted into an on-disk R-tree (regions.idx/regions.dat),
+so spatial queries never rescan the parts. A rerun of the same storm window and threshold replaces its part.
+
+Example usage:
+    store = RegionStore('region_store')
+    store.append(regions, '2023-01-01', '2023-03-30', threshold=1.1, WY='2023')
+    hits = store.query(aoi=box(-123, 38, -121, 40), start='2023-01-01', end='2023-01-31')
+    candidates = LandslideEventDetector().detect_regions(hits)
+'''
+# Library Imports
+import os
+import glob
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+REGION_COLUMNS = ['region_id', 'storm_begin', 'storm_end', 'threshold', 'WY', 'run', 'min_lon', 'min_lat',
+                  'max_lon', 'max_lat', 'area', 'exceedance', 'geometry']
+
+def run_key(storm_begin, storm_end, threshold, WY=None):
+    '''
+    Returns the identifier of a run: one storm window, threshold and water year.
+    '''
+    text = f'{pd.Timestamp(storm_begin).isoformat()}|{pd.Timestamp(storm_end).isoformat()}|{float(threshold)!r}|{WY}'
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+class RegionStore:
+    def __init__(self, path):
+        from rtree import index
+
+        self.path = path
+        self.parts_dir = os.path.join(path, 'parts')
+        os.makedirs(self.parts_dir, exist_ok=True)
+        self.table = self._read_parts()
+
+        basename = os.path.join(path, 'regions')
+        fresh = not os.path.exists(basename + '.idx')
+        self._index = index.Index(basename)
+        # Rebuild if the index is new or out of step with the parts (e.g. a part written by another copy)
+        if fresh or self._index.get_size() != len(self.table):
+            self._index.close()
+            for suffix in ('.idx', '.dat'):
+                if os.path.exists(basename + suffix):
+                    os.remove(basename + suffix)
+            self._index = index.Index(basename, self._index_entries(self.table)) if len(self.table) else index.Index(basename)
+            self._index.flush()
+
+    def __len__(self):
+        return len(self.table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._index.close()
+
+    def _read_parts(self):
+        parts = [gpd.read_parquet(path) for path in sorted(glob.glob(os.path.join(self.parts_dir, '*.parquet')))]
+        if not parts:
+            return gpd.GeoDataFrame(pd.DataFrame(columns=REGION_COLUMNS), geometry='geometry', crs='EPSG:4326')
+        table = pd.concat(parts, ignore_index=True)
+        return table.set_index('region_id', drop=False).sort_index()
+
+    @staticmethod
+    def _index_entries(table):
+        for region_id, minx, miny, maxx, maxy in zip(table['region_id'], table['min_lon'], table['min_lat'],
+                                                     table['max_lon'], table['max_lat']):
+            yield int(region_id), (minx, miny, maxx, maxy), None
+
+    def append(self, regions, storm_begin, storm_end, threshold, WY=None):
+        '''
+        Adds the regions of one run, replacing an earlier run with the same storm window, threshold and water year.
+                Parameters:
+                        regions (GeoDataFrame): Output of astar_regions (EPSG:4326)
+                        storm_begin, storm_end (str or datetime): Storm window
+                        threshold (float): A* threshold the regions were extracted with
+                        WY (str): Water year
+                Returns:
+                        region_ids (array): Ids assigned to the regions
+        '''
+        key = run_key(storm_begin, storm_end, threshold, WY)
+        part_path = os.path.join(self.parts_dir, f'{key}.parquet')
+        previous = self.table[self.table['run'] == key]
+        for region_id, minx, miny, maxx, maxy in zip(previous['region_id'], previous['min_lon'],
+                                                     previous['min_lat'], previous['max_lon'], previous['max_lat']):
+            self._index.delete(int(region_id), (minx, miny, maxx, maxy))
+        table = self.table[self.table['run'] != key]
+
+        next_id = int(self.table['region_id'].max()) + 1 if len(self.table) else 0
+        part = regions.to_crs('EPSG:4326').reset_index(drop=True).copy()
+        part['region_id'] = np.arange(next_id, next_id + len(part), dtype='int64')
+        part['storm_begin'] = pd.Timestamp(storm_begin)
+        part['storm_end'] = pd.Timestamp(storm_end)
+        part['threshold'] = float(threshold)
+        part['WY'] = None if WY is None else str(WY)
+        part['run'] = key
+        if 'exceedance' not in part:
+            part['exceedance'] = pd.NaT
+        part = part[REGION_COLUMNS]
+
+        tmp_path = part_path + '.tmp'
+        part.to_parquet(tmp_path)
+        os.replace(tmp_path, part_path)
+        for entry in self._index_entries(part):
+            self._index.insert(*entry)
+        self._index.flush()
+
+        self.table = pd.concat([table, part.set_index('region_id', drop=False)]).sort_index()
+        return part['region_id'].values
+
+    def query(self, aoi=None, start=None, end=None, threshold=None):
+        '''
+        Returns stored regions intersecting an AOI whose storm window overlaps [start, end].
+                Parameters:
+                        aoi (shapely geometry or bounds tuple): Area of interest in EPSG:4326 (None for everywhere)
+                        start, end (str or datetime): Date range (None leaves that side open)
+                        threshold (float): Only regions extracted with this threshold
+                Returns:
+                        regions (GeoDataFrame): Matching regions with their run metadata
+        '''
+        table = self.table
+        if aoi is not None:
+            if isinstance(aoi, (tuple, list)):
+                aoi = shapely.box(*aoi)
+            ids = list(self._index.intersection(aoi.bounds))
+            table = table.loc[table.index.intersection(ids)]
+            table = table[shapely.intersects(table.geometry.values, aoi)]
+        if start is not None:
+            table = table[table['storm_end'] >= pd.Timestamp(start)]
+        if end is not None:
+            table = table[table['storm_begin'] <= pd.Timestamp(end)]
+        if threshold is not None:
+            table = table[np.isclose(table['threshold'].astype(float), threshold)]
+        return table
+
+    def runs(self):
+        '''
+        Returns one row per stored run with its storm window, threshold, water year and region count.
+        '''
+        return (self.table.groupby('run')
+                .agg(storm_begin=('storm_begin', 'first'), storm_end=('storm_end', 'first'),
+                     threshold=('threshold', 'first'), WY=('WY', 'first'), regions=('region_id', 'size'))
+                .sort_values('storm_begin').reset_index())
+
+    def search_aoi(self, aoi=None, start=None, end=None, threshold=None):
+        '''
+        Returns the union of matching regions, for use as the intersects AOI of an OPERA search.
+        '''
+        regions = self.query(aoi, start, end, threshold)
+        if regions.empty:
+            return None
+        return shapely.union_all(regions.geometry.values)
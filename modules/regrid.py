@@ -0,0 +1,242 @@
+'''
+Regridding with cached sparse remap weights.
+
+Weights from a rectilinear latitude/longitude source grid to a destination grid are computed once,
+stored as a scipy sparse matrix keyed by a hash of both grids and the method, and applied to any field
+as one sparse matrix product per 2-D slice. Destinations can be another lat/lon grid (e.g. a QPE clip
+box) or the pixel centres of a projected raster such as a 30 m OPERA DIST-ALERT tile.
+
+Example usage:
+    regrid = Regridder.from_dataarrays(awi_15yr, a_prime.isel(z=0), cache_dir='.regrid_cache')
+    awi_15yr_on_qpe = regrid(awi_15yr)          # same result as awi_15yr.interp_like(a_prime.isel(z=0))
+
+    to_tile = Regridder.to_projected(astar['latitude'], astar['longitude'], tile_x, tile_y, tile_crs)
+    astar_30m = to_tile(astar_storm_max)         # (len(tile_y), len(tile_x))
+'''
+# Library Imports
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import xarray as xr
+from scipy import sparse
+
+from modules.instrumentation import instrumentation
+
+METHODS = ('bilinear', 'nearest', 'conservative')
+# Part of every cache key; bump it whenever the weights a method produces change, so stale files are not reused
+WEIGHTS_VERSION = 2
+# Weights kept in memory (least recently used are dropped); the .npz files in cache_dir are the durable cache
+MEMORY_CACHE_SIZE = 8
+_weights_cache = OrderedDict()
+_weights_lock = threading.Lock()
+
+def grid_hash(*arrays, crs=''):
+    '''
+    Returns a short hash of coordinate arrays and a CRS string.
+    '''
+    digest = hashlib.sha1(str(crs).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(np.asarray(array, dtype='float64'))
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()[:16]
+
+def _axis_position(coords, points):
+    '''
+    Returns, for each point, the index i of its left neighbour along a monotonic axis and its fractional
+    distance from coords[i] towards coords[i + 1]; points outside the axis get index -1.
+    '''
+    coords = np.asarray(coords, dtype='float64')
+    descending = coords[0] > coords[-1]
+    if descending:
+        coords = coords[::-1]
+    lower = np.searchsorted(coords, points, side='right') - 1
+    inside = (points >= coords[0]) & (points <= coords[-1])
+    lower = np.clip(lower, 0, len(coords) - 2)
+    fraction = (points - coords[lower]) / (coords[lower + 1] - coords[lower])
+    if descending:
+        lower = len(coords) - 2 - lower
+        fraction = 1.0 - fraction
+    return np.where(inside, lower, -1), fraction
+
+def bilinear_weights(src_lats, src_lons, dst_lats, dst_lons):
+    '''
+    Returns the (n_dst, n_src) sparse bilinear weights from a rectilinear grid to destination points.
+            Parameters:
+                    src_lats, src_lons (array): 1-D source coordinates
+                    dst_lats, dst_lons (array): Destination points (flat, same length)
+            Returns:
+                    weights (csr_matrix): Rows sum to 1 inside the source grid and are empty outside it
+    '''
+    nx = len(src_lons)
+    row_idx, fy = _axis_position(src_lats, dst_lats)
+    col_idx, fx = _axis_position(src_lons, dst_lons)
+    inside = np.nonzero((row_idx >= 0) & (col_idx >= 0))[0]
+    r, c, fy, fx = row_idx[inside], col_idx[inside], fy[inside], fx[inside]
+
+    rows = np.repeat(inside, 4)
+    cols = np.column_stack([r * nx + c, r * nx + c + 1, (r + 1) * nx + c, (r + 1) * nx + c + 1]).ravel()
+    values = np.column_stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx]).ravel()
+    weights = sparse.csr_matrix((values, (rows, cols)), shape=(len(dst_lats), len(src_lats) * nx))
+    weights.eliminate_zeros()
+    return weights
+
+def nearest_index(src_lats, src_lons, dst_lats, dst_lons):
+    '''
+    Returns the flat index (int32) of the nearest source cell for each destination point, -1 outside the grid.
+    '''
+    nx = len(src_lons)
+    row_idx, fy = _axis_position(src_lats, dst_lats)
+    col_idx, fx = _axis_position(src_lons, dst_lons)
+    inside = (row_idx >= 0) & (col_idx >= 0)
+    row_idx = row_idx + (fy >= 0.5)
+    col_idx = col_idx + (fx >= 0.5)
+    return np.where(inside, row_idx * nx + col_idx, -1).astype('int32')
+
+def nearest_weights(src_lats, src_lons, dst_lats, dst_lons):
+    '''
+    Returns the (n_dst, n_src) sparse nearest-neighbour selection from a rectilinear grid to destination points.
+    '''
+    cell = nearest_index(src_lats, src_lons, dst_lats, dst_lons)
+    inside = np.nonzero(cell >= 0)[0]
+    return sparse.csr_matrix((np.ones(inside.size), (inside, cell[inside])),
+                             shape=(len(dst_lats), len(src_lats) * len(src_lons)))
+
+def _overlap_1d(src, dst):
+    '''
+    Returns the (len(dst), len(src)) fraction of each destination cell covered by each source cell along one axis.
+    '''
+    def edges(centres):
+        centres = np.asarray(centres, dtype='float64')
+        middle = (centres[1:] + centres[:-1]) / 2
+        return np.concatenate([[2 * centres[0] - middle[0]], middle, [2 * centres[-1] - middle[-1]]])
+
+    src_edges, dst_edges = edges(src), edges(dst)
+    src_lo, src_hi = np.minimum(src_edges[:-1], src_edges[1:]), np.maximum(src_edges[:-1], src_edges[1:])
+    dst_lo, dst_hi = np.minimum(dst_edges[:-1], dst_edges[1:]), np.maximum(dst_edges[:-1], dst_edges[1:])
+    overlap = np.clip(np.minimum(dst_hi[:, None], src_hi[None, :]) - np.maximum(dst_lo[:, None], src_lo[None, :]), 0, None)
+    return sparse.csr_matrix(overlap / (dst_hi - dst_lo)[:, None])
+
+def conservative_weights(src_lats, src_lons, dst_lats, dst_lons):
+    '''
+    Returns area-overlap weights between two rectilinear grids (destination given by its 1-D axes).
+    The lat/lon cell overlap is separable, so the 2-D weights are the Kronecker product of the two axes.
+    '''
+    weights = sparse.kron(_overlap_1d(src_lats, dst_lats), _overlap_1d(src_lons, dst_lons), format='csr')
+    weights.eliminate_zeros()
+    return weights
+
+class Regridder:
+    '''
+    Applies cached sparse remap weights to fields on a rectilinear latitude/longitude source grid.
+            Parameters:
+                    src_lats, src_lons (array): 1-D source coordinates
+                    dst_lats, dst_lons (array): 1-D destination axes, or 2-D destination point coordinates
+                    method (str): 'bilinear', 'nearest' or 'conservative' (1-D destination axes only)
+                    cache_dir (str): If given, weights are stored there as v{version}_{method}_{src}_{dst}.npz
+                    dst_key (str): Extra text for the destination hash (e.g. the CRS of a projected raster)
+    '''
+    def __init__(self, src_lats, src_lons, dst_lats, dst_lons, method='bilinear', cache_dir=None, dst_key=''):
+        if method not in METHODS:
+            raise Exception(f"Invalid value for 'method'. It should be one of {', '.join(METHODS)}.")
+        self.src_shape = (len(src_lats), len(src_lons))
+        dst_lats = np.asarray(dst_lats)
+        dst_lons = np.asarray(dst_lons)
+        self.dst_shape = dst_lats.shape if dst_lats.ndim == 2 else (len(dst_lats), len(dst_lons))
+        self.dst_coords = None if dst_lats.ndim == 2 else {'latitude': dst_lats, 'longitude': dst_lons}
+        self.method = method
+        key = f'v{WEIGHTS_VERSION}_{method}_{grid_hash(src_lats, src_lons)}_{grid_hash(dst_lats, dst_lons, crs=dst_key)}'
+        self.weights = self._load(key, cache_dir, np.asarray(src_lats), np.asarray(src_lons), dst_lats, dst_lons)
+
+    def _load(self, key, cache_dir, src_lats, src_lons, dst_lats, dst_lons):
+        path = None if cache_dir is None else os.path.join(cache_dir, f'{key}.npz')
+        with _weights_lock:
+            if key in _weights_cache:
+                _weights_cache.move_to_end(key)
+                instrumentation.cache_hit(True)
+                return _weights_cache[key]
+        if path is not None and os.path.exists(path):
+            weights = sparse.load_npz(path).tocsr()
+            instrumentation.cache_hit(True)
+        else:
+            instrumentation.cache_hit(False)
+            with instrumentation.stage('regrid_weights', method=self.method):
+                if self.method == 'conservative':
+                    if dst_lats.ndim == 2:
+                        raise Exception("Conservative weights need 1-D destination axes.")
+                    weights = conservative_weights(src_lats, src_lons, dst_lats, dst_lons)
+                else:
+                    if dst_lats.ndim == 1:
+                        dst_lons, dst_lats = np.meshgrid(dst_lons, dst_lats)
+                    build = bilinear_weights if self.method == 'bilinear' else nearest_weights
+                    weights = build(src_lats, src_lons, dst_lats.ravel(), dst_lons.ravel())
+            if path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = path + '.tmp.npz'
+                sparse.save_npz(tmp_path, weights)
+                os.replace(tmp_path, path)
+        with _weights_lock:
+            _weights_cache[key] = weights
+            while len(_weights_cache) > MEMORY_CACHE_SIZE:
+                _weights_cache.popitem(last=False)
+        return weights
+
+    @classmethod
+    def from_dataarrays(cls, source, target, method='bilinear', cache_dir=None):
+        '''
+        Returns a Regridder between the latitude/longitude grids of two DataArrays.
+        '''
+        return cls(source['latitude'].values, source['longitude'].values, target['latitude'].values,
+                   target['longitude'].values, method=method, cache_dir=cache_dir)
+
+    @classmethod
+    def to_projected(cls, src_lats, src_lons, x, y, crs, method='bilinear', cache_dir=None):
+        '''
+        Returns a Regridder onto the pixel centres of a projected raster (e.g. a 30 m OPERA tile in UTM).
+                Parameters:
+                        src_lats, src_lons (array): 1-D source coordinates (EPSG:4326)
+                        x, y (array): 1-D pixel centre coordinates of the raster
+                        crs (str): CRS of the raster
+        '''
+        from modules.dist_utils import get_transformer
+
+        xx, yy = np.meshgrid(np.asarray(x, dtype='float64'), np.asarray(y, dtype='float64'))
+        lons, lats = get_transformer(str(crs), 'EPSG:4326').transform(xx, yy)
+        return cls(np.asarray(src_lats), np.asarray(src_lons), np.asarray(lats), np.asarray(lons), method=method,
+                   cache_dir=cache_dir, dst_key=str(crs))
+
+    def __call__(self, field, skipna=False):
+        '''
+        Regrids a field whose last two dims are the source (latitude, longitude).
+                Parameters:
+                        field (numpy array or xarray DataArray): Field on the source grid
+                        skipna (bool): If False, a destination value is nan when any contributing source value is
+                                       nan (as xarray interp); if True, weights are renormalized over valid values
+                Returns:
+                        regridded (same type as field): Field on the destination grid
+        '''
+        if isinstance(field, xr.DataArray):
+            field = field.transpose(..., 'latitude', 'longitude')
+        values = np.asarray(field.values if isinstance(field, xr.DataArray) else field, dtype='float64')
+        lead = values.shape[:-2]
+        flat = values.reshape(-1, self.src_shape[0] * self.src_shape[1]).T
+        valid = np.isfinite(flat)
+        total = self.weights @ np.where(valid, flat, 0.0)
+        covered = self.weights @ valid.astype('float64')
+        reach = np.asarray(self.weights.sum(axis=1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if skipna:
+                out = np.where(covered > 0, total / covered, np.nan)
+            else:
+                out = np.where((reach > 0) & np.isclose(covered, reach), total / reach, np.nan)
+        out = out.T.reshape(lead + self.dst_shape)
+
+        if not isinstance(field, xr.DataArray):
+            return out
+        dims = field.dims[:-2] + (('latitude', 'longitude') if self.dst_coords else ('y', 'x'))
+        coords = {dim: field[dim] for dim in field.dims[:-2] if dim in field.coords}
+        if self.dst_coords:
+            coords.update(self.dst_coords)
+        return xr.DataArray(out, dims=dims, coords=coords, name=field.name, attrs=field.attrs)
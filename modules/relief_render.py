@@ -0,0 +1,160 @@
+'''
+Storm figure rendering with cached terrain.
+
+The earth relief and its hillshade are computed once per region, resolution and shading, stored as
+NetCDF in a cache directory and reused by every figure. The relief resolution is picked from the
+figure width and dpi, so a 10 cm figure does not pay for 15s terrain it cannot show. Batches of storm
+figures render in worker processes after the shared terrain is prepared in the parent.
+
+Example usage:
+    render_catalog('storm_catalog', cache_dir='relief_cache', max_workers=8)
+'''
+# Library Imports
+import os
+import sys
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xarray as xr
+
+from modules.instrumentation import instrumentation, instrumented
+
+CA_REGION = (-125, -115, 32, 42.5)
+PROJECTION = 'L-120/37/32/39/{width}c'
+
+# GMT remote relief resolutions and their cell size in arc-seconds, coarsest first
+RELIEF_RESOLUTIONS = [('01d', 3600), ('30m', 1800), ('20m', 1200), ('15m', 900), ('10m', 600), ('06m', 360),
+                      ('05m', 300), ('04m', 240), ('03m', 180), ('02m', 120), ('01m', 60), ('30s', 30), ('15s', 15)]
+
+def pick_resolution(region, width_cm, dpi=300):
+    '''
+    Returns the coarsest relief resolution that still gives at least one cell per output pixel.
+    '''
+    pixels = width_cm / 2.54 * dpi
+    needed = (region[1] - region[0]) * 3600 / pixels
+    for name, arcsec in RELIEF_RESOLUTIONS:
+        if arcsec <= needed:
+            return name
+    return RELIEF_RESOLUTIONS[-1][0]
+
+def cached_relief(region, resolution, cache_dir, azimuth='315/45', normalize='t1'):
+    '''
+    Returns the paths of the relief and hillshade grids for a region, computing them on the first call.
+            Parameters:
+                    region (tuple): west, east, south, north
+                    resolution (str): GMT relief resolution (e.g. '01m')
+                    cache_dir (str): Directory of the cached grids
+                    azimuth (str): grdgradient azimuth/elevation
+                    normalize (str): grdgradient normalization
+            Returns:
+                    relief_path, shade_path (str): NetCDF grids
+    '''
+    key = '_'.join([f'{v:g}' for v in region] + [resolution, azimuth.replace('/', '-'), normalize])
+    relief_path = os.path.join(cache_dir, f'relief_{key}.nc')
+    shade_path = os.path.join(cache_dir, f'shade_{key}.nc')
+    hit = os.path.exists(relief_path) and os.path.exists(shade_path)
+    instrumentation.cache_hit(hit)
+    if hit:
+        return relief_path, shade_path
+
+    import pygmt
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with instrumentation.stage('relief_compute', resolution=resolution):
+        grid = pygmt.datasets.load_earth_relief(resolution=resolution, region=list(region))
+        shade = pygmt.grdgradient(grid=grid, azimuth=[azimuth], normalize=[normalize])
+    for data, path in ((grid, relief_path), (shade, shade_path)):
+        tmp_path = path + '.tmp'
+        data.to_netcdf(tmp_path)
+        os.replace(tmp_path, path)
+    return relief_path, shade_path
+
+def render_storm_figure(astar_max, output_file, relief_path, shade_path, width_cm=10, dpi=300, minc=1.0, maxc=1.7,
+                        dc=0.05, title=None):
+    '''
+    Renders the storm maximum A* over the shaded relief, as in the A* workflow notebook.
+            Parameters:
+                    astar_max (xarray DataArray or str): Storm maximum A* grid, or a NetCDF path to one
+                    output_file (str): Output image path
+                    relief_path, shade_path (str): Cached terrain from cached_relief
+                    width_cm (float): Map width
+                    dpi (int): Output resolution
+                    minc, maxc, dc (float): A* color scale and contour interval
+                    title (str): Optional map title
+            Returns:
+                    output_file (str): Output image path
+    '''
+    import pygmt
+
+    if isinstance(astar_max, str):
+        astar_max = xr.open_dataarray(astar_max).load()
+    projection = PROJECTION.format(width=width_cm)
+    grid = xr.open_dataarray(relief_path)
+    shade = xr.open_dataarray(shade_path)
+
+    fig = pygmt.Figure()
+    pygmt.config(FONT_TITLE="10p,5", MAP_TITLE_OFFSET="1p", MAP_FRAME_TYPE="plain")
+    pygmt.config(FONT="AvantGarde-Demi")
+
+    pygmt.makecpt(cmap="terra", series=[-100, 4000])
+    fig.grdimage(grid=grid, shading=shade, projection=projection, cmap=True, transparency=60)
+
+    pygmt.makecpt(cmap="matlab/hot", reverse=True, series=[minc, maxc, dc])
+    fig.grdimage(grid=astar_max, projection=projection, cmap=True, frame=[f'+t{title}'] if title else True,
+                 nan_transparent="+z0", transparency=30)
+    fig.grdcontour(levels=np.arange(minc, maxc + dc, dc), grid=astar_max, limit=[minc, maxc], pen="0.1p,black")
+    fig.coast(shorelines=["1/0.5p,black"], borders=["1/0.5p,black", "2/0.5p,black"], water="dodgerblue3", transparency=20)
+    fig.colorbar(frame=["a"], position=f"JBC+/1.0c+w{0.6 * width_cm:g}c/0.5c")
+    fig.text(text="A@+*", position="CB", offset="0c/-2.5c", font="14p,AvantGarde-DemiOblique,black", no_clip=True)
+
+    fig.savefig(output_file, dpi=dpi)
+    grid.close()
+    shade.close()
+    instrumentation.wrote_file(output_file)
+    return output_file
+
+@instrumented('relief_render_batch')
+def render_batch(jobs, cache_dir, region=CA_REGION, width_cm=10, dpi=300, max_workers=None):
+    '''
+    Renders many storm figures over shared cached terrain.
+            Parameters:
+                    jobs (list): (astar_max path or DataArray, output_file, title) tuples
+                    cache_dir (str): Terrain cache directory
+                    region (tuple): Terrain region
+                    width_cm (float): Map width, which sets the terrain resolution
+                    dpi (int): Output resolution
+                    max_workers (int): Worker processes (defaults to the CPU count)
+            Returns:
+                    paths (list): Rendered images
+    '''
+    # Terrain is prepared here once, so workers only read the cached grids
+    relief_path, shade_path = cached_relief(region, pick_resolution(region, width_cm, dpi), cache_dir)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(render_storm_figure, astar_max, output_file, relief_path, shade_path,
+                               width_cm, dpi, title=title) for astar_max, output_file, title in jobs]
+        return [future.result() for future in futures]
+
+def render_catalog(catalog_dir, cache_dir, width_cm=10, dpi=300, max_workers=None):
+    '''
+    Renders Astar_Results.png for every storm folder of a storm catalog (see modules/storm_catalog.py).
+    '''
+    jobs = [(path, os.path.join(os.path.dirname(path), 'Astar_Results.png'), os.path.basename(os.path.dirname(path)))
+            for path in sorted(glob.glob(os.path.join(catalog_dir, 'storm_*', 'astar_max.nc')))]
+    return render_batch(jobs, cache_dir, width_cm=width_cm, dpi=dpi, max_workers=max_workers)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render storm figures for a storm catalog over cached terrain.')
+    parser.add_argument('catalog_dir', help='Storm catalog directory with storm_*/astar_max.nc')
+    parser.add_argument('--cache-dir', default='relief_cache')
+    parser.add_argument('--width-cm', type=float, default=10)
+    parser.add_argument('--dpi', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    paths = render_catalog(args.catalog_dir, args.cache_dir, args.width_cm, args.dpi, args.workers)
+    print(f"Rendered {len(paths)} figures")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
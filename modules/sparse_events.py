@@ -0,0 +1,197 @@
+# Library Imports
+import json
+import datetime
+import numpy as np
+import pandas as pd
+
+def _end_bound(end):
+    '''
+    Returns (bound, inclusive) for the end of a time filter. A date without a time of day (e.g. '2023-01-31')
+    covers that whole day, so the bound is the next midnight, exclusive; a full timestamp is inclusive.
+    '''
+    date_only = ((isinstance(end, str) and ':' not in end)
+                 or (isinstance(end, datetime.date) and not isinstance(end, datetime.datetime))
+                 or (isinstance(end, np.datetime64) and np.datetime_data(end.dtype)[0] in ('D', 'W', 'M', 'Y')))
+    if date_only:
+        return pd.Timestamp(end).normalize() + pd.Timedelta(days=1), False
+    return pd.Timestamp(end), True
+
+class SparseEvents:
+    '''
+    Compact coordinate-list (COO) storage for sparse exceedance and disturbance results.
+    Each event is one (time, row, col, value) row on a fixed grid described by its latitude and
+    longitude (or projected y/x) coordinates. Events are kept sorted by time, so temporal filters are
+    binary searches and spatial filters are integer range checks; no dense cube is rebuilt to query.
+
+    Example usage:
+        events = SparseEvents.from_exceedance(astar, threshold=1.1)
+        january = events.between('2023-01-01', '2023-01-31')
+        january.pixels()                     # which pixels exceeded in January
+        events.to_parquet('astar_exceedance_2023.parquet')
+    '''
+    def __init__(self, table, lats, lons, crs='EPSG:4326', kind='events'):
+        self.table = table.sort_values('time', kind='stable').reset_index(drop=True)
+        self.lats = np.asarray(lats)
+        self.lons = np.asarray(lons)
+        self.crs = crs
+        self.kind = kind
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def shape(self):
+        return len(self.lats), len(self.lons)
+
+    @classmethod
+    def from_exceedance(cls, astar, threshold, time_dim='z'):
+        '''
+        Returns the A* exceedance events (value >= threshold) of a prism.
+                Parameters:
+                        astar (xarray DataArray): Prism with dims (time_dim, latitude, longitude) and a 'time' coordinate
+                        threshold (float): Exceedance threshold
+                        time_dim (str): Name of the time dimension
+                Returns:
+                        events (SparseEvents): One row per exceeding pixel and timestep
+        '''
+        astar = astar.transpose(time_dim, 'latitude', 'longitude')
+        times = astar['time'].values
+        frames = []
+        # One timestep at a time, so the boolean scan never spans the whole cube
+        for t in range(astar.sizes[time_dim]):
+            grid = np.asarray(astar[t].values)
+            rows, cols = np.nonzero(grid >= threshold)
+            if rows.size:
+                frames.append(pd.DataFrame({
+                    'time': np.repeat(times[t], rows.size),
+                    'row': rows.astype('int32'),
+                    'col': cols.astype('int32'),
+                    'value': grid[rows, cols].astype('float32'),
+                }))
+        table = pd.concat(frames, ignore_index=True) if frames else cls._empty()
+        return cls(table, astar['latitude'].values, astar['longitude'].values, kind=f'astar>={threshold}')
+
+    @classmethod
+    def from_binary_mask(cls, binary_mask, time):
+        '''
+        Returns events for a single dense boolean mask (e.g. the binary_mask of a storm maximum).
+        '''
+        rows, cols = np.nonzero(np.asarray(binary_mask.values))
+        table = pd.DataFrame({'time': np.repeat(np.datetime64(time, 'ns'), rows.size),
+                              'row': rows.astype('int32'), 'col': cols.astype('int32'),
+                              'value': np.ones(rows.size, dtype='float32')})
+        return cls(table, binary_mask['latitude'].values, binary_mask['longitude'].values, kind='mask')
+
+    @classmethod
+    def from_dist_alert(cls, masked_VEG_ANOM_MAX, masked_VEG_DIST_DATE, masked_VEG_DIST_STATUS, lats, lons, crs,
+                        ref_date='2020-12-31'):
+        '''
+        Returns one event per disturbed pixel from the mask_rasters outputs, dated by VEG-DIST-DATE.
+                Parameters:
+                        masked_VEG_ANOM_MAX, masked_VEG_DIST_DATE, masked_VEG_DIST_STATUS (masked arrays): mask_rasters outputs
+                        lats, lons (array): y and x coordinates of the raster
+                        crs (str): CRS of the raster
+                        ref_date (str): Date VEG-DIST-DATE counts days from
+                Returns:
+                        events (SparseEvents): Columns time, row, col, value (VEG-ANOM-MAX) and status
+        '''
+        valid = ~np.ma.getmaskarray(masked_VEG_DIST_STATUS) & ~np.ma.getmaskarray(masked_VEG_DIST_DATE)
+        rows, cols = np.nonzero(valid)
+        days = np.asarray(masked_VEG_DIST_DATE)[rows, cols].astype('int64')
+        table = pd.DataFrame({
+            'time': pd.Timestamp(ref_date) + pd.to_timedelta(days, unit='D'),
+            'row': rows.astype('int32'),
+            'col': cols.astype('int32'),
+            'value': np.asarray(masked_VEG_ANOM_MAX)[rows, cols].astype('float32'),
+            'status': np.asarray(masked_VEG_DIST_STATUS)[rows, cols].astype('uint8'),
+        })
+        return cls(table, lats, lons, crs=crs, kind='dist-alert')
+
+    @staticmethod
+    def _empty():
+        return pd.DataFrame({'time': np.array([], dtype='datetime64[ns]'), 'row': np.array([], dtype='int32'),
+                             'col': np.array([], dtype='int32'), 'value': np.array([], dtype='float32')})
+
+    def _subset(self, table):
+        return SparseEvents(table, self.lats, self.lons, crs=self.crs, kind=self.kind)
+
+    def between(self, start=None, end=None):
+        '''
+        Returns the events with start <= time <= end (binary search on the sorted times). An end given as a
+        date without a time of day includes that whole day.
+        '''
+        times = self.table['time'].values
+        first = 0 if start is None else np.searchsorted(times, np.datetime64(pd.Timestamp(start)), side='left')
+        last = len(times)
+        if end is not None:
+            bound, inclusive = _end_bound(end)
+            last = np.searchsorted(times, np.datetime64(bound), side='right' if inclusive else 'left')
+        return self._subset(self.table.iloc[first:last])
+
+    def within(self, min_lon, max_lon, min_lat, max_lat):
+        '''
+        Returns the events inside a box given in grid coordinates, as integer row/col range checks.
+        '''
+        cols = np.nonzero((self.lons >= min_lon) & (self.lons <= max_lon))[0]
+        rows = np.nonzero((self.lats >= min_lat) & (self.lats <= max_lat))[0]
+        if cols.size == 0 or rows.size == 0:
+            return self._subset(self.table.iloc[0:0])
+        keep = ((self.table['row'].values >= rows[0]) & (self.table['row'].values <= rows[-1])
+                & (self.table['col'].values >= cols[0]) & (self.table['col'].values <= cols[-1]))
+        return self._subset(self.table[keep])
+
+    def pixels(self):
+        '''
+        Returns one row per pixel with its coordinates, first and last event time, event count and maximum value.
+        '''
+        summary = self.table.groupby(['row', 'col']).agg(first=('time', 'min'), last=('time', 'max'),
+                                                         events=('time', 'size'), max_value=('value', 'max'))
+        summary = summary.reset_index()
+        summary['latitude'] = self.lats[summary['row'].values]
+        summary['longitude'] = self.lons[summary['col'].values]
+        return summary
+
+    def to_dense(self, reducer='max'):
+        '''
+        Returns a dense 2-D grid of the events (nan where no event), reduced over time with 'max' or 'count'.
+        '''
+        grid = np.full(self.shape, np.nan, dtype='float32')
+        rows = self.table['row'].values
+        cols = self.table['col'].values
+        if reducer == 'count':
+            counts = np.zeros(self.shape, dtype='float32')
+            np.add.at(counts, (rows, cols), 1)
+            grid = np.where(counts > 0, counts, np.nan)
+        else:
+            np.fmax.at(grid, (rows, cols), self.table['value'].values)
+        return grid
+
+    def to_parquet(self, path):
+        '''
+        Writes the events to Parquet, with the grid coordinates, CRS and kind stored in the file metadata.
+        '''
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        arrow = pa.Table.from_pandas(self.table, preserve_index=False)
+        grid = {'lats': self.lats.tolist(), 'lons': self.lons.tolist(), 'crs': str(self.crs), 'kind': self.kind}
+        metadata = dict(arrow.schema.metadata or {})
+        metadata[b'sparse_events'] = json.dumps(grid).encode()
+        pq.write_table(arrow.replace_schema_metadata(metadata), path, compression='zstd')
+
+    @classmethod
+    def read_parquet(cls, path, start=None, end=None):
+        '''
+        Reads events written by to_parquet; start/end are pushed down as row filters on time, as in between.
+        '''
+        import pyarrow.parquet as pq
+
+        filters = []
+        if start is not None:
+            filters.append(('time', '>=', pd.Timestamp(start)))
+        if end is not None:
+            bound, inclusive = _end_bound(end)
+            filters.append(('time', '<=' if inclusive else '<', bound))
+        arrow = pq.read_table(path, filters=filters or None)
+        grid = json.loads(pq.read_schema(path).metadata[b'sparse_events'])
+        return cls(arrow.to_pandas(), grid['lats'], grid['lons'], crs=grid['crs'], kind=grid['kind'])
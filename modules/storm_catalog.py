@@ -0,0 +1,166 @@
+'''
+Builds a historical storm catalog from A* prisms: scans each water year for timesteps where any pixel
+reaches the threshold, segments them into storm events and computes each event's maximum grid, hazard
+regions and statistics, in parallel across years (scan) and events (analysis).
+
+Example usage, from the project root:
+    python -m modules.storm_catalog --astar 'wy*_astar/processing_results/Astar_prism_*.nc' --threshold 1.1
+'''
+# Library Imports
+import os
+import re
+import sys
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from modules.figure_and_boundingboxes import astar_regions
+from modules.instrumentation import instrumented
+
+ASTAR_NAME = re.compile(r'Astar_prism_(\d{4})\.nc$')
+
+def exceedance_series(astar_path, threshold, chunk_steps=64):
+    '''
+    Returns, per timestep, the number of pixels at or above threshold and the domain maximum of A*.
+    The prism is streamed in blocks of chunk_steps timesteps.
+    '''
+    astar = xr.open_dataarray(astar_path, chunks={'z': chunk_steps})
+    series = xr.Dataset({'pixels': (astar >= threshold).sum(dim=['latitude', 'longitude']),
+                         'max_astar': astar.max(dim=['latitude', 'longitude'])}).compute()
+    astar.close()
+    return pd.DataFrame({'time': series['time'].values, 'pixels': series['pixels'].values,
+                         'max_astar': series['max_astar'].values})
+
+def segment_storms(series, min_pixels=1, max_gap_hours=24, min_steps=1):
+    '''
+    Groups exceeding timesteps into storm events.
+            Parameters:
+                    series (DataFrame): Output of exceedance_series
+                    min_pixels (int): Pixels at or above threshold for a timestep to count as exceeding
+                    max_gap_hours (float): Exceeding timesteps closer than this belong to the same storm
+                    min_steps (int): Drop storms with fewer exceeding timesteps
+            Returns:
+                    storms (DataFrame): One row per storm with begin, end, steps, peak_pixels and peak_astar
+    '''
+    active = series[series['pixels'] >= min_pixels]
+    columns = ['begin', 'end', 'steps', 'peak_pixels', 'peak_astar']
+    if active.empty:
+        return pd.DataFrame(columns=columns)
+    gaps = active['time'].diff() > pd.Timedelta(hours=max_gap_hours)
+    storm = active.groupby(gaps.cumsum().values)
+    storms = pd.DataFrame({'begin': storm['time'].min(), 'end': storm['time'].max(), 'steps': storm.size(),
+                           'peak_pixels': storm['pixels'].max(), 'peak_astar': storm['max_astar'].max()})
+    return storms[storms['steps'] >= min_steps].reset_index(drop=True)[columns]
+
+def scan_water_year(WY, astar_path, threshold, min_pixels=1, max_gap_hours=24, min_steps=1):
+    storms = segment_storms(exceedance_series(astar_path, threshold), min_pixels, max_gap_hours, min_steps)
+    storms.insert(0, 'WY', WY)
+    storms['astar_path'] = astar_path
+    return storms
+
+def analyze_storm(storm_id, astar_path, begin, end, threshold, output_dir):
+    '''
+    Computes one event's maximum grid, regions and statistics and writes them under output_dir/storm_id.
+            Returns:
+                    stats (dict): Region count, exceeding pixel count, exceeding area (deg2), peak A*, and the
+                                  first exceedance and largest region bounds
+    '''
+    storm_dir = os.path.join(output_dir, storm_id)
+    os.makedirs(storm_dir, exist_ok=True)
+    with xr.open_dataarray(astar_path) as astar:
+        times = astar['time'].values
+        window = np.nonzero((times >= np.datetime64(begin)) & (times <= np.datetime64(end)))[0]
+        astar = astar.isel(z=slice(window[0], window[-1] + 1)).load()
+
+    regions, storm_max = astar_regions(astar, begin, end, threshold)
+    storm_max.rename('astar_max').to_netcdf(os.path.join(storm_dir, 'astar_max.nc'))
+    regions.to_parquet(os.path.join(storm_dir, 'regions.parquet'))
+
+    lats = storm_max['latitude'].values
+    lons = storm_max['longitude'].values
+    cell_area = abs(np.diff(lats).mean() * np.diff(lons).mean())
+    exceeding = int((storm_max.values >= threshold).sum())
+    stats = {'storm_id': storm_id, 'regions': len(regions), 'exceed_pixels': exceeding,
+             'exceed_area_deg2': exceeding * cell_area, 'max_astar': float(np.nanmax(storm_max.values)),
+             'first_exceedance': regions['exceedance'].min() if len(regions) else pd.NaT}
+    if len(regions):
+        largest = regions.loc[regions['area'].idxmax()]
+        stats.update({'min_lon': largest.min_lon, 'min_lat': largest.min_lat,
+                      'max_lon': largest.max_lon, 'max_lat': largest.max_lat})
+    return stats
+
+@instrumented('storm_catalog')
+def build_storm_catalog(astar_paths, threshold, output_dir, min_pixels=1, max_gap_hours=24, min_steps=1,
+                        max_workers=None, region_store=None):
+    '''
+    Builds the storm catalog for many water years.
+            Parameters:
+                    astar_paths (dict or list): WY -> Astar_prism_{WY}.nc path, or paths named that way
+                    threshold (float): A* threshold defining exceedance
+                    output_dir (str): Directory for storm_catalog.csv and one folder per storm
+                    min_pixels (int): Pixels at or above threshold for a timestep to count as exceeding
+                    max_gap_hours (float): Exceeding timesteps closer than this belong to the same storm
+                    min_steps (int): Drop storms with fewer exceeding timesteps
+                    max_workers (int): Worker processes (defaults to the CPU count)
+                    region_store (str): If given, every storm's regions are appended to this RegionStore
+            Returns:
+                    catalog (DataFrame): One row per storm with its window and statistics
+    '''
+    if not isinstance(astar_paths, dict):
+        astar_paths = {ASTAR_NAME.search(os.path.basename(path)).group(1): path for path in astar_paths}
+    os.makedirs(output_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        scans = [pool.submit(scan_water_year, str(WY), path, threshold, min_pixels, max_gap_hours, min_steps)
+                 for WY, path in sorted(astar_paths.items())]
+        storms = pd.concat([future.result() for future in scans], ignore_index=True)
+        if storms.empty:
+            print("No storms found.")
+            return storms
+        storms['storm_id'] = [f'storm_{begin:%Y%m%dT%H}_{end:%Y%m%dT%H}'
+                              for begin, end in zip(storms['begin'], storms['end'])]
+        print(f"Found {len(storms)} storms in {len(astar_paths)} water years")
+
+        events = [pool.submit(analyze_storm, row.storm_id, row.astar_path, row.begin, row.end, threshold, output_dir)
+                  for row in storms.itertuples()]
+        stats = pd.DataFrame([future.result() for future in events])
+
+    catalog = storms.drop(columns=['astar_path']).merge(stats, on='storm_id')
+    catalog['threshold'] = threshold
+    catalog.to_csv(os.path.join(output_dir, 'storm_catalog.csv'), index=False)
+
+    if region_store is not None:
+        import geopandas as gpd
+        from modules.region_store import RegionStore
+
+        with RegionStore(region_store) as store:
+            for row in catalog.itertuples():
+                regions = gpd.read_parquet(os.path.join(output_dir, row.storm_id, 'regions.parquet'))
+                store.append(regions, row.begin, row.end, threshold, WY=row.WY)
+
+    print(f"Catalog saved to {os.path.join(output_dir, 'storm_catalog.csv')}")
+    return catalog
+
+def main(argv=None):
+    project_root = os.getcwd()
+    parser = argparse.ArgumentParser(description='Build a storm catalog from A* prisms.')
+    parser.add_argument('--astar', default=os.path.join(project_root, 'wy*_astar', 'processing_results', 'Astar_prism_*.nc'),
+                        help='Glob pattern of Astar_prism_{WY}.nc files')
+    parser.add_argument('--threshold', type=float, default=1.1)
+    parser.add_argument('--output-dir', default=os.path.join(project_root, 'storm_catalog'))
+    parser.add_argument('--min-pixels', type=int, default=1)
+    parser.add_argument('--max-gap-hours', type=float, default=24)
+    parser.add_argument('--min-steps', type=int, default=1)
+    parser.add_argument('--region-store', default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    build_storm_catalog(sorted(glob.glob(args.astar)), args.threshold, args.output_dir, args.min_pixels,
+                        args.max_gap_hours, args.min_steps, args.workers, args.region_store)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
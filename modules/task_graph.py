@@ -0,0 +1,205 @@
+'''
+Small local task scheduler with content-hash memoization.
+
+Each task declares its function, parameters, input files and output files. Its cache key is a hash of
+the function name, the parameters, the content of its input files and the keys of the tasks it depends
+on, so a task reruns only when one of those changes, and every task downstream of it follows. Tasks
+whose dependencies are done run concurrently.
+
+Example usage:
+    graph = TaskGraph(cache_dir='.task_cache')
+    awi = graph.add('awi', run_awi, params={'WY': '2023'}, inputs=['wy2023_astar/wy_data/*.nc'],
+                    outputs=['wy2023_astar/processing_results/AWI_prism_2023.nc'])
+    graph.add('regions', extract_regions, params={'awi_paths': awi, 'threshold': 1.1})
+    results = graph.run()
+Changing threshold only reruns 'regions'; a new QPE file reruns both.
+'''
+# Library Imports
+import os
+import glob
+import json
+import pickle
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class Ref:
+    '''
+    Placeholder for the result of another task, usable anywhere inside a task's params.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f'Ref({self.name!r})'
+
+class Task:
+    def __init__(self, name, func, params=None, inputs=(), outputs=(), deps=(), cache=True):
+        self.name = name
+        self.func = func
+        self.params = params or {}
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.cache = cache
+        self.deps = set(deps) | {ref.name for ref in _refs(self.params)}
+
+def _refs(value):
+    if isinstance(value, Ref):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _refs(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _refs(item)
+
+def _resolve(value, lookup):
+    '''
+    Returns value with every Ref replaced by lookup(name).
+    '''
+    if isinstance(value, Ref):
+        return lookup(value.name)
+    if isinstance(value, dict):
+        return {k: _resolve(v, lookup) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_resolve(v, lookup) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_resolve(v, lookup) for v in value)
+    return value
+
+class TaskGraph:
+    def __init__(self, cache_dir, max_workers=4):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.tasks = {}
+        self._hash_lock = threading.Lock()
+        self._hash_index_path = os.path.join(cache_dir, 'file_hashes.json')
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self._hash_index_path):
+            with open(self._hash_index_path) as f:
+                self._hash_index = json.load(f)
+        else:
+            self._hash_index = {}
+
+    def add(self, name, func, params=None, inputs=(), outputs=(), deps=(), cache=True):
+        '''
+        Adds a task and returns a Ref to its result.
+                Parameters:
+                        name (str): Unique task name
+                        func (callable): Called as func(**params) with Refs resolved
+                        params (dict): Keyword arguments; must be JSON serializable or repr-stable
+                        inputs (list): Input file paths or glob patterns, hashed by content when the task runs
+                        outputs (list): Output paths; the task reruns if any is missing
+                        deps (list): Extra task names to wait for (Refs in params are added automatically)
+                        cache (bool): False for tasks that must always run (e.g. incremental downloads)
+                Returns:
+                        ref (Ref): Reference to the task result
+        '''
+        if name in self.tasks:
+            raise ValueError(f"Task '{name}' already exists.")
+        self.tasks[name] = Task(name, func, params, inputs, outputs, deps, cache)
+        return Ref(name)
+
+    def file_hash(self, path):
+        '''
+        Returns the sha256 of a file, reusing the stored hash while its size and mtime are unchanged.
+        '''
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        with self._hash_lock:
+            entry = self._hash_index.get(path)
+            if entry and entry['stamp'] == stamp:
+                return entry['sha256']
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        with self._hash_lock:
+            self._hash_index[path] = {'stamp': stamp, 'sha256': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def task_key(self, task, dep_keys):
+        files = sorted({path for pattern in task.inputs for path in (glob.glob(pattern) or [pattern])})
+        payload = {
+            'func': f'{task.func.__module__}.{task.func.__qualname__}',
+            'params': _resolve(task.params, lambda name: f'task:{dep_keys[name]}'),
+            'inputs': {path: self.file_hash(path) if os.path.exists(path) else None for path in files},
+            'deps': {name: dep_keys[name] for name in sorted(task.deps)},
+        }
+        encoded = json.dumps(payload, sort_keys=True, default=repr)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def _record_path(self, name):
+        return os.path.join(self.cache_dir, f'{name}.json')
+
+    def _result_path(self, name):
+        return os.path.join(self.cache_dir, f'{name}.pkl')
+
+    def _load_cached(self, task, key):
+        record_path = self._record_path(task.name)
+        if not (task.cache and os.path.exists(record_path) and os.path.exists(self._result_path(task.name))):
+            return False, None
+        with open(record_path) as f:
+            record = json.load(f)
+        if record['key'] != key or not all(os.path.exists(path) for path in task.outputs):
+            return False, None
+        with open(self._result_path(task.name), 'rb') as f:
+            return True, pickle.load(f)
+
+    def _execute(self, task, dep_keys, results, force):
+        key = self.task_key(task, dep_keys)
+        if task.name not in force:
+            hit, result = self._load_cached(task, key)
+            if hit:
+                return key, result, 'cached'
+        result = task.func(**_resolve(task.params, lambda name: results[name]))
+        if task.cache:
+            with open(self._result_path(task.name), 'wb') as f:
+                pickle.dump(result, f)
+            with open(self._record_path(task.name), 'w') as f:
+                json.dump({'key': key, 'outputs': task.outputs}, f)
+        return key, result, 'ran'
+
+    def run(self, targets=None, force=()):
+        '''
+        Runs the tasks needed for targets (default: all), concurrently where dependencies allow.
+                Parameters:
+                        targets (list): Task names to produce
+                        force (list): Task names to rerun even when their cache key matches
+                Returns:
+                        results (dict): Task name -> result
+        '''
+        needed = set()
+        stack = list(targets or self.tasks)
+        while stack:
+            name = stack.pop()
+            if name not in self.tasks:
+                raise KeyError(f"Unknown task: {name}")
+            if name not in needed:
+                needed.add(name)
+                stack.extend(self.tasks[name].deps)
+
+        force = set(force)
+        keys, results, status = {}, {}, {}
+        pending = set(needed)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                ready = [name for name in pending if self.tasks[name].deps <= set(keys)]
+                for name in ready:
+                    pending.discard(name)
+                    dep_keys = {dep: keys[dep] for dep in self.tasks[name].deps}
+                    running[pool.submit(self._execute, self.tasks[name], dep_keys, results, force)] = name
+                if not running:
+                    raise ValueError(f"Dependency cycle among tasks: {sorted(pending)}")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    keys[name], results[name], status[name] = future.result()
+                    print(f"{name}: {status[name]}")
+
+        with self._hash_lock:
+            with open(self._hash_index_path, 'w') as f:
+                json.dump(self._hash_index, f)
+        self.status = status
+        return results
@@ -0,0 +1,129 @@
+import base64
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from modules.earthdata_session import EarthdataSession
+
+PAYLOAD = bytes(range(256)) * 64
+USERNAME, PASSWORD = 'user', 'secret'
+
+class Servers:
+    '''
+    A data host that needs a session cookie and a login host that checks basic auth, as Earthdata does:
+    data -> 302 login -> 302 data /callback (sets the cookie) -> 302 data file.
+    '''
+    def __init__(self):
+        self.logins = 0
+        self.data_requests = []
+        self.data = self._serve(self._data_handler())
+        self.urs = self._serve(self._urs_handler())
+        self.data_url = f'http://127.0.0.1:{self.data.server_port}'
+        self.urs_host = f'localhost:{self.urs.server_port}'
+
+    def _serve(self, handler):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def _data_handler(self):
+        servers = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                servers.data_requests.append(self.path)
+                url = urlparse(self.path)
+                if url.path == '/callback':
+                    self.send_response(302)
+                    self.send_header('Set-Cookie', 'session=ok; Path=/')
+                    self.send_header('Location', parse_qs(url.query)['next'][0])
+                    self.end_headers()
+                elif 'session=ok' not in (self.headers.get('Cookie') or ''):
+                    self.send_response(302)
+                    self.send_header('Location', f'http://{servers.urs_host}/oauth?next={quote(self.path)}')
+                    self.end_headers()
+                else:
+                    start, end = self.headers.get('Range', f'bytes=0-{len(PAYLOAD) - 1}')[6:].split('-')
+                    body = PAYLOAD[int(start):int(end) + 1]
+                    self.send_response(206 if 'Range' in self.headers else 200)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+        return Handler
+
+    def _urs_handler(self):
+        servers = self
+        expected = 'Basic ' + base64.b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.headers.get('Authorization') != expected:
+                    self.send_response(401)
+                    self.end_headers()
+                    return
+                servers.logins += 1
+                next_path = parse_qs(urlparse(self.path).query)['next'][0]
+                self.send_response(302)
+                self.send_header('Location', f'{servers.data_url}/callback?next={quote(next_path)}')
+                self.end_headers()
+        return Handler
+
+    def close(self):
+        for server in (self.data, self.urs):
+            server.shutdown()
+            server.server_close()
+
+@pytest.fixture
+def servers():
+    servers = Servers()
+    yield servers
+    servers.close()
+
+def test_fetch_logs_in_once_and_reuses_the_cookie(servers, tmp_path):
+    netrc_path = tmp_path / 'netrc'
+    netrc_path.write_text(f'machine {servers.urs_host}\n    login {USERNAME}\n    password {PASSWORD}\n')
+
+    async def main():
+        async with EarthdataSession(netrc_path=str(netrc_path), urs=servers.urs_host) as session:
+            first = await session.fetch(f'{servers.data_url}/granule_B01.tif')
+            header = await session.fetch(f'{servers.data_url}/granule_B02.tif', byte_range=(0, 1023))
+            return first, header
+
+    first, header = asyncio.run(main())
+    assert first == PAYLOAD
+    assert header == PAYLOAD[:1024]
+    assert servers.logins == 1
+    # The second file is served straight from the cookie, without another redirect to the login host
+    assert servers.data_requests[-1] == '/granule_B02.tif'
+    assert servers.data_requests.count('/granule_B02.tif') == 1
+
+def test_read_many_runs_inside_a_running_event_loop(tmp_path):
+    np = pytest.importorskip('numpy')
+    rasterio = pytest.importorskip('rasterio')
+    from rasterio.transform import from_origin
+
+    paths = []
+    for k in range(3):
+        path = str(tmp_path / f'band_{k}.tif')
+        with rasterio.open(path, 'w', driver='GTiff', width=4, height=4, count=1, dtype='uint8',
+                           transform=from_origin(0, 4, 1, 1)) as dst:
+            dst.write(np.full((4, 4), k, dtype='uint8'), 1)
+        paths.append(path)
+
+    async def notebook_cell():
+        # As in Jupyter, where the cell already runs inside an event loop
+        return EarthdataSession(netrc_path=str(tmp_path / 'netrc')).read_many(paths)
+
+    arrays = asyncio.run(notebook_cell())
+    assert [int(array[0, 0]) for array in arrays] == [0, 1, 2]
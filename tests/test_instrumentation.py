@@ -0,0 +1,20 @@
+from modules.instrumentation import Instrumentation
+
+def test_nested_stage_keeps_parent_heap_peak():
+    recorder = Instrumentation()
+    recorder.enable(trace_memory=True)
+    try:
+        with recorder.stage('outer'):
+            block = bytearray(32 * 2**20)
+            del block
+            with recorder.stage('inner'):
+                small = bytearray(2**20)
+                del small
+    finally:
+        recorder.disable()
+
+    peaks = {record['stage']: record['peak_heap_mb'] for record in recorder.records}
+    assert peaks['outer'] >= 32
+    assert peaks['inner'] < 16
+    assert all('max_rss_mb' in record for record in recorder.records)
+    assert recorder.summary()['outer']['peak_heap_mb'] == peaks['outer']
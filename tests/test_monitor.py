@@ -0,0 +1,70 @@
+import os
+import json
+import pytest
+
+np = pytest.importorskip('numpy')
+xr = pytest.importorskip('xarray')
+pystac = pytest.importorskip('pystac')
+pytest.importorskip('geopandas')
+pytest.importorskip('rioxarray')
+pytest.importorskip('metpy')
+
+from benchmarks.synthetic import write_synthetic_qpe
+from modules import monitor
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LATLON_CSV = os.path.join(PROJECT_ROOT, 'astar_needed_DoNotTouch', 'QPE_latlons_new.csv')
+BOUNDS = [-122.0, -120.0, 37.0, 39.0]
+
+def write_recurrence(path):
+    # A tiny recurrence level, so pixels cross the threshold as soon as rain accumulates
+    lats = np.linspace(43.0, 32.0, 45)
+    lons = np.linspace(-125.0, -113.0, 49)
+    tp = xr.DataArray(np.full((lats.size, lons.size), 1e-3), coords={'latitude': lats, 'longitude': lons},
+                      dims=('latitude', 'longitude'), name='tp')
+    tp.to_dataset().to_netcdf(path)
+
+def write_catalog(directory):
+    from datetime import datetime
+    from shapely.geometry import box, mapping
+
+    catalog = pystac.Catalog(id='dist-alert', description='Static DIST-ALERT catalog')
+    min_lon, max_lon, min_lat, max_lat = BOUNDS
+    item = pystac.Item(id='OPERA_L3_DIST-ALERT-HLS_T10SFH_20230101T183909Z_20230104T003620Z_S2B_30_v1',
+                       geometry=mapping(box(min_lon, min_lat, max_lon, max_lat)),
+                       bbox=[min_lon, min_lat, max_lon, max_lat], datetime=datetime(2023, 1, 1, 18), properties={})
+    item.add_asset('VEG-DIST-STATUS', pystac.Asset(href='https://example.com/VEG-DIST-STATUS.tif'))
+    catalog.add_item(item)
+    catalog.normalize_hrefs(directory)
+    catalog.save(catalog_type=pystac.CatalogType.SELF_CONTAINED)
+    return os.path.join(directory, 'catalog.json'), item.id
+
+def test_once_alerts_and_watches_each_region_once(tmp_path):
+    qpe_dir = tmp_path / 'qpe'
+    write_synthetic_qpe(str(qpe_dir), LATLON_CSV, n_steps=3, start='2022-12-31T00:00')
+    recurrence = str(tmp_path / 'recurrence.nc')
+    write_recurrence(recurrence)
+    catalog, item_id = write_catalog(str(tmp_path / 'stac'))
+    state_dir = tmp_path / 'state'
+    config_path = str(tmp_path / 'monitor.json')
+    with open(config_path, 'w') as f:
+        json.dump({'project_root': str(tmp_path), 'qpe_source': str(qpe_dir), 'stac_source': catalog,
+                   'state_dir': str(state_dir), 'bounds': BOUNDS, 'latlon_csv': LATLON_CSV,
+                   'recurrence': recurrence, 'regrid_cache': str(tmp_path / 'regrid')}, f)
+
+    assert monitor.main([config_path, '--once']) == 0
+
+    alerts = sorted(os.listdir(state_dir / 'alerts'))
+    assert alerts[0] == 'disturbance_' + item_id + '.json'
+    assert alerts[1] == 'hazard_20221231T0000.json'
+    with open(state_dir / 'watch.json') as f:
+        watch = json.load(f)['watch']
+    assert watch
+    assert len({tuple(entry['bounds']) for entry in watch}) == len(watch)
+    with open(state_dir / 'latency.jsonl') as f:
+        assert len(f.readlines()) == 3
+
+    # A second pass finds nothing new and leaves the watch list unchanged
+    assert monitor.main([config_path, '--once']) == 0
+    with open(state_dir / 'watch.json') as f:
+        assert json.load(f)['watch'] == watch
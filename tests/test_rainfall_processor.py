@@ -0,0 +1,53 @@
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+xr = pytest.importorskip('xarray')
+pytest.importorskip('rioxarray')
+pytest.importorskip('metpy')
+
+from benchmarks.synthetic import write_synthetic_qpe
+from modules.RainfallProcessor import HRAP_PROJ4, RainfallProcessor
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LATLON_CSV = os.path.join(PROJECT_ROOT, 'astar_needed_DoNotTouch', 'QPE_latlons_new.csv')
+BOUNDS = (-122.0, -120.0, 37.0, 39.0)
+
+def test_memmap_runner_matches_dense_runner(tmp_path):
+    write_synthetic_qpe(str(tmp_path / 'qpe'), LATLON_CSV, n_steps=4)
+    pattern = str(tmp_path / 'qpe' / '*.nc')
+    dense = RainfallProcessor(LATLON_CSV, HRAP_PROJ4, str(tmp_path / 'dense'))
+    memmap = RainfallProcessor(LATLON_CSV, HRAP_PROJ4, str(tmp_path / 'memmap'))
+    os.makedirs(dense.output_dir)
+
+    rain, awi = dense.process_dir_CNRFC_AWI_WY(pattern, *BOUNDS, None, 'test')
+    rain_mm, awi_mm = memmap.process_dir_CNRFC_AWI_WY_memmap(pattern, *BOUNDS, None, 'test')
+
+    assert awi_mm.dims == awi.dims
+    assert awi_mm.rio.crs == awi.rio.crs
+    np.testing.assert_array_equal(awi_mm['time'].values, awi['time'].values)
+    np.testing.assert_allclose(awi_mm['latitude'].values, awi['latitude'].values)
+    np.testing.assert_allclose(awi_mm['longitude'].values, awi['longitude'].values)
+    np.testing.assert_allclose(rain_mm.values, rain.values, rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(awi_mm.values, awi.values, rtol=1e-5, atol=1e-7)
+    assert not any(name.endswith('.f32') for name in os.listdir(memmap.output_dir))
+
+    # Both runners' files open as single data arrays, as compute_astar and the climatology read them
+    for output_dir in (dense.output_dir, memmap.output_dir):
+        with xr.open_dataarray(os.path.join(output_dir, 'AWI_prism_test.nc')) as prism:
+            assert prism.sizes['z'] == 4
+
+def test_region_runner_matches_dense_runner(tmp_path):
+    write_synthetic_qpe(str(tmp_path / 'qpe'), LATLON_CSV, n_steps=3)
+    pattern = str(tmp_path / 'qpe' / '*.nc')
+    processor = RainfallProcessor(LATLON_CSV, HRAP_PROJ4, str(tmp_path / 'out'))
+    os.makedirs(processor.output_dir)
+
+    _, awi = processor.process_dir_CNRFC_AWI_WY(pattern, *BOUNDS, None, 'test')
+    processor.process_dir_CNRFC_AWI_regions(pattern, {'box': BOUNDS}, None, 'test')
+
+    # Read as compute_astar reads the AWI prism
+    with xr.open_dataset(os.path.join(processor.output_dir, 'AWI_prism_test_box.nc')) as ds:
+        region = ds['__xarray_dataarray_variable__'].load()
+    expected = awi.sel(latitude=region['latitude'], longitude=region['longitude'])
+    np.testing.assert_allclose(region.values, expected.values)
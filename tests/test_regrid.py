@@ -0,0 +1,34 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+xr = pytest.importorskip('xarray')
+pytest.importorskip('scipy')
+
+from modules.regrid import Regridder
+
+def descending_field():
+    # Latitude descending, as in the recurrence and QPE grids
+    lats = np.linspace(42.0, 32.0, 41)
+    lons = np.linspace(-125.0, -113.0, 49)
+    values = np.random.default_rng(0).random((lats.size, lons.size))
+    return xr.DataArray(values, coords={'latitude': lats, 'longitude': lons}, dims=('latitude', 'longitude'))
+
+def target_axes():
+    # Offsets away from cell midpoints, so nearest has no ties
+    lats = np.linspace(41.83, 32.11, 23)
+    lons = np.linspace(-124.91, -113.07, 31)
+    return lats, lons
+
+def test_nearest_matches_xarray_on_descending_grid():
+    field = descending_field()
+    lats, lons = target_axes()
+    expected = field.interp(latitude=lats, longitude=lons, method='nearest')
+    regridded = Regridder(field['latitude'].values, field['longitude'].values, lats, lons, method='nearest')(field)
+    np.testing.assert_allclose(regridded.values, expected.values)
+
+def test_bilinear_matches_xarray_on_descending_grid():
+    field = descending_field()
+    lats, lons = target_axes()
+    expected = field.interp(latitude=lats, longitude=lons, method='linear')
+    regridded = Regridder(field['latitude'].values, field['longitude'].values, lats, lons)(field)
+    np.testing.assert_allclose(regridded.values, expected.values)
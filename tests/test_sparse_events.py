@@ -0,0 +1,57 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+xr = pytest.importorskip('xarray')
+
+from modules.sparse_events import SparseEvents
+
+def synthetic_prism():
+    # 6-hourly steps from Jan 30 to Feb 1, latitude descending as in the A* prisms
+    times = pd.date_range('2023-01-30T00:00', '2023-02-01T18:00', freq='6h').values
+    lats = np.linspace(39.0, 37.0, 9)
+    lons = np.linspace(-122.0, -120.0, 11)
+    values = np.random.default_rng(0).random((times.size, lats.size, lons.size)) * 2
+    return xr.DataArray(values, dims=('z', 'latitude', 'longitude'),
+                        coords={'time': ('z', times), 'latitude': lats, 'longitude': lons})
+
+def test_dense_sparse_parquet_round_trip(tmp_path):
+    astar = synthetic_prism()
+    events = SparseEvents.from_exceedance(astar, threshold=1.1)
+
+    exceeded = (astar >= 1.1).values
+    assert len(events) == exceeded.sum()
+    np.testing.assert_allclose(events.to_dense(), astar.where(astar >= 1.1).max('z').values)
+
+    path = str(tmp_path / 'events.parquet')
+    events.to_parquet(path)
+    restored = SparseEvents.read_parquet(path)
+    pd.testing.assert_frame_equal(restored.table, events.table)
+    np.testing.assert_array_equal(restored.lats, events.lats)
+    np.testing.assert_array_equal(restored.lons, events.lons)
+    assert (restored.crs, restored.kind) == (events.crs, events.kind)
+
+def test_time_and_space_filters(tmp_path):
+    astar = synthetic_prism()
+    events = SparseEvents.from_exceedance(astar, threshold=1.1)
+    times = pd.to_datetime(events.table['time'])
+
+    # A date-only end includes the whole day, the 06, 12 and 18 UTC steps of Jan 31 too
+    january = events.between('2023-01-01', '2023-01-31')
+    assert len(january) == (times < pd.Timestamp('2023-02-01')).sum()
+    assert pd.Timestamp(january.table['time'].max()) == pd.Timestamp('2023-01-31T18:00')
+    # A full timestamp is an inclusive instant
+    assert len(events.between('2023-01-31T00:00', '2023-01-31T06:00')) == times.between('2023-01-31T00:00',
+                                                                                        '2023-01-31T06:00').sum()
+
+    path = str(tmp_path / 'events.parquet')
+    events.to_parquet(path)
+    pd.testing.assert_frame_equal(SparseEvents.read_parquet(path, '2023-01-01', '2023-01-31').table, january.table)
+
+    box = events.within(-121.5, -120.5, 37.5, 38.5)
+    lats = events.lats[box.table['row'].values]
+    lons = events.lons[box.table['col'].values]
+    assert ((lats >= 37.5) & (lats <= 38.5) & (lons >= -121.5) & (lons <= -120.5)).all()
+    inside = ((events.lats[events.table['row'].values] >= 37.5) & (events.lats[events.table['row'].values] <= 38.5)
+              & (events.lons[events.table['col'].values] >= -121.5) & (events.lons[events.table['col'].values] <= -120.5))
+    assert len(box) == inside.sum()